@@ -1,4 +1,5 @@
 
+import re
 import pandas as pd
 import streamlit as st
 from sqlalchemy import text
@@ -6,7 +7,10 @@ from datetime import datetime
 
 # Annahme: Diese Module sind korrekt eingerichtet und verfügbar
 from Authorisation import (generate_salt, hash_password, get_searchable_columns, search_table, get_column_types)
-from Ticket import (create_ticket_relations, get_columns)
+from Ticket import (create_ticket_relations, create_ticket_relations_bulk, get_columns)
+from TicketCounts import invalidate_status_counts
+from TicketChanges import ACTION_DELETE, ACTION_INSERT, ACTION_UPDATE, get_change_version, publish_change
+from TicketMailboxes import HIDDEN_TABLES
 
 # ==============================================================================
 # 2. HELPER & DATA LOGIC FUNCTIONS
@@ -21,6 +25,9 @@ def get_delete_plan(table_name):
         "ticket": [
             {"name": "Ticket-Kommentare", "query": "DELETE FROM ticket_kommentar WHERE ID_Ticket = :id"},
             {"name": "Ticket-Historie", "query": "DELETE FROM ticket_historie WHERE ID_Ticket = :id"},
+            {"name": "Archivierte Ticket-Historie", "query": "DELETE FROM ticket_historie_archiv WHERE ID_Ticket = :id"},
+            {"name": "Ticket-Snapshots", "query": "DELETE FROM ticket_snapshot WHERE ID_Ticket = :id"},
+            {"name": "Ticket-Anhänge", "query": "DELETE FROM ticket_anhang WHERE ID_Ticket = :id"},
             {"name": "Ticket-Mitarbeiter-Zuordnungen", "query": "DELETE FROM ticket_mitarbeiter WHERE ID_Ticket = :id"},
             {"name": "Ticket-Kategorie-Zuordnungen", "query": "DELETE FROM ticket_kategorie WHERE ID_Ticket = :id"},
             {"name": "Ticket", "query": "DELETE FROM ticket WHERE ID_Ticket = :id"}
@@ -28,6 +35,7 @@ def get_delete_plan(table_name):
         "mitarbeiter": [
             {"name": "Ticket-Mitarbeiter-Zuordnungen", "query": "DELETE FROM ticket_mitarbeiter WHERE ID_Mitarbeiter = :id"},
             {"name": "Ticket-Historie-Einträge", "query": "UPDATE ticket_historie SET Geändert_von = NULL WHERE Geändert_von = :id"},
+            {"name": "Archivierte Historie-Einträge", "query": "UPDATE ticket_historie_archiv SET Geändert_von = NULL WHERE Geändert_von = :id"},
             {"name": "Tickets", "query": "UPDATE ticket SET ID_Mitarbeiter = NULL WHERE ID_Mitarbeiter = :id"},
             {"name": "Kommentare", "query": "UPDATE ticket_kommentar SET Erstellt_von = NULL WHERE Erstellt_von = :id"},
             {"name": "Mitarbeiter", "query": "DELETE FROM mitarbeiter WHERE ID_Mitarbeiter = :id"}
@@ -58,6 +66,14 @@ def execute_delete_step(engine, step_info, id_value, id_column):
             # Platzhalter für die ID-Spalte im generischen Fall ersetzen
             query_str = step_info['query'].format(id_column=id_column)
             conn.execute(text(query_str), {"id": id_value})
+
+            # Betroffene Tabelle für den Änderungs-Feed aus dem Statement ermitteln
+            match = re.match(r"\s*(DELETE FROM|UPDATE)\s+(\w+)", query_str, re.IGNORECASE)
+            if match:
+                action = ACTION_DELETE if match.group(1).upper() == "DELETE FROM" else ACTION_UPDATE
+                publish_change(match.group(2), action=action, conn=conn)
+        if "ticket" in query_str or "status" in query_str:
+            invalidate_status_counts()
         return True
     except Exception as e:
         st.error(f"❌ Fehler beim Ausführen des Schritts '{step_info['name']}': {e}")
@@ -139,7 +155,7 @@ def show_view_tab(engine, inspector):
     """Rendert den 'Anzeigen'-Tab mit Tabellenauswahl und Suche."""
     st.subheader("Tabelle anzeigen")
     try:
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         table_choice = st.selectbox("Wähle eine Tabelle", tabellen, key="view_table")
 
         # Suchfunktion für die ausgewählte Tabelle
@@ -215,7 +231,7 @@ def show_edit_tab(engine, inspector):
     """Rendert den 'Bearbeiten'-Tab mit dem interaktiven Data Editor."""
     st.subheader("Datensätze bearbeiten (interaktiv)")
     try:
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         table_choice_edit = st.selectbox("Tabelle wählen (Bearbeiten)", tabellen, key="edit_table_editor")
         spalten = get_columns(table_choice_edit)
         id_spalte = st.selectbox("Primärschlüsselspalte", spalten, key="primary_column_editor")
@@ -229,8 +245,13 @@ def show_edit_tab(engine, inspector):
             df = pd.read_sql(f"SELECT * FROM {table_choice_edit}", con=engine)
             st.session_state.original_df = df.copy()
             st.session_state.edited_df = df.copy()
+            st.session_state.edit_df_version = (table_choice_edit, get_change_version(table_choice_edit))
 
         if not st.session_state.original_df.empty:
+            # Offene Bearbeitungen nicht überschreiben, aber auf fremde Änderungen hinweisen
+            loaded_table, loaded_version = st.session_state.get("edit_df_version", (None, None))
+            if loaded_table == table_choice_edit and loaded_version != get_change_version(table_choice_edit):
+                st.warning("⚠️ Die Tabelle wurde seit dem Laden geändert. Bitte Daten neu laden.")
             st.markdown("✏️ **Daten bearbeiten – Änderungen werden erst nach dem Speichern übernommen.**")
             st.session_state.edited_df = st.data_editor(
                 st.session_state.edited_df,
@@ -261,17 +282,25 @@ def show_edit_tab(engine, inspector):
 
                                 if update_fields:
                                     set_clause = ", ".join([f"{col} = :{col}" for col in update_fields])
+                                    # Tickets: Version erhöhen, damit offene Bearbeitungen den Konflikt erkennen
+                                    if table_choice_edit == "ticket" and "version" not in update_fields:
+                                        set_clause += ", version = version + 1"
                                     query = text(
                                         f"UPDATE {table_choice_edit} SET {set_clause} WHERE {id_spalte} = :id_value"
                                     )
                                     update_fields["id_value"] = row[id_spalte]
                                     conn.execute(query, update_fields)
 
+                            publish_change(table_choice_edit, action=ACTION_UPDATE, conn=conn)
+
+                        if table_choice_edit in ("ticket", "status"):
+                            invalidate_status_counts()
                         st.success("✅ Änderungen erfolgreich gespeichert.")
-                        # Daten neu laden
+                        # Daten neu laden; die Version wird nach dem Neustart aus dem Feed übernommen
                         df = pd.read_sql(f"SELECT * FROM {table_choice_edit}", con=engine)
                         st.session_state.original_df = df.copy()
                         st.session_state.edited_df = df.copy()
+                        st.session_state.edit_df_version = None
                         st.rerun()
 
                     except Exception as e:
@@ -289,7 +318,7 @@ def show_insert_tab(engine, inspector):
     insert_tab1, insert_tab2 = st.tabs(["Einzelner Datensatz", "Mehrere Datensätze"])
 
     try:
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         table_choice = st.selectbox("Tabelle wählen (Einfügen)", tabellen, key="insert_table")
         spalten = get_columns(table_choice)
         spalten_typen = get_column_types(table_choice)
@@ -335,6 +364,7 @@ def show_insert_tab(engine, inspector):
                         placeholders = ", ".join([f":{col}" for col in valid_spalten])
                         query = text(f"INSERT INTO {table_choice} ({', '.join(valid_spalten)}) VALUES ({placeholders})")
                         result = conn.execute(query, {col: inputs[col] for col in valid_spalten})
+                        publish_change(table_choice, result.lastrowid, ACTION_INSERT, conn=conn)
 
                         # Wenn es sich um ein Ticket handelt, automatische Beziehungen erstellen
                         if table_choice == "ticket":
@@ -342,8 +372,10 @@ def show_insert_tab(engine, inspector):
                             ID_Mitarbeiter = inputs.get("ID_Mitarbeiter")
 
                             # Standard-Kategorie (ID 1) verwenden
-                            create_ticket_relations(ticket_id, ID_Mitarbeiter, 1)
+                            create_ticket_relations(ticket_id, ID_Mitarbeiter, 1, conn=conn)
 
+                    if table_choice in ("ticket", "status"):
+                        invalidate_status_counts()
                     st.success(f"✅ Datensatz in '{table_choice}' eingefügt!")
                 except Exception as e:
                     st.error("❌ Fehler beim Einfügen:")
@@ -389,6 +421,7 @@ def show_insert_tab(engine, inspector):
                     try:
                         success_count = 0
                         error_count = 0
+                        ticket_relations = []
 
                         with engine.begin() as conn:
                             for _, row in edited_df.iterrows():
@@ -422,21 +455,25 @@ def show_insert_tab(engine, inspector):
                                     placeholders = ", ".join([f":{col}" for col in valid_spalten])
                                     query = text(f"INSERT INTO {table_choice} ({', '.join(valid_spalten)}) VALUES ({placeholders})")
                                     result = conn.execute(query, values)
+                                    publish_change(table_choice, result.lastrowid, ACTION_INSERT, conn=conn)
 
-                                    # Wenn es sich um ein Ticket handelt, automatische Beziehungen erstellen
+                                    # Wenn es sich um ein Ticket handelt, Beziehungen für das Sammel-Insert merken
                                     if table_choice == "ticket":
-                                        ticket_id = result.lastrowid
-                                        ID_Mitarbeiter = values.get("ID_Mitarbeiter")
-
                                         # Standard-Kategorie (ID 1) verwenden
-                                        create_ticket_relations(ticket_id, ID_Mitarbeiter, 1)
+                                        ticket_relations.append((result.lastrowid, values.get("ID_Mitarbeiter"), 1))
 
                                     success_count += 1
                                 except Exception as e:
                                     error_count += 1
                                     st.error(f"Fehler beim Einfügen von Zeile {_+1}: {str(e)}")
 
+                            # Alle Ticket-Beziehungen mit je einem Statement anlegen
+                            if ticket_relations:
+                                create_ticket_relations_bulk(ticket_relations, conn=conn)
+
                         if success_count > 0:
+                            if table_choice in ("ticket", "status"):
+                                invalidate_status_counts()
                             st.success(f"✅ {success_count} Datensätze erfolgreich eingefügt!")
                             # Leeren DataFrame für neue Eingaben erstellen
                             empty_df = pd.DataFrame(columns=spalten)
@@ -478,16 +515,22 @@ def show_delete_tab(engine, inspector):
         return
 
     # Auswahl der Tabelle und des Datensatzes
-    table_names = inspector.get_table_names()
+    table_names = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
     table_choice = st.selectbox("Tabelle wählen (Löschen)", table_names, key="delete_table_select")
 
     if st.button("Daten zum Löschen laden", key="load_delete_data"):
         st.session_state.delete_df = pd.read_sql(f"SELECT * FROM {table_choice}", con=engine)
+        st.session_state.delete_df_version = get_change_version(table_choice)
         st.session_state.delete_table = table_choice
         st.session_state.delete_state = "select_id"
         st.rerun()
 
     if st.session_state.get("delete_state") in ["select_id", "confirm"]:
+        # Geladene Daten verwerfen, sobald die Tabelle anderweitig geändert wurde
+        delete_table = st.session_state.delete_table
+        if st.session_state.get("delete_df_version") != get_change_version(delete_table):
+            st.session_state.delete_df = pd.read_sql(f"SELECT * FROM {delete_table}", con=engine)
+            st.session_state.delete_df_version = get_change_version(delete_table)
         df = st.session_state.get("delete_df", pd.DataFrame())
         if df.empty:
             st.info("Bitte zuerst Daten laden.")
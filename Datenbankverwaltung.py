@@ -3,6 +3,7 @@ import pandas as pd
 from sqlalchemy import create_engine, text, inspect
 from datetime import datetime
 import pymysql
+from TicketMailboxes import HIDDEN_TABLES
 
 # Seitenkonfiguration
 st.set_page_config(page_title="Datenbankverwaltung", page_icon="🎫", layout="wide")
@@ -36,7 +37,7 @@ def main():
         st.write(f"**Verbunden mit:** {DB_NAME} auf {DB_HOST}")
 
         # Tabellen anzeigen
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         with st.expander("Verfügbare Tabellen"):
             for table in tabellen:
                 st.write(f"- {table}")
@@ -69,7 +70,7 @@ def get_columns(table):
 with tab1:
     st.subheader("Tabelle anzeigen")
     try:
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         table_choice = st.selectbox("Wähle eine Tabelle", tabellen)
         if st.button("🔄 Daten laden"):
             df = pd.read_sql(f"SELECT * FROM {table_choice}", con=engine)
@@ -84,7 +85,7 @@ with tab1:
 with tab2:
     st.subheader("Datensätze bearbeiten")
     try:
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         table_choice_edit = st.selectbox("Tabelle wählen (Bearbeiten)", tabellen, key="edit_table")
 
         spalten_edit = get_columns(table_choice_edit)
@@ -203,7 +204,7 @@ with tab2:
 with tab3:
     st.subheader("Datensatz einfügen")
     try:
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         table_choice = st.selectbox("Tabelle wählen (Einfügen)", tabellen, key="insert_table")
         spalten = get_columns(table_choice)
 
@@ -242,7 +243,7 @@ with tab3:
 with tab4:
     st.subheader("Datensatz löschen")
     try:
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         table_choice_delete = st.selectbox("Tabelle wählen (Löschen)", tabellen, key="delete_table")
         spalten_delete = get_columns(table_choice_delete)
 
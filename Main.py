@@ -1,10 +1,19 @@
 import streamlit as st
 from sqlalchemy import create_engine, text, inspect
 from Authorisation import (show_password_reset_page, show_password_change_page, show_login_page)
-from Ticket import (get_columns)
+from Ticket import (get_columns, ensure_relation_constraints)
 from Datenbanken import (show_database_management)
 import pandas as pd
 from TicketShow import show_ticket_system
+from TicketDashboard import start_precompute_worker
+from TicketCounts import ensure_status_index, format_status_counts
+from TicketHistory import ensure_history_index
+from TicketTimeline import ensure_timeline_indexes
+from TicketArchive import ensure_archive_table
+from TicketSnapshot import ensure_snapshot_table
+from TicketChanges import ensure_change_event_table, sync_change_feed
+from TicketMailIngest import ensure_mail_tables, get_ingest_scheduler
+from TicketMailboxes import HIDDEN_TABLES
 from fpdf import FPDF
 from io import BytesIO
 
@@ -62,7 +71,7 @@ def export_section(engine):
     st.subheader("📤 Daten exportieren")
 
     # Tabellenname wählen
-    tabellen = inspector.get_table_names()
+    tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
     table_name = st.selectbox("Tabelle auswählen", tabellen)
 
     if st.button("Daten laden"):
@@ -132,18 +141,65 @@ def ensure_required_columns_exist():
             with engine.begin() as conn:
                 conn.execute(text("ALTER TABLE mitarbeiter ADD COLUMN password_change_required BOOLEAN DEFAULT FALSE"))
 
+        # Versions-Spalte für optimistische Sperren auf Tickets hinzufügen, falls nicht vorhanden
+        ticket_columns = get_columns("ticket")
+        if "version" not in ticket_columns:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE ticket ADD COLUMN version INT NOT NULL DEFAULT 0"))
+
+        # Kodierungs-Spalte für delta-kodierte Historien-Einträge hinzufügen, falls nicht vorhanden
+        for historie_table in ("ticket_historie", "ticket_historie_archiv"):
+            historie_columns = get_columns(historie_table)
+            if historie_columns and "Kodierung" not in historie_columns:
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {historie_table} ADD COLUMN Kodierung VARCHAR(16) NULL"))
+
+        # Neue Spalten sind sonst für den Inspector (und get_columns) nicht sichtbar
+        inspector.clear_cache()
         return True
     except Exception as e:
         st.error(f"Fehler beim Überprüfen/Hinzufügen der erforderlichen Spalten: {str(e)}")
         return False
 
+@st.cache_resource
+def ensure_schema():
+    """
+    Bringt Spalten, Schlüssel, Indizes und Hilfstabellen einmal pro Server-Prozess
+    auf den aktuellen Stand (nicht bei jedem Rerun).
+
+    Returns:
+        bool: True, wenn alle Schritte erfolgreich waren
+    """
+    ok = ensure_required_columns_exist()
+    ensure_relation_constraints()
+    results = [
+        ensure_status_index(),
+        ensure_history_index(),
+        ensure_timeline_indexes(),
+        ensure_archive_table(),
+        ensure_snapshot_table(),
+        ensure_change_event_table(),
+        ensure_mail_tables(),
+    ]
+    return bool(ok) and all(result is not False for result in results)
+
 # Hauptfunktion
 def main():
     # Seitenkonfiguration
     st.set_page_config(page_title="Ticketsystem mit Datenbankverwaltung", page_icon="🎫", layout="wide")
 
-    # Sicherstellen, dass die erforderlichen Spalten existieren
-    ensure_required_columns_exist()
+    # Sicherstellen, dass die erforderlichen Spalten existieren; nach einem Fehler beim nächsten Rerun erneut versuchen
+    if not ensure_schema():
+        ensure_schema.clear()
+
+    # Hintergrund-Vorberechnung für Statistiken und Kanban (einmal pro Server-Prozess)
+    start_precompute_worker()
+
+    # E-Mail-Eingang für alle registrierten Postfächer (einmal pro Server-Prozess)
+    get_ingest_scheduler()
+
+    # Änderungen seit dem letzten Lauf übernehmen und betroffene Caches verwerfen
+    sync_change_feed()
 
     # Session-State initialisieren
     if "logged_in" not in st.session_state:
@@ -171,7 +227,7 @@ def main():
         st.write(f"**Verbunden mit:** {DB_NAME} auf {DB_HOST}")
 
         # Tabellen anzeigen
-        tabellen = inspector.get_table_names()
+        tabellen = [table for table in inspector.get_table_names() if table not in HIDDEN_TABLES]
         with st.expander("Verfügbare Tabellen"):
             for table in tabellen:
                 st.write(f"- {table}")
@@ -195,6 +251,12 @@ def show_main_application():
         st.write(f"Angemeldet als: **{st.session_state.username}**")
         st.write(f"Rolle: **{st.session_state.user_role}**")
 
+        # Ticket-Anzahl je Status aus dem Zähler-Cache
+        try:
+            st.caption(format_status_counts())
+        except Exception as e:
+            st.caption(f"Status-Zähler nicht verfügbar: {str(e)}")
+
 
     # Abmelden-Button
         if st.button("Abmelden"):
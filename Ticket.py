@@ -1,40 +1,94 @@
 import streamlit as st
 from sqlalchemy import text
 import time
+from TicketHistory import make_history_record, insert_history_records, write_history
+from TicketSnapshot import maybe_take_snapshot
+from TicketChanges import ACTION_DELETE, publish_change
 
-def create_ticket_relations(ticket_id, ID_Mitarbeiter, kategorie_id=1):
+class TicketConflictError(Exception):
+    """Das Ticket wurde seit dem Laden von jemand anderem geändert."""
+
+    def __init__(self, ticket_id):
+        super().__init__(f"Ticket #{ticket_id} wurde zwischenzeitlich von einem anderen Benutzer geändert.")
+        self.ticket_id = ticket_id
+
+# Eindeutige Schlüssel, damit Zuordnungen per INSERT IGNORE idempotent angelegt werden
+RELATION_UNIQUE_KEYS = {
+    "ticket_mitarbeiter": ("uq_ticket_mitarbeiter", ("ID_Ticket", "ID_Mitarbeiter")),
+    "ticket_kategorie": ("uq_ticket_kategorie", ("ID_Ticket", "ID_Kategorie")),
+}
+
+def ensure_relation_constraints():
+    """Legt die eindeutigen Schlüssel auf den Zuordnungstabellen an, falls sie fehlen."""
+    from Main import engine, inspector
+
+    for table, (name, columns) in RELATION_UNIQUE_KEYS.items():
+        try:
+            existing = inspector.get_unique_constraints(table) + [idx for idx in inspector.get_indexes(table) if idx.get("unique")]
+            if any(tuple(entry["column_names"]) == columns for entry in existing):
+                continue
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({', '.join(columns)})"))
+            inspector.clear_cache()
+        except Exception as e:
+            # z.B. bereits vorhandene doppelte Zuordnungen
+            print(f"FEHLER: Eindeutiger Schlüssel auf {table} konnte nicht angelegt werden: {str(e)}")
+
+def create_ticket_relations_bulk(relations, conn=None):
+    """
+    Legt Mitarbeiter- und Kategorie-Zuordnungen für viele Tickets mit je einem Statement an.
+    Bereits vorhandene Zuordnungen werden über die eindeutigen Schlüssel ignoriert,
+    nicht existierende Kategorien über den JOIN übersprungen.
+
+    Args:
+        relations: Liste von Tupeln (ticket_id, ID_Mitarbeiter, kategorie_id); None-Werte werden übersprungen
+        conn: Offene Verbindung des Aufrufers oder None für eine eigene Transaktion
+    """
     from Main import engine
-    try:
-        with engine.begin() as conn:
-            # Eintrag in ticket_mitarbeiter
-            if ID_Mitarbeiter:
-                # Prüfen, ob der Eintrag bereits existiert
-                check_query = text("SELECT COUNT(*) FROM ticket_mitarbeiter WHERE ID_Ticket = :ticket_id AND ID_Mitarbeiter = :ID_Mitarbeiter")
-                result = conn.execute(check_query, {"ticket_id": ticket_id, "ID_Mitarbeiter": ID_Mitarbeiter}).scalar()
-
-                if result == 0:  # Eintrag existiert noch nicht
-                    insert_query = text("INSERT INTO ticket_mitarbeiter (ID_Ticket, ID_Mitarbeiter, Rolle_im_Ticket) VALUES (:ticket_id, :ID_Mitarbeiter, 'Hauptverantwortlicher')")
-                    conn.execute(insert_query, {"ticket_id": ticket_id, "ID_Mitarbeiter": ID_Mitarbeiter})
-
-            # Eintrag in ticket_kategorie
-            if kategorie_id:
-                # Prüfen, ob die Kategorie existiert
-                check_kategorie = text("SELECT COUNT(*) FROM kategorie WHERE ID_Kategorie = :kategorie_id")
-                kategorie_exists = conn.execute(check_kategorie, {"kategorie_id": kategorie_id}).scalar()
-
-                if kategorie_exists > 0:
-                    # Prüfen, ob der Eintrag bereits existiert
-                    check_query = text("SELECT COUNT(*) FROM ticket_kategorie WHERE ID_Ticket = :ticket_id AND ID_Kategorie = :kategorie_id")
-                    result = conn.execute(check_query, {"ticket_id": ticket_id, "kategorie_id": kategorie_id}).scalar()
-
-                    if result == 0:  # Eintrag existiert noch nicht
-                        insert_query = text("INSERT INTO ticket_kategorie (ID_Ticket, ID_Kategorie) VALUES (:ticket_id, :kategorie_id)")
-                        conn.execute(insert_query, {"ticket_id": ticket_id, "kategorie_id": kategorie_id})
-
-        return True
-    except Exception as e:
-        st.error(f"Fehler beim Erstellen der Ticket-Beziehungen: {str(e)}")
-        return False
+
+    if conn is None:
+        try:
+            with engine.begin() as own_conn:
+                return create_ticket_relations_bulk(relations, own_conn)
+        except Exception as e:
+            st.error(f"Fehler beim Erstellen der Ticket-Beziehungen: {str(e)}")
+            return False
+
+    # Eintrag in ticket_mitarbeiter
+    mitarbeiter_rows = [(ticket_id, mitarbeiter_id) for ticket_id, mitarbeiter_id, _ in relations if mitarbeiter_id]
+    if mitarbeiter_rows:
+        params = {}
+        values = []
+        for i, (ticket_id, mitarbeiter_id) in enumerate(mitarbeiter_rows):
+            values.append(f"(:ticket_id_{i}, :mitarbeiter_id_{i}, 'Hauptverantwortlicher')")
+            params[f"ticket_id_{i}"] = ticket_id
+            params[f"mitarbeiter_id_{i}"] = mitarbeiter_id
+        conn.execute(text(f"""
+            INSERT IGNORE INTO ticket_mitarbeiter (ID_Ticket, ID_Mitarbeiter, Rolle_im_Ticket)
+            VALUES {", ".join(values)}
+        """), params)
+
+    # Eintrag in ticket_kategorie, nur für existierende Kategorien
+    kategorie_rows = [(ticket_id, kategorie_id) for ticket_id, _, kategorie_id in relations if kategorie_id]
+    if kategorie_rows:
+        params = {}
+        selects = []
+        for i, (ticket_id, kategorie_id) in enumerate(kategorie_rows):
+            selects.append(f"SELECT :ticket_id_{i} AS ID_Ticket, :kategorie_id_{i} AS ID_Kategorie")
+            params[f"ticket_id_{i}"] = ticket_id
+            params[f"kategorie_id_{i}"] = kategorie_id
+        conn.execute(text(f"""
+            INSERT IGNORE INTO ticket_kategorie (ID_Ticket, ID_Kategorie)
+            SELECT v.ID_Ticket, k.ID_Kategorie
+            FROM ({" UNION ALL ".join(selects)}) v
+            JOIN kategorie k ON k.ID_Kategorie = v.ID_Kategorie
+        """), params)
+
+    return True
+
+def create_ticket_relations(ticket_id, ID_Mitarbeiter, kategorie_id=1, conn=None):
+    """Legt die Zuordnungen für ein einzelnes Ticket an, bei Bedarf in der Transaktion des Aufrufers."""
+    return create_ticket_relations_bulk([(ticket_id, ID_Mitarbeiter, kategorie_id)], conn)
 
 # Diese Funktion fügt einen Lösch-Button zum Ticket-Details-Bereich hinzu
 def add_ticket_delete_button(ticket_id):
@@ -74,6 +128,9 @@ def add_ticket_delete_button(ticket_id):
                     result = conn.execute(delete_query, {"ticket_id": ticket_id})
 
                     if result.rowcount > 0:
+                        publish_change("ticket", ticket_id, ACTION_DELETE, conn=conn)
+                        from TicketCounts import invalidate_status_counts
+                        invalidate_status_counts()
                         st.success(f"✅ Ticket #{ticket_id} wurde erfolgreich gelöscht!")
 
                         # Session-State zurücksetzen
@@ -114,47 +171,112 @@ def get_columns(table):
 
 #Hilfsfunktion Historie
 def log_ticket_change(ticket_id, feldname, alter_wert, neuer_wert, mitarbeiter_id):
+    """
+    Protokolliert eine Feldänderung. Im Standardmodus wird der Eintrag nur in die
+    Warteschlange des Historien-Schreibers gestellt und blockiert die UI nicht.
+    """
+    record = make_history_record(ticket_id, feldname, alter_wert, neuer_wert, mitarbeiter_id)
+    if record is None:
+        return  # Nur Änderungen speichern
+
+    write_history(record)
+    return True
+
+# Hilfsfunktion: Mehrere Historien-Einträge mit einem einzigen INSERT schreiben
+def insert_history_rows(conn, ticket_id, changes, mitarbeiter_id):
+    """
+    Schreibt alle Änderungen als mehrzeiliges INSERT in ticket_historie.
+    Nutzt die übergebene Verbindung, läuft also in der Transaktion des Aufrufers.
+
+    Args:
+        conn: Offene Verbindung innerhalb einer Transaktion
+        ticket_id: ID des geänderten Tickets
+        changes: Liste von Dictionaries mit "display", "old" und "new"
+        mitarbeiter_id: ID des ändernden Mitarbeiters
+    """
+    records = []
+    for change in changes:
+        record = make_history_record(ticket_id, change["display"], change["old"], change["new"], mitarbeiter_id)
+        if record is not None:
+            records.append(record)
+
+    return insert_history_records(conn, records)
+
+# Ticket aktualisieren: Ticket, Kategorie und Historie in einer kurzen Transaktion
+def update_ticket_with_history(ticket_id, values, changes, mitarbeiter_id, expected_version, kategorie_id=None):
+    """
+    Aktualisiert ein Ticket inklusive Kategorie-Zuordnung und Historie atomar.
+    Die Versionsprüfung im WHERE schlägt sofort fehl, statt auf Zeilensperren zu warten,
+    wenn das Ticket seit dem Laden geändert wurde (TicketConflictError).
 
+    Args:
+        ticket_id: ID des Tickets
+        values: Dictionary mit titel, beschreibung, prioritaet, status, mitarbeiter, kunde
+        changes: Liste der Änderungen für die Historie
+        mitarbeiter_id: ID des ändernden Mitarbeiters
+        expected_version: Version des Tickets beim Laden
+        kategorie_id: Neue Kategorie oder None, wenn die Kategorie unverändert bleibt
+    """
     from Main import engine
 
-    # Typkonvertierung für den Vergleich
-    alter_wert_str = str(alter_wert) if alter_wert is not None else ""
-    neuer_wert_str = str(neuer_wert) if neuer_wert is not None else ""
+    update_query = text("""
+        UPDATE ticket
+        SET Titel = :titel,
+            Beschreibung = :beschreibung,
+            Priorität = :prioritaet,
+            ID_Status = :status,
+            ID_Mitarbeiter = :mitarbeiter,
+            ID_Kunde = :kunde,
+            Geändert_am = NOW(),
+            version = version + 1
+        WHERE ID_Ticket = :ticket_id AND version = :version
+    """)
 
-    # Nur speichern, wenn sich die Werte tatsächlich unterscheiden
-    if alter_wert_str.strip() == neuer_wert_str.strip():
-        return  # Nur Änderungen speichern
+    with engine.begin() as conn:
+        result = conn.execute(update_query, {**values, "ticket_id": ticket_id, "version": expected_version})
+        if result.rowcount == 0:
+            raise TicketConflictError(ticket_id)
 
-    # Kürzere Transaktion mit Wiederholungslogik
-    max_retries = 3
-    retry_count = 0
+        # Kategorie aktualisieren
+        if kategorie_id is not None:
+            conn.execute(text("DELETE FROM ticket_kategorie WHERE ID_Ticket = :ticket_id"), {"ticket_id": ticket_id})
+            conn.execute(text("""
+                INSERT INTO ticket_kategorie (ID_Ticket, ID_Kategorie)
+                VALUES (:ticket_id, :kategorie_id)
+            """), {"ticket_id": ticket_id, "kategorie_id": kategorie_id})
 
-    while retry_count < max_retries:
-        try:
-            insert_query = text("""
-                INSERT INTO ticket_historie (ID_Ticket, Feldname, Alter_Wert, Neuer_Wert, Geändert_von, Geändert_am)
-                VALUES (:ticket_id, :feldname, :alter_wert, :neuer_wert, :geändert_von, NOW())
-            """)
+        # Alle Historien-Einträge mit einem Statement
+        insert_history_rows(conn, ticket_id, changes, mitarbeiter_id)
+        maybe_take_snapshot(conn, ticket_id)
+        publish_change("ticket", ticket_id, conn=conn)
 
-            with engine.begin() as conn:
-                conn.execute(insert_query, {
-                    "ticket_id": ticket_id,
-                    "feldname": feldname,
-                    "alter_wert": alter_wert_str,
-                    "neuer_wert": neuer_wert_str,
-                    "geändert_von": mitarbeiter_id
-                })
+    return expected_version + 1
 
-            # Wenn erfolgreich, Schleife beenden
-            return True
+# Ticket-Status ändern (z.B. Kanban), ebenfalls mit Versionsprüfung
+def move_ticket_status(ticket_id, new_status_id, expected_version, old_status_id=None, mitarbeiter_id=None):
+    """
+    Setzt den Status eines Tickets, sofern es seit dem Laden nicht geändert wurde.
+    Wirft TicketConflictError bei einem Konflikt. Mit mitarbeiter_id wird der
+    Wechsel in derselben Transaktion in der Historie protokolliert.
+    """
+    from Main import engine
 
-        except Exception as e:
-            # Nur bei Lock-Timeout-Fehlern wiederholen
-            if "Lock wait timeout exceeded" in str(e) and retry_count < max_retries - 1:
-                retry_count += 1
-                time.sleep(0.5)  # Kurze Pause vor dem nächsten Versuch
-            else:
-                # Bei anderen Fehlern oder zu vielen Versuchen, Fehler protokollieren
-                print(f"FEHLER: Historien-Eintrag konnte nicht gespeichert werden: {str(e)}")
-                # Fehler weitergeben
-                raise
+    with engine.begin() as conn:
+        result = conn.execute(text("""
+            UPDATE ticket
+            SET ID_Status = :status_id, Geändert_am = NOW(), version = version + 1
+            WHERE ID_Ticket = :ticket_id AND version = :version
+        """), {
+            "status_id": new_status_id,
+            "ticket_id": ticket_id,
+            "version": expected_version
+        })
+        if result.rowcount == 0:
+            raise TicketConflictError(ticket_id)
+
+        if mitarbeiter_id is not None:
+            insert_history_rows(conn, ticket_id, [{"display": "Status", "old": old_status_id, "new": new_status_id}], mitarbeiter_id)
+            maybe_take_snapshot(conn, ticket_id)
+        publish_change("ticket", ticket_id, conn=conn)
+
+    return expected_version + 1
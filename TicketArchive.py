@@ -0,0 +1,110 @@
+from sqlalchemy import text
+
+# ==============================================================================
+# ARCHIVIERUNG DER TICKET-HISTORIE
+# ==============================================================================
+# Historien-Einträge geschlossener Tickets, die älter als ARCHIVE_MIN_AGE_DAYS
+# sind, werden in ticket_historie_archiv verschoben. Jeder Stapel wird in einer
+# eigenen Transaktion kopiert und gelöscht; ein abgebrochener Lauf kann daher
+# jederzeit einfach erneut gestartet werden. So bleibt ticket_historie klein.
+
+ARCHIVE_TABLE = "ticket_historie_archiv"
+
+# Status, die als abgeschlossen gelten (Vergleich ohne Beachtung der Groß-/Kleinschreibung)
+ARCHIVE_CLOSED_STATUS_NAMES = ("Erledigt", "Geschlossen")
+ARCHIVE_MIN_AGE_DAYS = 180
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def ensure_archive_table(compressed=False):
+    """
+    Legt die Archivtabelle mit derselben Struktur wie ticket_historie an.
+    Mit compressed=True wird sie auf ROW_FORMAT=COMPRESSED umgestellt.
+    """
+    from Main import engine
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} LIKE ticket_historie"))
+            if compressed:
+                conn.execute(text(f"ALTER TABLE {ARCHIVE_TABLE} ROW_FORMAT=COMPRESSED"))
+        return True
+    except Exception as e:
+        print(f"FEHLER: Archivtabelle konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def _closed_status_params():
+    names = {f"closed_{i}": name for i, name in enumerate(ARCHIVE_CLOSED_STATUS_NAMES)}
+    placeholders = ", ".join(f":{key}" for key in names)
+    return placeholders, names
+
+
+def count_archivable_rows(engine, min_age_days=ARCHIVE_MIN_AGE_DAYS):
+    """Zählt die Historien-Einträge, die archiviert werden können."""
+    placeholders, params = _closed_status_params()
+    query = text(f"""
+        SELECT COUNT(*)
+        FROM ticket_historie th
+        JOIN ticket t ON th.ID_Ticket = t.ID_Ticket
+        JOIN status s ON t.ID_Status = s.ID_Status
+        WHERE s.Name IN ({placeholders})
+          AND th.Geändert_am < NOW() - INTERVAL :min_age_days DAY
+    """)
+    with engine.connect() as conn:
+        return conn.execute(query, {**params, "min_age_days": min_age_days}).scalar()
+
+
+def archive_history_batch(engine, min_age_days=ARCHIVE_MIN_AGE_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Verschiebt einen Stapel archivierbarer Einträge in einer Transaktion.
+    Gibt die Anzahl verschobener Einträge zurück (0 = nichts mehr zu tun).
+    """
+    placeholders, params = _closed_status_params()
+
+    with engine.begin() as conn:
+        ids = conn.execute(text(f"""
+            SELECT th.ID_Historie
+            FROM ticket_historie th
+            JOIN ticket t ON th.ID_Ticket = t.ID_Ticket
+            JOIN status s ON t.ID_Status = s.ID_Status
+            WHERE s.Name IN ({placeholders})
+              AND th.Geändert_am < NOW() - INTERVAL :min_age_days DAY
+            ORDER BY th.ID_Historie
+            LIMIT :batch_size
+            FOR UPDATE
+        """), {**params, "min_age_days": min_age_days, "batch_size": batch_size}).scalars().all()
+
+        if not ids:
+            return 0
+
+        id_params = {f"id_{i}": id_value for i, id_value in enumerate(ids)}
+        id_list = ", ".join(f":{key}" for key in id_params)
+
+        # INSERT IGNORE macht einen wiederholten Stapel nach einem Abbruch unschädlich
+        conn.execute(text(f"""
+            INSERT IGNORE INTO {ARCHIVE_TABLE}
+            SELECT * FROM ticket_historie WHERE ID_Historie IN ({id_list})
+        """), id_params)
+        conn.execute(text(f"DELETE FROM ticket_historie WHERE ID_Historie IN ({id_list})"), id_params)
+
+    return len(ids)
+
+
+def run_history_archival(engine, min_age_days=ARCHIVE_MIN_AGE_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                         max_batches=None, on_progress=None):
+    """
+    Archiviert stapelweise, bis nichts mehr übrig ist oder max_batches erreicht ist.
+    on_progress(verschoben_gesamt) wird nach jedem Stapel aufgerufen.
+    """
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        moved = archive_history_batch(engine, min_age_days, batch_size)
+        if moved == 0:
+            break
+        total += moved
+        batches += 1
+        if on_progress:
+            on_progress(total)
+    return total
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from PIL import Image
+from sqlalchemy import text
+
+# ==============================================================================
+# DATEIABLAGE FÜR E-MAIL-ANHÄNGE
+# ==============================================================================
+# Anhänge werden beim Abruf in eine inhaltsadressierte Ablage auf der
+# Festplatte geschrieben (Dateiname = SHA-256 des Inhalts) und über ticket_anhang
+# mit dem Ticket verknüpft. Gleiche Dateien liegen dadurch nur einmal auf der
+# Platte; in Datenbank und Session State stehen nur Name, Größe und Hash.
+# Anhänge großer Nachrichten lädt TicketMailParts in Teilbereichen vom Server und
+# gibt sie direkt an store_stream weiter; kleine Nachrichten (bis MAX_MESSAGE_SIZE
+# in TicketMailSync) liegen beim Abruf ohnehin vollständig im Speicher.
+# Vorschaubilder und Downloads werden erst beim Anzeigen von der Platte gelesen.
+
+ATTACHMENT_TABLE = "ticket_anhang"
+ATTACHMENT_DIR = Path(os.environ.get("TICKET_ATTACHMENT_DIR", Path(__file__).resolve().parent / "anhaenge"))
+
+MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024
+MAX_ATTACHMENTS_PER_MESSAGE = 20
+CHUNK_SIZE = 64 * 1024
+
+THUMBNAIL_SIZE = (240, 240)
+THUMBNAIL_TYPES = ("image/png", "image/jpeg", "image/gif", "image/bmp", "image/webp")
+
+
+def ensure_attachment_table():
+    """Legt die Tabelle für die Anhang-Verknüpfungen an, falls sie fehlt."""
+    from Main import engine
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {ATTACHMENT_TABLE} (
+                    ID_Anhang INT AUTO_INCREMENT PRIMARY KEY,
+                    ID_Ticket INT NOT NULL,
+                    Dateiname VARCHAR(255) NOT NULL,
+                    Content_Type VARCHAR(127) NULL,
+                    Groesse BIGINT NOT NULL,
+                    Hash CHAR(64) NOT NULL,
+                    Erstellt_am DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE KEY uq_anhang_ticket_datei (ID_Ticket, Hash, Dateiname)
+                )
+            """))
+        return True
+    except Exception as e:
+        print(f"FEHLER: Tabelle {ATTACHMENT_TABLE} konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def blob_path(content_hash):
+    """Pfad einer abgelegten Datei; zwei Verzeichnisebenen halten die Ordner klein."""
+    return ATTACHMENT_DIR / content_hash[:2] / content_hash
+
+
+def store_stream(chunks, max_size=MAX_ATTACHMENT_SIZE):
+    """
+    Schreibt die Datenstücke in die Ablage und berechnet dabei den Hash.
+
+    Returns:
+        (Hash, Größe) oder None, wenn max_size überschritten wurde
+    """
+    tmp_dir = ATTACHMENT_DIR / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, tmp_name = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    return None
+                digest.update(chunk)
+                tmp_file.write(chunk)
+
+        content_hash = digest.hexdigest()
+        target = blob_path(content_hash)
+        if not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_name, target)
+        return content_hash, size
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+def store_message_attachments(msg, max_size=MAX_ATTACHMENT_SIZE, max_count=MAX_ATTACHMENTS_PER_MESSAGE):
+    """
+    Legt die Anhänge einer vollständig geladenen imap_tools-Nachricht ab und gibt ihre
+    Beschreibungen (Dateiname, Content_Type, Größe, Hash) zurück. Zu große Anhänge werden
+    übersprungen. Für große Nachrichten siehe TicketMailParts.store_part_attachments.
+    """
+    refs = []
+    for att in msg.attachments[:max_count]:
+        payload = memoryview(att.payload)
+        if len(payload) > max_size:
+            print(f"FEHLER: Anhang '{att.filename}' ({len(payload) // 1024} KB) überschreitet die Größengrenze")
+            continue
+        stored = store_stream(payload[i:i + CHUNK_SIZE] for i in range(0, len(payload), CHUNK_SIZE))
+        if stored is None:
+            continue
+        content_hash, size = stored
+        refs.append({
+            "Dateiname": (att.filename or "anhang")[:255],
+            "Content_Type": att.content_type,
+            "Größe": size,
+            "Hash": content_hash,
+        })
+    return refs
+
+
+def store_text_attachment(content, filename, content_type="text/plain"):
+    """Legt einen Text (z.B. die Originalnachricht) als Anhang ab; None bei Überschreitung der Größengrenze."""
+    data = memoryview(content.encode("utf-8"))
+    stored = store_stream(data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE))
+    if stored is None:
+        return None
+    content_hash, size = stored
+    return {"Dateiname": filename, "Content_Type": content_type, "Größe": size, "Hash": content_hash}
+
+
+def link_attachments(conn, ticket_id, refs):
+    """Verknüpft abgelegte Anhänge in der Transaktion des Aufrufers mit einem Ticket."""
+    if not refs:
+        return
+    conn.execute(text(f"""
+        INSERT IGNORE INTO {ATTACHMENT_TABLE} (ID_Ticket, Dateiname, Content_Type, Groesse, Hash)
+        VALUES (:ticket_id, :dateiname, :content_type, :groesse, :hash)
+    """), [{
+        "ticket_id": ticket_id,
+        "dateiname": ref["Dateiname"],
+        "content_type": ref["Content_Type"],
+        "groesse": ref["Größe"],
+        "hash": ref["Hash"],
+    } for ref in refs])
+
+
+def load_ticket_attachments(engine, ticket_id):
+    """Lädt die Beschreibungen der Anhänge eines Tickets, ohne Dateiinhalte."""
+    with engine.connect() as conn:
+        return conn.execute(text(f"""
+            SELECT ID_Anhang, Dateiname, Content_Type, Groesse, Hash
+            FROM {ATTACHMENT_TABLE}
+            WHERE ID_Ticket = :ticket_id
+            ORDER BY ID_Anhang
+        """), {"ticket_id": ticket_id}).fetchall()
+
+
+def open_attachment(content_hash):
+    """Öffnet eine abgelegte Datei zum Lesen oder gibt None zurück, wenn sie fehlt."""
+    path = blob_path(content_hash)
+    return open(path, "rb") if path.exists() else None
+
+
+def get_thumbnail(content_hash, content_type):
+    """
+    Gibt den Pfad eines Vorschaubilds zurück und erzeugt es beim ersten Aufruf.
+    None für Dateien, die keine Bilder sind oder nicht gelesen werden können.
+    """
+    if content_type not in THUMBNAIL_TYPES:
+        return None
+
+    thumb = ATTACHMENT_DIR / "thumbs" / f"{content_hash}.png"
+    if thumb.exists():
+        return thumb
+
+    source = blob_path(content_hash)
+    if not source.exists():
+        return None
+    try:
+        thumb.parent.mkdir(parents=True, exist_ok=True)
+        with Image.open(source) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            image.save(thumb, "PNG")
+        return thumb
+    except Exception as e:
+        print(f"FEHLER: Vorschaubild für {content_hash} konnte nicht erzeugt werden: {str(e)}")
+        return None
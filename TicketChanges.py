@@ -0,0 +1,209 @@
+import threading
+import time
+import uuid
+from datetime import timedelta
+from sqlalchemy import text
+
+# ==============================================================================
+# ÄNDERUNGS-FEED FÜR DIE CACHE-INVALIDIERUNG
+# ==============================================================================
+# Jeder Schreibpfad hängt ein Ereignis (Tabelle, ID, Aktion) an change_event an.
+# Zu Beginn jedes Seitenlaufs liest sync_change_feed() die neuen Ereignisse mit
+# einer einzigen Abfrage über den Primärschlüssel und benachrichtigt die
+# registrierten Caches. So werden Caches aller Prozesse genau dann verworfen,
+# wenn sich ihre Daten geändert haben, statt nach einer geschätzten Lebensdauer.
+# Im Modus "local" (ein einziger Server-Prozess) wird die Tabelle nicht benutzt
+# und direkt im Prozess benachrichtigt.
+
+CHANGE_EVENT_TABLE = "change_event"
+CHANGE_FEED_MODE = "db"
+
+# Höchstens so viele Ereignisse pro Abfrage; der Rest folgt beim nächsten Lauf
+CHANGE_FEED_BATCH_SIZE = 1000
+
+# IDs werden beim Insert vergeben, sichtbar werden die Ereignisse aber erst mit dem
+# Commit. Ein Ereignis aus einer langen Transaktion kann daher nach einem höheren
+# erscheinen. Jede Abfrage liest deshalb die letzten CHANGE_FEED_LOOKBACK IDs
+# erneut; bereits gemeldete Ereignisse werden über ihre ID übersprungen.
+CHANGE_FEED_LOOKBACK = 200
+
+# Alte Ereignisse werden regelmäßig gelöscht, damit die Tabelle nicht unbegrenzt wächst
+CHANGE_EVENT_RETENTION = timedelta(days=1)
+CHANGE_EVENT_CLEANUP_INTERVAL = 600
+CHANGE_EVENT_CLEANUP_BATCH = 10000
+
+ACTION_INSERT = "insert"
+ACTION_UPDATE = "update"
+ACTION_DELETE = "delete"
+
+# Kennung dieses Prozesses, damit eigene Ereignisse erkannt werden
+PROCESS_ID = uuid.uuid4().hex[:16]
+
+_subscribers = {}
+_versions = {}
+_version_counter = 0
+_last_event_id = None
+_seen_event_ids = set()
+_last_cleanup = None
+_feed_lock = threading.RLock()
+
+
+def ensure_change_event_table():
+    """Legt die Ereignistabelle an, falls sie fehlt."""
+    from Main import engine
+
+    if CHANGE_FEED_MODE != "db":
+        return True
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {CHANGE_EVENT_TABLE} (
+                    ID_Event BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    Entitaet VARCHAR(64) NOT NULL,
+                    ID_Objekt INT NULL,
+                    Aktion VARCHAR(16) NOT NULL,
+                    Quelle VARCHAR(32) NOT NULL,
+                    Erstellt_am DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """))
+        return True
+    except Exception as e:
+        print(f"FEHLER: Ereignistabelle konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def subscribe(entity, callback):
+    """
+    Registriert callback(event) für Änderungen an einer Tabelle.
+    event ist ein Dictionary mit id, entity, object_id, action und local
+    (True, wenn das Ereignis aus diesem Prozess stammt).
+    """
+    with _feed_lock:
+        _subscribers.setdefault(entity, []).append(callback)
+
+
+def _dispatch(event):
+    global _version_counter
+    # Eigener Zähler statt der Ereignis-ID: ein verspätetes Ereignis hat eine
+    # kleinere ID, muss die Version aber trotzdem auf einen neuen Wert setzen
+    _version_counter += 1
+    _versions[event["entity"]] = _version_counter
+    for callback in _subscribers.get(event["entity"], []):
+        try:
+            callback(event)
+        except Exception as e:
+            print(f"FEHLER: Cache-Invalidierung für '{event['entity']}' fehlgeschlagen: {str(e)}")
+
+
+def publish_change(entity, object_id=None, action=ACTION_UPDATE, conn=None):
+    """
+    Meldet eine Änderung. Mit conn wird das Ereignis in der Transaktion des
+    Aufrufers geschrieben und erst nach dem Commit sichtbar; die Caches werden
+    dann beim nächsten sync_change_feed() benachrichtigt.
+    """
+    from Main import engine
+
+    if CHANGE_FEED_MODE != "db":
+        with _feed_lock:
+            _dispatch({"id": _version_counter + 1, "entity": entity, "object_id": object_id, "action": action, "local": True})
+        return
+
+    insert_query = text(f"""
+        INSERT INTO {CHANGE_EVENT_TABLE} (Entitaet, ID_Objekt, Aktion, Quelle)
+        VALUES (:entity, :object_id, :action, :quelle)
+    """)
+    params = {"entity": entity, "object_id": object_id, "action": action, "quelle": PROCESS_ID}
+
+    if conn is not None:
+        conn.execute(insert_query, params)
+        return
+
+    with engine.begin() as own_conn:
+        own_conn.execute(insert_query, params)
+    sync_change_feed()
+
+
+def sync_change_feed():
+    """
+    Liest alle neuen Ereignisse seit dem letzten Aufruf und benachrichtigt die Caches.
+    Beim ersten Aufruf im Prozess wird nur die aktuelle Position gemerkt, da noch
+    nichts zwischengespeichert ist.
+    """
+    global _last_event_id
+    from Main import engine
+
+    if CHANGE_FEED_MODE != "db":
+        return
+
+    with _feed_lock:
+        try:
+            with engine.connect() as conn:
+                if _last_event_id is None:
+                    _last_event_id = conn.execute(text(f"SELECT COALESCE(MAX(ID_Event), 0) FROM {CHANGE_EVENT_TABLE}")).scalar()
+                    return
+
+                rows = conn.execute(text(f"""
+                    SELECT ID_Event, Entitaet, ID_Objekt, Aktion, Quelle
+                    FROM {CHANGE_EVENT_TABLE}
+                    WHERE ID_Event > :window_start
+                    ORDER BY ID_Event
+                    LIMIT :limit
+                """), {
+                    "window_start": max(0, _last_event_id - CHANGE_FEED_LOOKBACK),
+                    "limit": CHANGE_FEED_BATCH_SIZE + CHANGE_FEED_LOOKBACK
+                }).fetchall()
+        except Exception as e:
+            print(f"FEHLER: Änderungs-Feed konnte nicht gelesen werden: {str(e)}")
+            return
+
+        for row in rows:
+            if row.ID_Event in _seen_event_ids:
+                continue
+            _seen_event_ids.add(row.ID_Event)
+            _dispatch({
+                "id": row.ID_Event,
+                "entity": row.Entitaet,
+                "object_id": row.ID_Objekt,
+                "action": row.Aktion,
+                "local": row.Quelle == PROCESS_ID
+            })
+            _last_event_id = max(_last_event_id, row.ID_Event)
+
+        # Nur IDs im Nachlese-Fenster werden noch gebraucht
+        window_start = _last_event_id - CHANGE_FEED_LOOKBACK
+        _seen_event_ids.difference_update([event_id for event_id in _seen_event_ids if event_id <= window_start])
+
+    cleanup_change_events()
+
+
+def cleanup_change_events():
+    """Löscht Ereignisse, die älter als CHANGE_EVENT_RETENTION sind, höchstens alle CHANGE_EVENT_CLEANUP_INTERVAL Sekunden."""
+    global _last_cleanup
+    from Main import engine
+
+    with _feed_lock:
+        now = time.monotonic()
+        if _last_cleanup is not None and now - _last_cleanup < CHANGE_EVENT_CLEANUP_INTERVAL:
+            return
+        _last_cleanup = now
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                DELETE FROM {CHANGE_EVENT_TABLE}
+                WHERE Erstellt_am < NOW() - INTERVAL :seconds SECOND
+                ORDER BY ID_Event
+                LIMIT :limit
+            """), {"seconds": int(CHANGE_EVENT_RETENTION.total_seconds()), "limit": CHANGE_EVENT_CLEANUP_BATCH})
+    except Exception as e:
+        print(f"FEHLER: Alte Ereignisse konnten nicht gelöscht werden: {str(e)}")
+
+
+def get_change_version(*entities):
+    """
+    Gibt für jede Tabelle eine Versionsnummer zurück, die sich mit jedem Ereignis ändert.
+    Geeignet als zusätzlicher Parameter von st.cache_data-Funktionen, damit
+    der Cache genau bei einer Änderung einen neuen Eintrag anlegt.
+    """
+    with _feed_lock:
+        return tuple(_versions.get(entity, 0) for entity in entities)
@@ -0,0 +1,80 @@
+import altair as alt
+import pandas as pd
+
+# ==============================================================================
+# DATEN-BUDGET FÜR DIAGRAMME
+# ==============================================================================
+# Altair bettet den kompletten DataFrame in die Vega-Spezifikation ein, die an den
+# Browser geschickt wird. Deshalb werden die Daten hier serverseitig auf eine feste
+# Obergrenze reduziert, bevor das Diagramm gebaut wird.
+
+MAX_CHART_CATEGORIES = 12
+MAX_CHART_POINTS = 120
+OTHER_LABEL = "Sonstige"
+
+# Mögliche Zeitintervalle, vom feinsten zum gröbsten
+TIME_BIN_FREQUENCIES = ["h", "D", "W-MON", "MS", "QS", "YS"]
+
+
+def limit_categories(df, category_col, value_col="Anzahl", top_n=MAX_CHART_CATEGORIES, other_label=OTHER_LABEL):
+    """
+    Behält die größten Kategorien und fasst den Rest zu einer Zeile "Sonstige" zusammen.
+    Das Ergebnis hat höchstens top_n Zeilen.
+    """
+    if df.empty or len(df) <= top_n:
+        return df
+
+    df_sorted = df.sort_values(value_col, ascending=False)
+    top = df_sorted.head(top_n - 1)
+    rest_sum = df_sorted.iloc[top_n - 1:][value_col].sum()
+
+    other_row = pd.DataFrame([{category_col: other_label, value_col: rest_sum}])
+    return pd.concat([top[[category_col, value_col]], other_row], ignore_index=True)
+
+
+def bin_time_series(df, time_col, value_col="Anzahl", max_points=MAX_CHART_POINTS):
+    """
+    Fasst eine Zeitreihe in Intervalle zusammen, sodass höchstens max_points Punkte entstehen.
+    Gewählt wird das feinste Intervall, das in das Budget passt.
+    """
+    if df.empty:
+        return df
+
+    series = df[[time_col, value_col]].copy()
+    series[time_col] = pd.to_datetime(series[time_col])
+    series = series.set_index(time_col)[value_col]
+
+    binned = None
+    for freq in TIME_BIN_FREQUENCIES:
+        binned = series.resample(freq).sum()
+        if len(binned) <= max_points:
+            break
+
+    # Auch jährliche Intervalle sprengen das Budget: nur die jüngsten Punkte behalten
+    binned = binned.tail(max_points)
+    return binned.reset_index()
+
+
+def bar_chart(df, category_col, value_col="Anzahl", top_n=MAX_CHART_CATEGORIES, width=400, height=300):
+    """Balkendiagramm mit begrenzter Anzahl Kategorien."""
+    data = limit_categories(df, category_col, value_col, top_n=top_n)
+    return alt.Chart(data).mark_bar().encode(
+        x=alt.X(f'{category_col}:N', sort='-y'),
+        y=f'{value_col}:Q',
+        color=f'{category_col}:N'
+    ).properties(
+        width=width,
+        height=height
+    )
+
+
+def time_series_chart(df, time_col, value_col="Anzahl", max_points=MAX_CHART_POINTS, width=400, height=300):
+    """Liniendiagramm über eine serverseitig gebinnte Zeitreihe."""
+    data = bin_time_series(df, time_col, value_col, max_points=max_points)
+    return alt.Chart(data).mark_line(point=True).encode(
+        x=alt.X(f'{time_col}:T'),
+        y=f'{value_col}:Q'
+    ).properties(
+        width=width,
+        height=height
+    )
@@ -0,0 +1,115 @@
+import threading
+from sqlalchemy import text
+from TicketChanges import subscribe
+
+# ==============================================================================
+# STATUS-ZÄHLER
+# ==============================================================================
+# Die Anzahl Tickets je Status wird mit einem einzigen GROUP BY über den Index
+# auf ticket.ID_Status ermittelt und im Prozess zwischengespeichert. Alle
+# Schreibpfade, die den Status eines Tickets ändern, passen den Cache direkt an,
+# sodass für die Anzeige keine Ticket-Zeilen geladen werden müssen. Änderungen
+# aus anderen Prozessen kommen über den Änderungs-Feed (TicketChanges).
+
+STATUS_INDEX_NAME = "idx_ticket_status"
+
+_counts = None
+_counts_lock = threading.Lock()
+
+
+def ensure_status_index():
+    """Legt den Index auf ticket.ID_Status an, falls die Spalte noch nicht indiziert ist."""
+    from Main import engine, inspector
+
+    try:
+        indexes = inspector.get_indexes("ticket")
+        if any(idx["column_names"] and idx["column_names"][0] == "ID_Status" for idx in indexes):
+            return True
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE INDEX {STATUS_INDEX_NAME} ON ticket (ID_Status)"))
+        # Sonst meldet der Inspector den Index beim nächsten Aufruf weiter als fehlend
+        inspector.clear_cache()
+        return True
+    except Exception as e:
+        print(f"FEHLER: Index auf ticket.ID_Status konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def load_status_counts(engine):
+    """Liest die Ticket-Anzahl je Status mit einer einzigen Aggregat-Abfrage."""
+    query = text("""
+        SELECT s.ID_Status, s.Name, COUNT(t.ID_Ticket) AS Anzahl
+        FROM status s
+        LEFT JOIN ticket t ON t.ID_Status = s.ID_Status
+        GROUP BY s.ID_Status, s.Name
+        ORDER BY s.ID_Status
+    """)
+    with engine.connect() as conn:
+        rows = conn.execute(query).fetchall()
+    return {row.ID_Status: {"Name": row.Name, "Anzahl": row.Anzahl} for row in rows}
+
+
+def get_status_counts():
+    """
+    Gibt {ID_Status: {"Name": ..., "Anzahl": ...}} zurück.
+    Geladen wird nur beim ersten Zugriff oder nach einer Invalidierung.
+    """
+    global _counts
+    from Main import engine
+
+    with _counts_lock:
+        if _counts is None:
+            _counts = load_status_counts(engine)
+        return {status_id: dict(entry) for status_id, entry in _counts.items()}
+
+
+def bump_status_count(old_status_id, new_status_id):
+    """
+    Passt die gecachten Zähler nach einer Statusänderung an.
+    old_status_id=None bedeutet neues Ticket, new_status_id=None gelöschtes Ticket.
+    """
+    global _counts
+
+    if old_status_id == new_status_id:
+        return
+
+    with _counts_lock:
+        if _counts is None:
+            return
+        for status_id, delta in ((old_status_id, -1), (new_status_id, 1)):
+            if status_id is None:
+                continue
+            if status_id not in _counts:
+                # Unbekannter Status: beim nächsten Zugriff neu laden
+                _counts = None
+                return
+            _counts[status_id]["Anzahl"] = max(0, _counts[status_id]["Anzahl"] + delta)
+
+
+def invalidate_status_counts():
+    """Verwirft die gecachten Zähler, z.B. nach Massenänderungen."""
+    global _counts
+    with _counts_lock:
+        _counts = None
+
+
+def get_status_count_label(status_id):
+    """Formatiert die Anzahl für einen einzelnen Status, z.B. für Kanban-Spaltenköpfe."""
+    entry = get_status_counts().get(status_id)
+    return str(entry["Anzahl"]) if entry else "0"
+
+
+def format_status_counts():
+    """Formatiert alle Zähler als "Offen: 312 / In Bearbeitung: 88"."""
+    counts = get_status_counts()
+    return " / ".join(f"{entry['Name']}: {entry['Anzahl']}" for entry in counts.values())
+
+
+def _on_change(event):
+    # Eigene Schreibpfade passen die Zähler bereits direkt an
+    if event["entity"] == "status" or not event["local"]:
+        invalidate_status_counts()
+
+
+subscribe("ticket", _on_change)
+subscribe("status", _on_change)
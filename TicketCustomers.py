@@ -0,0 +1,156 @@
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, text
+from TicketChanges import ACTION_INSERT, publish_change, subscribe
+
+# ==============================================================================
+# KUNDEN ZU E-MAIL-ADRESSEN AUFLÖSEN
+# ==============================================================================
+# Absenderadressen werden normalisiert (ohne Leerzeichen, klein geschrieben) und
+# über einen eindeutigen Schlüssel auf kunde.Email angelegt bzw. gefunden; die
+# Standard-Kollation vergleicht dabei ohne Groß-/Kleinschreibung. Bekannte
+# Zuordnungen Adresse -> ID_Kunde hält ein LRU-Cache im Prozess, sodass
+# wiederkehrende Absender ohne Datenbankzugriff aufgelöst werden. Neue Einträge
+# kommen erst nach dem Commit in den Cache, damit ein Rollback keine IDs hinterlässt.
+
+CUSTOMER_EMAIL_KEY = "uq_kunde_email"
+CUSTOMER_CACHE_SIZE = 4096
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def ensure_customer_email_key():
+    """Legt den eindeutigen Schlüssel auf kunde.Email an, falls er fehlt."""
+    from Main import engine, inspector
+
+    try:
+        existing = inspector.get_unique_constraints("kunde") + [idx for idx in inspector.get_indexes("kunde") if idx.get("unique")]
+        if any(entry["column_names"] == ["Email"] for entry in existing):
+            return True
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE kunde ADD CONSTRAINT {CUSTOMER_EMAIL_KEY} UNIQUE (Email)"))
+        inspector.clear_cache()
+        return True
+    except Exception as e:
+        # z.B. bereits mehrfach angelegte Kunden mit derselben Adresse
+        print(f"FEHLER: Eindeutiger Schlüssel auf kunde.Email konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def normalize_email(address):
+    return (address or "").strip().lower()
+
+
+def clear_customer_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def _remember(customer_ids):
+    with _cache_lock:
+        for address, kunde_id in customer_ids.items():
+            _cache[address] = kunde_id
+            _cache.move_to_end(address)
+        while len(_cache) > CUSTOMER_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _remember_after_commit(conn, customer_ids):
+    if not conn.in_transaction():
+        _remember(customer_ids)
+        return
+    event.listen(conn, "commit", lambda _conn: _remember(customer_ids), once=True)
+
+
+def _select_customer_ids(conn, emails, locking=False):
+    """
+    Liest die IDs vorhandener Kunden zu normalisierten Adressen. Mit locking=True
+    werden auch Zeilen gelesen, die nach Beginn der Transaktion bestätigt wurden.
+    """
+    params = {f"email_{i}": email for i, email in enumerate(emails)}
+    rows = conn.execute(text(f"""
+        SELECT ID_Kunde, Email FROM kunde WHERE Email IN ({', '.join(f':{key}' for key in params)})
+        {'LOCK IN SHARE MODE' if locking else ''}
+    """), params)
+    return {normalize_email(row.Email): row.ID_Kunde for row in rows}
+
+
+def resolve_customer_ids(conn, addresses):
+    """
+    Ordnet Absenderadressen ihren Kunden zu und legt fehlende Kunden in der
+    Transaktion des Aufrufers an. Gibt ein Dictionary Adresse -> ID_Kunde zurück.
+    """
+    normalized = {address: normalize_email(address) for address in addresses}
+
+    found = {}
+    with _cache_lock:
+        for email in set(normalized.values()):
+            if email in _cache:
+                found[email] = _cache[email]
+                _cache.move_to_end(email)
+
+    missing = sorted(set(normalized.values()) - set(found))
+    resolved = _select_customer_ids(conn, missing) if missing else {}
+    new = [email for email in missing if email not in resolved]
+    if new:
+        # INSERT IGNORE zählt nur tatsächlich angelegte Zeilen; ON DUPLICATE KEY UPDATE meldet
+        # mit CLIENT_FOUND_ROWS (SQLAlchemy) auch unveränderte Kunden als betroffen
+        params = {}
+        for i, email in enumerate(new):
+            params[f"name_{i}"] = email.split("@")[0]  # Derive name from email
+            params[f"email_{i}"] = email
+        result = conn.execute(text(f"""
+            INSERT IGNORE INTO kunde (Name, Email)
+            VALUES {', '.join(f'(:name_{i}, :email_{i})' for i in range(len(new)))}
+        """), params)
+        if len(new) == 1 and result.rowcount == 1:
+            resolved[new[0]] = result.lastrowid
+        else:
+            # Zwischenzeitlich von einer anderen Transaktion angelegte Kunden mitlesen
+            resolved.update(_select_customer_ids(conn, new, locking=True))
+        if result.rowcount:
+            publish_change("kunde", None, ACTION_INSERT, conn=conn)
+
+    if resolved:
+        _remember_after_commit(conn, resolved)
+        found.update(resolved)
+
+    return {address: found[email] for address, email in normalized.items()}
+
+
+def lookup_customer_ids(conn, addresses):
+    """
+    Wie resolve_customer_ids, legt aber keine Kunden an.
+    Gibt ein Dictionary Adresse -> ID_Kunde zurück, None für unbekannte Adressen.
+    """
+    normalized = {address: normalize_email(address) for address in addresses}
+
+    found = {}
+    with _cache_lock:
+        for email in set(normalized.values()):
+            if email in _cache:
+                found[email] = _cache[email]
+                _cache.move_to_end(email)
+
+    missing = sorted(set(normalized.values()) - set(found))
+    if missing:
+        resolved = _select_customer_ids(conn, missing)
+        _remember(resolved)
+        found.update(resolved)
+
+    return {address: found.get(email) for address, email in normalized.items()}
+
+
+def resolve_customer_id(conn, address):
+    """Wie resolve_customer_ids für eine einzelne Adresse."""
+    return resolve_customer_ids(conn, [address])[address]
+
+
+def _on_change(event_data):
+    # Neue Kunden ändern keine bekannte Zuordnung, gelöschte oder geänderte schon
+    if event_data["action"] != ACTION_INSERT:
+        clear_customer_cache()
+
+
+subscribe("kunde", _on_change)
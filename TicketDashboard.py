@@ -0,0 +1,187 @@
+import threading
+import time
+from datetime import datetime
+import pandas as pd
+import streamlit as st
+from sqlalchemy import text
+from TicketChanges import subscribe
+
+# ==============================================================================
+# HINTERGRUND-VORBERECHNUNG FÜR DASHBOARDS
+# ==============================================================================
+# Statistiken und Kanban-Spalten werden einmal pro Server-Prozess in einem
+# Hintergrund-Thread berechnet und in einem gemeinsamen Cache abgelegt.
+# Seitenaufrufe lesen nur noch aus diesem Cache. Meldet der Änderungs-Feed eine
+# Änderung, wird vor Ablauf des Intervalls neu berechnet.
+
+# Intervalle in Sekunden
+DASHBOARD_REFRESH_INTERVAL = 60
+KANBAN_REFRESH_INTERVAL = 30
+
+# Anzahl Tickets, die pro Kanban-Spalte vorberechnet werden
+KANBAN_COLUMN_LIMIT = 25
+
+DASHBOARD_KEY = "dashboard_aggregates"
+KANBAN_KEY = "kanban_heads"
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def set_cached(key, value):
+    """Legt einen Wert mit Zeitstempel im gemeinsamen Cache ab."""
+    with _cache_lock:
+        _cache[key] = (value, datetime.now())
+
+
+def get_cached(key):
+    """Gibt (Wert, Berechnet_am) zurück oder (None, None), falls noch nichts berechnet wurde."""
+    with _cache_lock:
+        return _cache.get(key, (None, None))
+
+
+def compute_dashboard_aggregates(engine):
+    """Berechnet alle Aggregate für die Statistik-Seite."""
+    queries = {
+        "status": """
+            SELECT s.Name AS Status, COUNT(*) AS Anzahl
+            FROM ticket t
+            JOIN status s ON t.ID_Status = s.ID_Status
+            GROUP BY s.Name
+        """,
+        "prioritaet": """
+            SELECT Priorität, COUNT(*) AS Anzahl
+            FROM ticket
+            GROUP BY Priorität
+        """,
+        "mitarbeiter": """
+            SELECT m.Name AS Mitarbeiter, COUNT(*) AS Anzahl
+            FROM ticket t
+            JOIN mitarbeiter m ON t.ID_Mitarbeiter = m.ID_Mitarbeiter
+            GROUP BY m.Name
+        """,
+        "verlauf": """
+            SELECT DATE(Erstellt_am) AS Datum, COUNT(*) AS Anzahl
+            FROM ticket
+            WHERE Erstellt_am IS NOT NULL
+            GROUP BY DATE(Erstellt_am)
+            ORDER BY Datum
+        """,
+    }
+    return {name: pd.read_sql(query, con=engine) for name, query in queries.items()}
+
+
+def compute_kanban_heads(engine, limit=KANBAN_COLUMN_LIMIT):
+    """Berechnet die Status-Liste und die neuesten Tickets je Status-Spalte."""
+    status_df = pd.read_sql("SELECT ID_Status, Name FROM status ORDER BY ID_Status", con=engine)
+
+    query = text("""
+        SELECT x.ID_Ticket, x.Titel, x.Priorität, x.ID_Status, x.Status, x.version
+        FROM (
+            SELECT t.ID_Ticket, t.Titel, t.Priorität, t.ID_Status, s.Name AS Status, t.version,
+                   ROW_NUMBER() OVER (PARTITION BY t.ID_Status ORDER BY t.Erstellt_am DESC) AS rn
+            FROM ticket t
+            LEFT JOIN status s ON t.ID_Status = s.ID_Status
+        ) x
+        WHERE x.rn <= :limit
+        ORDER BY x.ID_Status, x.rn
+    """)
+    tickets_df = pd.read_sql(query, con=engine, params={"limit": limit})
+
+    return {"status": status_df.to_dict('records'), "tickets": tickets_df}
+
+
+class PrecomputeWorker(threading.Thread):
+    """Hintergrund-Thread, der die registrierten Berechnungen periodisch ausführt."""
+
+    def __init__(self, engine, jobs):
+        super().__init__(name="dashboard-precompute", daemon=True)
+        self.engine = engine
+        # key -> (Funktion, Intervall in Sekunden)
+        self.jobs = jobs
+        self.next_run = {key: 0 for key in jobs}
+        self.stop_event = threading.Event()
+
+    def request_refresh(self, key):
+        """Plant eine Neuberechnung beim nächsten Durchlauf ein."""
+        self.next_run[key] = 0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            for key, (func, interval) in self.jobs.items():
+                if now < self.next_run[key]:
+                    continue
+                try:
+                    set_cached(key, func(self.engine))
+                except Exception as e:
+                    print(f"FEHLER: Vorberechnung '{key}' fehlgeschlagen: {str(e)}")
+                self.next_run[key] = time.monotonic() + interval
+            self.stop_event.wait(1)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+@st.cache_resource
+def start_precompute_worker(dashboard_interval=DASHBOARD_REFRESH_INTERVAL, kanban_interval=KANBAN_REFRESH_INTERVAL):
+    """
+    Startet den Vorberechnungs-Thread genau einmal pro Server-Prozess.
+    """
+    from Main import engine
+    worker = PrecomputeWorker(engine, {
+        DASHBOARD_KEY: (compute_dashboard_aggregates, dashboard_interval),
+        KANBAN_KEY: (compute_kanban_heads, kanban_interval),
+    })
+    worker.start()
+    return worker
+
+
+def get_precomputed(key):
+    """
+    Liest einen vorberechneten Wert. Ist der Cache noch leer (z.B. direkt nach dem
+    Serverstart), wird einmalig synchron berechnet.
+    """
+    value, computed_at = get_cached(key)
+    if value is None:
+        value, computed_at = refresh_now(key)
+    return value, computed_at
+
+
+def refresh_now(key):
+    """Berechnet einen Wert sofort synchron, z.B. nach einer eigenen Änderung."""
+    from Main import engine
+    worker = start_precompute_worker()
+    func, _ = worker.jobs[key]
+    set_cached(key, func(engine))
+    return get_cached(key)
+
+
+def request_refresh(key):
+    """Bittet den Hintergrund-Thread, einen Wert beim nächsten Durchlauf neu zu berechnen."""
+    start_precompute_worker().request_refresh(key)
+
+
+def show_staleness(computed_at):
+    """Zeigt an, wie alt die angezeigten Daten sind."""
+    if computed_at is None:
+        return
+    age = int((datetime.now() - computed_at).total_seconds())
+    st.caption(f"🕒 Stand: {computed_at.strftime('%H:%M:%S')} (vor {age} s aktualisiert)")
+
+
+# Welche vorberechneten Werte von Änderungen an welcher Tabelle betroffen sind
+_REFRESH_ON_CHANGE = {
+    "ticket": (DASHBOARD_KEY, KANBAN_KEY),
+    "status": (DASHBOARD_KEY, KANBAN_KEY),
+    "mitarbeiter": (DASHBOARD_KEY,),
+}
+
+
+def _on_change(event):
+    for key in _REFRESH_ON_CHANGE[event["entity"]]:
+        request_refresh(key)
+
+
+for _entity in _REFRESH_ON_CHANGE:
+    subscribe(_entity, _on_change)
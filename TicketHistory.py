@@ -0,0 +1,214 @@
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import text
+from TicketHistoryDelta import encode_history_values
+
+# ==============================================================================
+# GEPUFFERTER HISTORIEN-SCHREIBER
+# ==============================================================================
+# Historien-Einträge werden im Modus "async" in eine Warteschlange gestellt und
+# von einem Hintergrund-Thread gesammelt als mehrzeiliges INSERT geschrieben.
+# Wiederholungen bei Sperrkonflikten passieren dort und blockieren die UI nicht.
+# Im Modus "sync" (z.B. für Tests) wird direkt geschrieben.
+
+HISTORY_WRITE_MODE = "async"
+
+# Spätestens nach diesem Intervall (Sekunden) oder dieser Anzahl Einträge wird geschrieben
+HISTORY_FLUSH_INTERVAL = 0.3
+HISTORY_BATCH_SIZE = 100
+
+HISTORY_MAX_RETRIES = 5
+HISTORY_RETRY_BASE_DELAY = 0.2
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def make_history_record(ticket_id, feldname, alter_wert, neuer_wert, mitarbeiter_id, geändert_am=None):
+    """
+    Erstellt einen Historien-Eintrag oder None, wenn sich die Werte nicht unterscheiden.
+    Der Zeitpunkt wird beim Erstellen festgehalten, nicht erst beim Schreiben.
+    Lange Texte werden dabei delta-kodiert (siehe TicketHistoryDelta).
+    """
+    alter_wert_str = str(alter_wert) if alter_wert is not None else ""
+    neuer_wert_str = str(neuer_wert) if neuer_wert is not None else ""
+
+    # Nur Änderungen speichern
+    if alter_wert_str.strip() == neuer_wert_str.strip():
+        return None
+
+    alter_wert_str, neuer_wert_str, kodierung = encode_history_values(feldname, alter_wert_str, neuer_wert_str)
+
+    return {
+        "ticket_id": ticket_id,
+        "feldname": feldname,
+        "alter_wert": alter_wert_str,
+        "neuer_wert": neuer_wert_str,
+        "kodierung": kodierung,
+        "geändert_von": mitarbeiter_id,
+        "geändert_am": geändert_am or datetime.now()
+    }
+
+
+def insert_history_records(conn, records):
+    """Schreibt alle Einträge mit einem einzigen mehrzeiligen INSERT."""
+    if not records:
+        return 0
+
+    rows = []
+    params = {}
+    for i, record in enumerate(records):
+        rows.append(f"(:ticket_id_{i}, :feldname_{i}, :alter_wert_{i}, :neuer_wert_{i}, :kodierung_{i}, :geändert_von_{i}, :geändert_am_{i})")
+        for key, value in record.items():
+            params[f"{key}_{i}"] = value
+
+    insert_query = text(f"""
+        INSERT INTO ticket_historie (ID_Ticket, Feldname, Alter_Wert, Neuer_Wert, Kodierung, Geändert_von, Geändert_am)
+        VALUES {", ".join(rows)}
+    """)
+    conn.execute(insert_query, params)
+    return len(records)
+
+
+def write_history_records_sync(engine, records, max_retries=3, retry_delay=0.5):
+    """Schreibt Einträge direkt; wiederholt nur bei Lock-Timeouts."""
+    retry_count = 0
+    while True:
+        try:
+            with engine.begin() as conn:
+                return insert_history_records(conn, records)
+        except Exception as e:
+            if "Lock wait timeout exceeded" in str(e) and retry_count < max_retries - 1:
+                retry_count += 1
+                time.sleep(retry_delay)
+            else:
+                print(f"FEHLER: Historien-Eintrag konnte nicht gespeichert werden: {str(e)}")
+                raise
+
+
+class HistoryWriter:
+    """Sammelt Historien-Einträge und schreibt sie gebündelt in einem Hintergrund-Thread."""
+
+    def __init__(self, engine, flush_interval=HISTORY_FLUSH_INTERVAL, batch_size=HISTORY_BATCH_SIZE,
+                 max_retries=HISTORY_MAX_RETRIES, retry_base_delay=HISTORY_RETRY_BASE_DELAY):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    def enqueue(self, record):
+        self.queue.put(record)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = None
+
+            if record is not None:
+                batch.append(record)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            stopping = self.stopped.is_set() and self.queue.empty()
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or stopping):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+            if stopping and not batch:
+                return
+
+    def _flush(self, batch):
+        """Schreibt einen Stapel; bei Fehlern mit exponentiell wachsender Pause erneut."""
+        for attempt in range(self.max_retries):
+            try:
+                with self.engine.begin() as conn:
+                    insert_history_records(conn, batch)
+                return
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    print(f"FEHLER: {len(batch)} Historien-Einträge konnten nicht gespeichert werden: {str(e)}")
+                    return
+                time.sleep(self.retry_base_delay * (2 ** attempt))
+
+    def drain(self, timeout=10):
+        """Schreibt alle wartenden Einträge und beendet den Thread."""
+        self.stopped.set()
+        # Wartenden get()-Aufruf aufwecken
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+HISTORY_INDEX_NAME = "idx_historie_ticket_zeit"
+
+
+def ensure_history_index():
+    """Legt den Index für die seitenweise Historien-Abfrage an, falls er fehlt."""
+    from Main import engine, inspector
+
+    try:
+        indexes = inspector.get_indexes("ticket_historie")
+        if any(idx["name"] == HISTORY_INDEX_NAME for idx in indexes):
+            return True
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE INDEX {HISTORY_INDEX_NAME} ON ticket_historie (ID_Ticket, Geändert_am, ID_Historie)"))
+        inspector.clear_cache()
+        return True
+    except Exception as e:
+        print(f"FEHLER: Index auf ticket_historie konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def get_history_writer():
+    """Gibt den Schreiber des Prozesses zurück und startet ihn bei Bedarf."""
+    global _writer
+    from Main import engine
+
+    with _writer_lock:
+        if _writer is None:
+            _writer = HistoryWriter(engine)
+        return _writer
+
+
+def shutdown_history_writer(timeout=10):
+    """Leert die Warteschlange beim Beenden des Prozesses."""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.drain(timeout)
+
+
+def set_history_write_mode(mode):
+    """Schaltet zwischen "async" (gepuffert) und "sync" (direkt, z.B. für Tests) um."""
+    global HISTORY_WRITE_MODE
+    if mode not in ("async", "sync"):
+        raise ValueError(f"Unbekannter Historien-Modus: {mode}")
+    if mode == "sync":
+        shutdown_history_writer()
+    HISTORY_WRITE_MODE = mode
+
+
+def write_history(record):
+    """Schreibt einen Eintrag je nach Modus sofort oder über den Hintergrund-Thread."""
+    if HISTORY_WRITE_MODE == "sync":
+        from Main import engine
+        write_history_records_sync(engine, [record])
+    else:
+        get_history_writer().enqueue(record)
+
+
+atexit.register(shutdown_history_writer)
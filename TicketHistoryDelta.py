@@ -0,0 +1,84 @@
+import base64
+import difflib
+import json
+import zlib
+
+# ==============================================================================
+# DELTA-KODIERUNG FÜR GROSSE TEXTFELDER IN DER HISTORIE
+# ==============================================================================
+# Bei langen Texten (z.B. eingefügten E-Mail-Texten in der Beschreibung) wird nicht
+# mehr zweimal der volle Text gespeichert. Neuer_Wert enthält den neuen Text
+# komprimiert, Alter_Wert nur noch die komprimierte zeilenweise Differenz, aus der
+# sich der alte Text zusammen mit dem neuen wiederherstellen lässt.
+
+DELTA_ENCODING = "zlib-delta"
+
+# Felder, die delta-kodiert werden, und die Mindestlänge (alt + neu) dafür
+DELTA_FIELDS = ("Beschreibung",)
+DELTA_MIN_LENGTH = 1024
+
+
+def _compress(value):
+    return base64.b64encode(zlib.compress(value.encode("utf-8"), 9)).decode("ascii")
+
+
+def _decompress(value):
+    return zlib.decompress(base64.b64decode(value)).decode("utf-8")
+
+
+def make_delta(base, target):
+    """
+    Berechnet eine zeilenweise Differenz, mit der sich target aus base erzeugen lässt.
+    ["=", i1, i2] übernimmt Zeilen aus base, ["+", text] fügt neuen Text ein.
+    """
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(["=", i1, i2])
+        elif tag in ("replace", "insert"):
+            ops.append(["+", "".join(target_lines[j1:j2])])
+        # "delete": nichts übernehmen
+    return ops
+
+
+def apply_delta(base, ops):
+    """Stellt den Zieltext aus base und einer Differenz aus make_delta wieder her."""
+    base_lines = base.splitlines(keepends=True)
+    parts = []
+    for op in ops:
+        if op[0] == "=":
+            parts.extend(base_lines[op[1]:op[2]])
+        else:
+            parts.append(op[1])
+    return "".join(parts)
+
+
+def encode_history_values(feldname, alter_wert, neuer_wert):
+    """
+    Kodiert ein Wertepaar für ticket_historie.
+    Gibt (Alter_Wert, Neuer_Wert, Kodierung) zurück; Kodierung None bedeutet Klartext.
+    """
+    if feldname not in DELTA_FIELDS or len(alter_wert) + len(neuer_wert) < DELTA_MIN_LENGTH:
+        return alter_wert, neuer_wert, None
+
+    encoded_new = _compress(neuer_wert)
+    encoded_old = _compress(json.dumps(make_delta(neuer_wert, alter_wert), separators=(",", ":")))
+
+    # Nur kodieren, wenn es tatsächlich Platz spart
+    if len(encoded_old) + len(encoded_new) >= len(alter_wert) + len(neuer_wert):
+        return alter_wert, neuer_wert, None
+    return encoded_old, encoded_new, DELTA_ENCODING
+
+
+def decode_history_values(alter_wert, neuer_wert, kodierung):
+    """Gibt (Alter_Wert, Neuer_Wert) im Klartext zurück."""
+    if kodierung != DELTA_ENCODING:
+        return alter_wert, neuer_wert
+
+    neuer_klartext = _decompress(neuer_wert)
+    alter_klartext = apply_delta(neuer_klartext, json.loads(_decompress(alter_wert)))
+    return alter_klartext, neuer_klartext
@@ -5,7 +5,14 @@ from sqlalchemy import text
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.utils import make_msgid
 from datetime import datetime
+from TicketCounts import invalidate_status_counts
+from TicketChanges import ACTION_INSERT, get_change_version, publish_change
+from TicketMailIngest import get_ingest_scheduler, insert_tickets_from_emails, poll_mailboxes, run_ingestion
+from TicketMailThreads import DIRECTION_OUTBOUND, normalize_message_id, parse_recipients, record_message_ids
+from TicketMailboxes import DEFAULT_FOLDER, delete_mailbox, load_mailbox_keys, load_mailboxes, mailbox_key, save_mailbox
+from TicketMailSync import fetch_message_bodies, message_to_email_header
 
 # Assuming 'engine' is imported from 'Main.py' or defined globally in the main application
 # from Main import engine
@@ -57,8 +64,9 @@ def initialize_session_state():
         if key not in st.session_state:
             st.session_state[key] = value
 
-    # Load employees from DB if not already loaded or if it's still the default fallback
-    if not st.session_state.employees:
+    # Load employees from DB if not already loaded, still the default fallback or changed since loading
+    employees_version = get_change_version("mitarbeiter")
+    if not st.session_state.employees or st.session_state.get("employees_version") != employees_version:
         try:
             from Main import engine # Import engine here to avoid circular dependency if Main imports this file
             with engine.connect() as conn:
@@ -70,6 +78,7 @@ def initialize_session_state():
                 else:
                     st.success(f"✅ {len(rows)} Mitarbeiter geladen.")
                 st.session_state.employees = [dict(row._mapping) for row in rows]
+                st.session_state.employees_version = employees_version
         except Exception as e:
             st.error(f"❌ Fehler beim Laden der Mitarbeiter: {e}")
             import traceback
@@ -87,34 +96,47 @@ def get_database_engine():
 
 def fetch_emails(email, password, imap_server="imap.gmail.com", limit=10):
     """
-    Holt E-Mails über IMAP ab, ohne sie zu löschen.
+    Holt die Kopfdaten (Absender, Betreff, Datum, Größe) der neuesten E-Mails über IMAP ab,
+    ohne sie zu löschen oder als gelesen zu markieren. Inhalte lädt fetch_email_bodies nach.
     """
     try:
         with MailBox(imap_server).login(email, password, initial_folder="INBOX") as mailbox:
-            messages = mailbox.fetch(limit=limit, reverse=True)
-            emails = []
-            for msg in messages:
-                emails.append({
-                    "Von": msg.from_,
-                    "Betreff": msg.subject,
-                    "Datum": msg.date.strftime("%d.%m.%Y %H:%M"),
-                    "Nachricht": msg.text or msg.html,
-                    "Message-ID": msg.uid,  # Eindeutige ID für die E-Mail
-                })
-            return emails
+            # Für den Schlüssel in ticket_email_log bei E-Mails ohne Message-ID
+            uidvalidity = mailbox.folder.status("INBOX", ["UIDVALIDITY"])["UIDVALIDITY"]
+            messages = mailbox.fetch(limit=limit, reverse=True, mark_seen=False, headers_only=True, bulk=True)
+            return [{**message_to_email_header(msg), "UIDVALIDITY": uidvalidity} for msg in messages]
     except Exception as e:
         st.error(f"Fehler beim Abrufen der E-Mails: {str(e)}")
         return [] # Return empty list on error for consistent type
 
-def send_email(smtp_server, smtp_port, email, app_password, to_email, subject, body, use_ssl=True):
+def fetch_email_bodies(email, password, imap_server, headers):
+    """
+    Lädt die Inhalte zu den übergebenen Kopfdaten mit einer Verbindung nach.
+    Bereits geladene Inhalte werden aus st.session_state.email_bodies übernommen.
+    """
+    cache = st.session_state.setdefault("email_bodies", {})
+    missing = [header for header in headers if header["UID"] not in cache]
+
+    if missing:
+        with MailBox(imap_server).login(email, password, initial_folder="INBOX") as mailbox:
+            for email_data in fetch_message_bodies(mailbox, missing):
+                # Anhänge liegen bereits in der Dateiablage, hier nur ihre Beschreibungen
+                cache[email_data["UID"]] = {"Nachricht": email_data["Nachricht"], "Anhänge": email_data["Anhänge"],
+                                            "Unvollständig": email_data.get("Unvollständig", False)}
+
+    return [{**header, **cache[header["UID"]]} for header in headers]
+
+def send_email(smtp_server, smtp_port, email, app_password, to_email, subject, body, use_ssl=True, ticket_id=None):
     """
     Sendet eine E-Mail über SMTP.
+    Mit ticket_id wird die Message-ID im Index gespeichert, damit Antworten dem Ticket zugeordnet werden.
     """
     try:
         msg = MIMEMultipart()
         msg["From"] = email
         msg["To"] = to_email
         msg["Subject"] = subject
+        msg["Message-ID"] = make_msgid(domain=email.split("@")[-1])
 
         msg.attach(MIMEText(body, "plain", "utf-8"))
 
@@ -129,82 +151,148 @@ def send_email(smtp_server, smtp_port, email, app_password, to_email, subject, b
         server.sendmail(email, to_email, msg.as_string())
         server.quit()
 
+        if ticket_id is not None:
+            try:
+                with get_database_engine().begin() as conn:
+                    record_message_ids(conn, ticket_id, [normalize_message_id(msg["Message-ID"])], DIRECTION_OUTBOUND,
+                                       recipients=parse_recipients(to_email))
+            except Exception as e:
+                return True, f"E-Mail gesendet, Antworten können aber nicht automatisch zugeordnet werden: {str(e)}"
+
         return True, "E-Mail erfolgreich gesendet!"
 
     except Exception as e:
         return False, f"Fehler beim Senden der E-Mail: {str(e)}"
 
-def create_ticket_from_email(email_data, user_id=1, assigned_employee_id=None, priority="mittel"):
+def create_tickets_from_emails(emails, assigned_employee_id=None, priority="mittel", mailbox=None):
     """
-    Erstellt ein Ticket aus einer E-Mail mit Mitarbeiterzuweisung.
+    Erstellt Tickets für mehrere E-Mails in einer gemeinsamen Transaktion.
+    Bereits (auch vom Hintergrund-Abgleich) verarbeitete E-Mails werden übersprungen.
+    Gibt pro E-Mail ein Tupel (Erfolg, Meldung) in der Reihenfolge der Eingabe zurück.
     """
     engine = get_database_engine()
 
-    try:
-        title = email_data["Betreff"][:100]
-        description = email_data["Nachricht"]
-        customer_email = email_data["Von"]
+    results = [None] * len(emails)
+    valid = []
+    for i, email_data in enumerate(emails):
+        if not email_data.get("Von"):
+            results[i] = (False, f"Fehler beim Erstellen des Tickets: Absender fehlt ({email_data.get('Betreff', '')})")
+        elif email_data.get("Unvollständig"):
+            results[i] = (False, f"Inhalt der E-Mail '{email_data.get('Betreff', '')}' konnte nicht geladen werden, bitte manuell bearbeiten.")
+        else:
+            valid.append(i)
 
-        with engine.begin() as conn:
-            # Check if customer exists and get ID, or insert new customer
-            result = conn.execute(
-                text("SELECT ID_Kunde FROM kunde WHERE Email = :email"),
-                {"email": customer_email}
-            )
-            row = result.fetchone()
+    employee_name = "Nicht zugewiesen"
+    if assigned_employee_id:
+        employee = next((emp for emp in st.session_state.employees if emp["id"] == assigned_employee_id), None)
+        if employee:
+            employee_name = employee["name"]
 
-            kunde_id = None
-            if row:
-                kunde_id = row[0]
+    try:
+        with engine.begin() as conn:
+            outcomes = insert_tickets_from_emails(conn, [emails[i] for i in valid], assigned_employee_id, priority, mailbox)
+        invalidate_status_counts()
+        for i, (outcome, thread_id) in zip(valid, outcomes):
+            if outcome == "replied":
+                results[i] = (True, f"✅ Antwort von {emails[i]['Von']} als Kommentar an Ticket #{thread_id} angehängt.")
+            elif outcome == "created":
+                results[i] = (True, f"✅ Ticket aus E-Mail von {emails[i]['Von']} erstellt und an {employee_name} zugewiesen.")
             else:
-                # Insert new customer and get their ID
-                conn.execute(text("""
-                    INSERT INTO kunde (Name, Email)
-                    VALUES (:name, :email)
-                """), {
-                    "name": customer_email.split("@")[0],  # Derive name from email
-                    "email": customer_email
+                results[i] = (False, f"⏭️ E-Mail von {emails[i]['Von']} ({emails[i].get('Betreff', '')}) wurde bereits verarbeitet.")
+    except Exception as e:
+        # Alle Tickets werden gemeinsam angelegt, daher schlagen bei einem Fehler alle fehl
+        for i in valid:
+            results[i] = (False, f"Fehler beim Erstellen des Tickets: {str(e)}")
+
+    return results
+
+def show_mailbox_registry():
+    """
+    Verwaltung der Postfächer, die im Hintergrund automatisch in Tickets umgewandelt werden.
+    """
+    engine = get_database_engine()
+
+    with st.expander("📮 Registrierte Postfächer"):
+        try:
+            mailboxes = load_mailboxes(engine, only_active=False)
+        except Exception as e:
+            st.error(f"Fehler beim Laden der Postfächer: {str(e)}")
+            return
+
+        last_metrics = get_ingest_scheduler().last_metrics
+        if mailboxes:
+            rows = []
+            for mailbox in mailboxes:
+                metrics = last_metrics.get(mailbox_key(mailbox), {})
+                if "error" in metrics:
+                    last_run = f"⚠️ {metrics['error']}"
+                elif metrics:
+                    last_run = f"{datetime.fromtimestamp(metrics['at']).strftime('%H:%M:%S')}: {metrics['created']} neu ({metrics['seconds']} s)"
+                else:
+                    last_run = "-"
+                rows.append({
+                    "Konto": mailbox["email"],
+                    "Server": mailbox["imap_server"],
+                    "Ordner": mailbox["folder"],
+                    "Aktiv": mailbox["active"],
+                    "Letzter Abgleich": last_run
                 })
-                # Fetch the newly created customer's ID
-                result = conn.execute(
-                    text("SELECT ID_Kunde FROM kunde WHERE Email = :email"),
-                    {"email": customer_email}
+            st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+        else:
+            st.info("Noch keine Postfächer registriert.")
+
+        with st.form("mailbox_registry_form", clear_on_submit=True):
+            col1, col2 = st.columns(2)
+            with col1:
+                new_email = st.text_input("Konto")
+                new_server = st.text_input("IMAP-Server", value="imap.gmail.com")
+            with col2:
+                new_password = st.text_input("App-Passwort", type="password")
+                new_folder = st.text_input("Ordner", value=DEFAULT_FOLDER)
+            new_active = st.checkbox("Aktiv", value=True)
+            if st.form_submit_button("💾 Postfach speichern"):
+                if not new_email or not new_password:
+                    st.error("Bitte Konto und Passwort eingeben.")
+                else:
+                    try:
+                        save_mailbox(engine, new_email, new_password, new_server, new_folder or DEFAULT_FOLDER, new_active)
+                    except Exception as e:
+                        st.error(f"Fehler beim Speichern des Postfachs: {str(e)}")
+                    else:
+                        st.rerun()
+
+        if mailboxes:
+            col1, col2 = st.columns(2)
+            with col1:
+                to_delete = st.selectbox(
+                    "Postfach entfernen",
+                    options=mailboxes,
+                    format_func=lambda mailbox: f"{mailbox['email']} / {mailbox['folder']} ({mailbox['imap_server']})",
+                    key="mailbox_delete_select"
                 )
-                kunde_id = result.fetchone()[0]
-
-            # Create ticket with extended fields
-            conn.execute(text("""
-                INSERT INTO ticket (Titel, Beschreibung, Erstellt_am, ID_Kunde, ID_Status, Priorität, ID_Mitarbeiter)
-                VALUES (:title, :description, CURRENT_TIMESTAMP, :kunde_id, :id_status, :priority, :assigned_to)
-            """), {
-                "title": title,
-                "description": description,
-                "kunde_id": kunde_id,
-                "id_status": 1,
-                "priority": priority,
-                "assigned_to": assigned_employee_id
-            })
-
-        employee_name = "Nicht zugewiesen"
-        if assigned_employee_id:
-            employee = next((emp for emp in st.session_state.employees if emp["id"] == assigned_employee_id), None)
-            if employee:
-                employee_name = employee["name"]
-
-        return True, f"✅ Ticket aus E-Mail von {customer_email} erstellt und an {employee_name} zugewiesen."
-
-    except Exception as e:
-        st.error(f"Fehler beim Erstellen des Tickets: {str(e)}")
-        import traceback
-        st.text(traceback.format_exc())
-        return False, f"Fehler beim Erstellen des Tickets: {str(e)}"
+                if st.button("🗑️ Entfernen"):
+                    try:
+                        delete_mailbox(engine, to_delete["id"])
+                    except Exception as e:
+                        st.error(f"Fehler beim Entfernen des Postfachs: {str(e)}")
+                    else:
+                        st.rerun()
+            with col2:
+                if st.button("🔄 Alle aktiven Postfächer jetzt abgleichen"):
+                    with st.spinner("Postfächer werden parallel abgeglichen..."):
+                        results = poll_mailboxes(engine, [mailbox for mailbox in mailboxes if mailbox["active"]])
+                    last_metrics.update(results)
+                    created = sum(metrics.get("created", 0) for metrics in results.values())
+                    errors = [f"{key[0]}/{key[2]}: {metrics['error']}" for key, metrics in results.items() if "error" in metrics]
+                    st.success(f"🎫 {created} neue Tickets aus {len(results)} Postfächern erstellt.")
+                    for error in errors:
+                        st.error(f"⚠️ {error}")
 
 def show_email_inbox_tab():
     """
     Verbesserte E-Mail-Inbox mit interaktiver Tabelle und Ticketkonvertierung.
     """
     st.subheader("📥 E-Mail empfangen")
-    auto_convert_new_emails_to_tickets()
 
     initialize_session_state()
 
@@ -250,6 +338,40 @@ def show_email_inbox_tab():
         "email_limit": email_limit
     })
 
+    # Neue E-Mails registrierter Postfächer werden im Hintergrund in Tickets umgewandelt,
+    # die Seite wartet nicht darauf. Zugangsdaten aus der Sitzung gelangen nur über das
+    # Register (verschlüsselt) in den prozessweiten Abgleich.
+    if email and password:
+        key = mailbox_key(st.session_state.email_config)
+        try:
+            registered = key in load_mailbox_keys(get_database_engine())
+        except Exception as e:
+            st.caption(f"⚠️ Postfach-Register nicht verfügbar: {str(e)}")
+            registered = None
+        if registered is False:
+            st.caption("ℹ️ Automatische Ticket-Erstellung läuft nur für registrierte Postfächer.")
+            if st.button("📮 Postfach registrieren"):
+                try:
+                    save_mailbox(get_database_engine(), email, password, key[1], key[2])
+                except Exception as e:
+                    st.error(f"Fehler beim Speichern des Postfachs: {str(e)}")
+                else:
+                    st.rerun()
+        elif registered:
+            metrics = get_ingest_scheduler().last_metrics.get(key)
+            if metrics is None:
+                st.caption("🔄 Automatische Ticket-Erstellung läuft im Hintergrund, erster Abgleich steht noch aus.")
+            elif "error" in metrics:
+                st.caption(f"⚠️ Letzter automatischer Abgleich ({datetime.fromtimestamp(metrics['at']).strftime('%H:%M:%S')}) fehlgeschlagen: {metrics['error']}")
+            else:
+                st.caption(f"🔄 Letzter automatischer Abgleich um {datetime.fromtimestamp(metrics['at']).strftime('%H:%M:%S')}: "
+                           f"{metrics['created']} neue Tickets, {metrics['replied']} Antworten zugeordnet, "
+                           f"{metrics['skipped']} übersprungen, {metrics['failed']} Fehler.")
+        if st.button("🎫 Jetzt in Tickets umwandeln"):
+            auto_convert_new_emails_to_tickets()
+
+    show_mailbox_registry()
+
     if st.button("📬 E-Mails abrufen"):
         if not email or not password:
             st.error("Bitte E-Mail-Adresse und Passwort eingeben.")
@@ -279,9 +401,12 @@ def show_email_inbox_tab():
                 "Von": st.column_config.TextColumn("Absender", width="medium"),
                 "Betreff": st.column_config.TextColumn("Betreff", width="large"),
                 "Datum": st.column_config.TextColumn("Datum", width="small"),
-                "Nachricht": st.column_config.TextColumn("Nachricht", width="large"),
+                "Größe": st.column_config.NumberColumn("Größe (Bytes)", width="small"),
+                "In-Reply-To": None,
+                "References": None,
+                "UIDVALIDITY": None,
             },
-            disabled=["Von", "Betreff", "Datum", "Nachricht", "Message-ID"],
+            disabled=["Von", "Betreff", "Datum", "Größe", "UID", "Message-ID"],
             key="email_table"
         )
 
@@ -335,41 +460,36 @@ def show_email_inbox_tab():
                 st.rerun()
 
         if st.button("🎫 Ausgewählte E-Mails in Tickets umwandeln", type="primary"):
-            user_id = st.session_state.get("user_id")
             emails_to_convert = st.session_state.selected_emails_for_conversion
 
             if not emails_to_convert:
                 st.warning("Keine E-Mails zum Konvertieren ausgewählt.")
             else:
-                created = 0
-                failed = 0
-                messages = []
-
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-
-                for i, email_data in enumerate(emails_to_convert):
-                    status_text.text(f"Verarbeite E-Mail {i+1} von {len(emails_to_convert)}...")
-                    progress_bar.progress((i + 1) / len(emails_to_convert))
+                # Inhalte nur für die ausgewählten E-Mails laden
+                try:
+                    with st.spinner("E-Mail-Inhalte werden geladen..."):
+                        emails_to_convert = fetch_email_bodies(email, password, imap_server, emails_to_convert)
+                except Exception as e:
+                    st.error(f"Fehler beim Laden der E-Mail-Inhalte: {str(e)}")
+                    emails_to_convert = []
 
-                    success, msg = create_ticket_from_email(
-                        email_data,
-                        user_id=user_id,
+                with st.spinner(f"{len(emails_to_convert)} E-Mails werden in Tickets umgewandelt..."):
+                    results = create_tickets_from_emails(
+                        emails_to_convert,
                         assigned_employee_id=assigned_employee_id,
-                        priority=st.session_state.selected_ticket_priority
+                        priority=st.session_state.selected_ticket_priority,
+                        mailbox=mailbox_key(st.session_state.email_config)
                     )
 
-                    messages.append(msg)
-                    if success:
-                        created += 1
-                    else:
-                        failed += 1
-
-                progress_bar.empty()
-                status_text.empty()
+                messages = [msg for _, msg in results]
+                created = sum(1 for success, _ in results if success)
+                skipped = sum(1 for _, msg in results if "⏭️" in msg)
+                failed = len(results) - created - skipped
 
                 if created > 0:
                     st.success(f"✅ {created} Tickets erfolgreich erstellt!")
+                if skipped > 0:
+                    st.info(f"⏭️ {skipped} E-Mails wurden bereits verarbeitet.")
                 if failed > 0:
                     st.error(f"❌ {failed} Tickets konnten nicht erstellt werden.")
 
@@ -377,6 +497,8 @@ def show_email_inbox_tab():
                     for msg in messages:
                         if "✅" in msg:
                             st.success(msg)
+                        elif "⏭️" in msg:
+                            st.info(msg)
                         else:
                             st.error(msg)
 
@@ -399,16 +521,23 @@ def show_email_inbox_tab():
                     st.markdown(f"**Betreff:** {selected_email["Betreff"]}")
                     st.markdown(f"**Datum:** {selected_email["Datum"]}")
                     st.markdown("**Nachricht:**")
-                    st.text_area("", value=selected_email["Nachricht"], height=200, disabled=True, key="email_content_display")
+                    # Inhalt erst beim Öffnen laden
+                    try:
+                        body = fetch_email_bodies(email, password, imap_server, [selected_email.drop("Auswählen").to_dict()])[0]["Nachricht"]
+                    except Exception as e:
+                        body = f"Fehler beim Laden der Nachricht: {str(e)}"
+                    st.text_area("", value=body, height=200, disabled=True, key="email_content_display")
+
+# Tabellen, deren Änderungen die Ticket-Liste betreffen
+TICKETS_DF_ENTITIES = ("ticket", "kunde", "mitarbeiter", "status")
 
-@st.cache_data(ttl=600) # Cache for 10 minutes
-def get_tickets_df():
+@st.cache_data(max_entries=4) # Invalidated by the change feed via change_version, no TTL needed
+def get_tickets_df(change_version=None):
     engine = get_database_engine()
     ticket_query = """
     SELECT 
         t.ID_Ticket,
         t.Titel,
-        t.Beschreibung,
         s.name as Status,
         t.Priorität,
         t.Erstellt_am,
@@ -438,7 +567,7 @@ def show_ticket_management():
     initialize_session_state()
 
     try:
-        tickets_df = get_tickets_df()
+        tickets_df = get_tickets_df(get_change_version(*TICKETS_DF_ENTITIES))
 
         if tickets_df.empty:
             st.info("Keine Tickets vorhanden.")
@@ -528,16 +657,17 @@ def show_ticket_management():
 
                             conn.execute(text("""
                                 UPDATE ticket 
-                                SET Status = :status, Prioritaet = :priority
+                                SET Status = :status, Prioritaet = :priority, version = version + 1
                                 WHERE ID_Ticket = :ticket_id
                             """), {
                                 "status": new_status,
                                 "priority": new_priority,
                                 "ticket_id": ticket_id
                             })
+                            publish_change("ticket", int(ticket_id), conn=conn)
 
                     st.success("Änderungen erfolgreich gespeichert!")
-                    get_tickets_df.clear() # Clear cache to refetch updated data
+                    invalidate_status_counts()
                     st.rerun()
 
                 except Exception as e:
@@ -598,10 +728,11 @@ def show_employee_management():
                 try:
                     engine = get_database_engine()
                     with engine.begin() as conn:
-                        conn.execute(text("""
+                        result = conn.execute(text("""
                             INSERT INTO mitarbeiter (Name, Email)
                             VALUES (:name, :email)
                         """), {"name": new_name, "email": new_email})
+                        publish_change("mitarbeiter", result.lastrowid, ACTION_INSERT, conn=conn)
                     st.success(f"Mitarbeiter {new_name} erfolgreich hinzugefügt!")
                     # Re-initialize session state to fetch updated employee list from DB
                     initialize_session_state()
@@ -675,7 +806,7 @@ def show_email_tab():
     st.markdown("### E-Mail-Inhalt")
 
     try:
-        tickets_df = get_tickets_df()
+        tickets_df = get_tickets_df(get_change_version(*TICKETS_DF_ENTITIES))
     except Exception as e:
         st.error(f"Fehler beim Laden der Tickets: {str(e)}")
         tickets_df = pd.DataFrame()
@@ -775,7 +906,8 @@ def show_email_tab():
                     to_email=recipient_email,
                     subject=email_subject,
                     body=email_body,
-                    use_ssl=use_ssl
+                    use_ssl=use_ssl,
+                    ticket_id=int(selected_ticket_data["ID_Ticket"]) if selected_ticket_data is not None else None
                 )
 
             if success:
@@ -821,63 +953,27 @@ def show_email_tab():
 
 def auto_convert_new_emails_to_tickets():
     """
-    Automatisch neue E-Mails abrufen und in Tickets umwandeln.
-    Nur E-Mails, die noch nicht verarbeitet wurden (basierend auf Message-ID).
+    Neue E-Mails sofort abrufen und in Tickets umwandeln, statt auf den Hintergrund-Abgleich zu warten.
+    Abgerufen werden nur Nachrichten seit dem letzten Abgleich (UID-Marke),
+    zusätzlich schützt der eindeutige Schlüssel auf ticket_email_log vor doppelten Tickets.
     """
-    st.info("🔄 Automatischer Ticket-Erstellungsprozess gestartet...")
-
-    config = st.session_state.email_config
-    emails = fetch_emails(
-        config["email"],
-        config["password"],
-        config["imap_server"],
-        limit=config["email_limit"]
-    )
+    engine = get_database_engine()
 
-    if not emails:
-        st.info("Keine neuen E-Mails gefunden.")
+    try:
+        with st.spinner("E-Mails werden in Tickets umgewandelt..."):
+            metrics = run_ingestion(engine, st.session_state.email_config)
+    except Exception as e:
+        st.error(f"Fehler beim Abrufen der E-Mails: {str(e)}")
         return
 
-    engine = get_database_engine()
-    new_tickets = 0
-    skipped = 0
-    errors = 0
-
-    with engine.begin() as conn:
-        for email in emails:
-            msg_id = email.get("Message-ID")
-
-            # Prüfen, ob Ticket mit dieser E-Mail bereits existiert (z.B. Message-ID speichern)
-            result = conn.execute(text("""
-                SELECT COUNT(*) FROM ticket_email_log WHERE message_id = :msg_id
-            """), {"msg_id": msg_id})
-            already_exists = result.scalar()
-
-            if already_exists:
-                skipped += 1
-                continue
-
-            # Ticket erstellen
-            success, message = create_ticket_from_email(
-                email_data=email,
-                user_id=st.session_state.get("user_id", 1),
-                assigned_employee_id=None,  # Oder Logik zur automatischen Zuweisung
-                priority="mittel"           # Oder dynamisch z. B. basierend auf Betreff analysieren
-            )
+    if not metrics["fetched"]:
+        st.info("Keine neuen E-Mails gefunden.")
+        return
 
-            if success:
-                new_tickets += 1
-                # Nachricht als verarbeitet markieren
-                conn.execute(text("""
-                    INSERT INTO ticket_email_log (message_id, erstellt_am)
-                    VALUES (:msg_id, CURRENT_TIMESTAMP)
-                """), {"msg_id": msg_id})
-            else:
-                errors += 1
-                st.warning(message)
-
-    st.success(f"🎫 {new_tickets} neue Tickets erstellt.")
-    if skipped:
-        st.info(f"🔁 {skipped} E-Mails wurden übersprungen (bereits verarbeitet).")
-    if errors:
-        st.error(f"⚠️ {errors} Fehler bei der Ticket-Erstellung.")
+    st.success(f"🎫 {metrics['created']} neue Tickets erstellt.")
+    if metrics["replied"]:
+        st.info(f"💬 {metrics['replied']} Antworten an bestehende Tickets angehängt.")
+    if metrics["skipped"]:
+        st.info(f"🔁 {metrics['skipped']} E-Mails wurden übersprungen (bereits verarbeitet).")
+    if metrics["failed"]:
+        st.error(f"⚠️ {metrics['failed']} Fehler bei der Ticket-Erstellung.")
@@ -0,0 +1,133 @@
+import re
+from html import unescape
+from html.parser import HTMLParser
+
+# ==============================================================================
+# E-MAIL-TEXT VOR DEM SPEICHERN NORMALISIEREN
+# ==============================================================================
+# Bevor ein E-Mail-Text als Ticket-Beschreibung oder Kommentar gespeichert wird,
+# durchläuft er mehrere Schritte: HTML wird zu Text, zitierte frühere Nachrichten
+# und Signaturen werden entfernt, Leerraum wird zusammengefasst und der Text auf
+# MAX_DESCRIPTION_LENGTH gekürzt. Wurde dabei Inhalt entfernt, bleibt die
+# Originalnachricht als Anhang in der Dateiablage erhalten.
+
+MAX_DESCRIPTION_LENGTH = 8000
+TRUNCATION_NOTE = "\n\n[... gekürzt, vollständige Nachricht im Anhang]"
+
+# Beginn einer zitierten Nachricht (deutsche und englische Mail-Programme)
+QUOTE_HEADER_PATTERNS = [
+    re.compile(r"^\s*Am .{0,200}schrieb .{0,200}:\s*$", re.IGNORECASE),
+    re.compile(r"^\s*On .{0,200}wrote:\s*$", re.IGNORECASE),
+    re.compile(r"^\s*-{2,}\s*(Ursprüngliche Nachricht|Original Message|Weitergeleitete Nachricht|Forwarded message)\s*-{2,}", re.IGNORECASE),
+    re.compile(r"^\s*_{20,}\s*$"),  # Outlook-Trennlinie vor "Von: ... Gesendet: ..."
+]
+
+# Beginn einer Signatur: "-- " nach RFC 3676 und typische Mobil-Signaturen
+SIGNATURE_PATTERNS = [
+    re.compile(r"^-- ?$"),
+    re.compile(r"^\s*(Gesendet von meinem|Sent from my|Von meinem .{0,40} gesendet)", re.IGNORECASE),
+]
+
+_BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "table", "hr"}
+_SKIP_TAGS = {"script", "style", "head", "title"}
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Sammelt den sichtbaren Text eines HTML-Dokuments mit Zeilenumbrüchen an Blockgrenzen.
+    Zitate in <blockquote> (auch verschachtelte) werden wie "> "-Zeilen in Text-Mails entfernt.
+    """
+
+    def __init__(self, keep_quotes=False):
+        super().__init__(convert_charrefs=True)
+        self.keep_quotes = keep_quotes
+        self.parts = []
+        self.skip_depth = 0
+        self.quote_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+        if tag == "blockquote" and not self.keep_quotes:
+            self.quote_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+        if tag == "blockquote" and not self.keep_quotes:
+            self.quote_depth = max(0, self.quote_depth - 1)
+
+    def handle_data(self, data):
+        if not self.skip_depth and not self.quote_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html, keep_quotes=False):
+    extractor = _TextExtractor(keep_quotes)
+    try:
+        extractor.feed(html)
+        extractor.close()
+    except Exception:
+        # Kaputtes HTML: Tags grob entfernen
+        return unescape(re.sub(r"<[^>]+>", " ", html))
+    return "".join(extractor.parts)
+
+
+def strip_quoted_reply(text):
+    """Entfernt zitierte frühere Nachrichten ab der ersten Zitat-Kopfzeile sowie "> "-Zeilen."""
+    lines = []
+    for line in text.splitlines():
+        if any(pattern.match(line) for pattern in QUOTE_HEADER_PATTERNS):
+            break
+        if line.lstrip().startswith(">"):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def strip_signature(text):
+    """Entfernt die Signatur ab dem ersten Signatur-Trenner."""
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if any(pattern.match(line) for pattern in SIGNATURE_PATTERNS):
+            return "\n".join(lines[:i])
+    return text
+
+
+def collapse_whitespace(text):
+    """Fasst Leerzeichen innerhalb von Zeilen und mehrere Leerzeilen zusammen."""
+    lines = [re.sub(r"[ \t\u00a0]+", " ", line).strip() for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def normalize_email_body(plain_text, html=None, max_length=MAX_DESCRIPTION_LENGTH):
+    """
+    Bereitet den Text einer E-Mail für die Speicherung auf.
+
+    Returns:
+        (normalisierter Text, True, wenn dabei Inhalt entfernt oder gekürzt wurde)
+    """
+    source = plain_text or ""
+    from_html = not source.strip() and bool(html)
+    if from_html:
+        source = html_to_text(html)
+        if not source.strip():
+            # Nur Zitat: lieber das Zitat behalten als nichts
+            source = html_to_text(html, keep_quotes=True)
+
+    text = collapse_whitespace(source)
+    stripped = collapse_whitespace(strip_signature(strip_quoted_reply(text)))
+    if not stripped:
+        # Nur Zitat oder Signatur: lieber den ganzen Text behalten als nichts
+        stripped = text
+    lost_content = from_html or stripped != text
+
+    if len(stripped) > max_length:
+        stripped = stripped[:max_length].rstrip() + TRUNCATION_NOTE
+        lost_content = True
+
+    return stripped, lost_content
@@ -0,0 +1,476 @@
+import argparse
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from sqlalchemy import text
+from TicketChanges import ACTION_INSERT, ensure_change_event_table, publish_change, sync_change_feed
+from TicketAttachments import ensure_attachment_table, link_attachments
+from TicketCounts import bump_status_count
+from TicketCustomers import ensure_customer_email_key, resolve_customer_id, resolve_customer_ids
+from TicketMailSync import ensure_sync_state_table, sync_mailbox
+from TicketMailThreads import (DIRECTION_INBOUND, append_reply, ensure_message_index_table, find_thread_ticket,
+                               find_thread_tickets, normalize_message_id, record_message_ids)
+from TicketMailboxes import DEFAULT_FOLDER, DEFAULT_IMAP_SERVER, ensure_mailbox_table, load_mailboxes, mailbox_key
+
+# ==============================================================================
+# E-MAIL-EINGANG OHNE BENUTZEROBERFLÄCHE
+# ==============================================================================
+# Wandelt neue E-Mails unabhängig von Streamlit in Tickets um. Läuft entweder als
+# eigener Prozess (python TicketMailIngest.py ...) oder als Hintergrund-Thread im
+# Server-Prozess. Ausgaben gehen ins Logging, nicht in die Oberfläche.
+
+INGEST_POLL_INTERVAL = 60
+
+# Postfächer werden parallel abgeglichen; ein langsamer Server hält die anderen nicht auf
+MAX_POLL_WORKERS = 8
+MAILBOX_TIMEOUT = 120
+
+# Verarbeitete E-Mails werden über ihre Message-ID (Kopfzeile, sonst Postfach,
+# UIDVALIDITY und IMAP-UID) in ticket_email_log eingetragen. Der Eintrag wird per INSERT IGNORE vor dem Ticket
+# angelegt; der eindeutige Schlüssel sorgt dafür, dass parallel laufende Abgleiche
+# dieselbe E-Mail nur einmal umwandeln.
+EMAIL_LOG_TABLE = "ticket_email_log"
+EMAIL_LOG_UNIQUE_KEY = "uq_email_log_message_id"
+
+# Standardwerte für Tickets aus E-Mails
+INGEST_STATUS_ID = 1
+INGEST_PRIORITY = "mittel"
+
+logger = logging.getLogger("ticketsystem.mail_ingest")
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+# Postfächer, deren Abgleich gerade läuft; ein neuer Lauf überspringt sie
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+INSERT_TICKET_QUERY = text("""
+    INSERT INTO ticket (Titel, Beschreibung, Erstellt_am, ID_Kunde, ID_Status, Priorität, ID_Mitarbeiter)
+    VALUES (:title, :description, CURRENT_TIMESTAMP, :kunde_id, :id_status, :priority, :assigned_to)
+""")
+
+
+def _ticket_params(email_data, kunde_id, assigned_employee_id, priority):
+    return {
+        "title": email_data["Betreff"][:100],
+        "description": email_data["Nachricht"],
+        "kunde_id": kunde_id,
+        "id_status": INGEST_STATUS_ID,
+        "priority": priority,
+        "assigned_to": assigned_employee_id
+    }
+
+
+def ensure_email_log_table():
+    """Legt ticket_email_log mit eindeutigem Schlüssel an bzw. ergänzt den Schlüssel."""
+    from Main import engine, inspector
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {EMAIL_LOG_TABLE} (
+                    message_id VARCHAR(255) NOT NULL,
+                    erstellt_am DATETIME NOT NULL,
+                    CONSTRAINT {EMAIL_LOG_UNIQUE_KEY} UNIQUE (message_id)
+                )
+            """))
+
+        existing = inspector.get_unique_constraints(EMAIL_LOG_TABLE) + [
+            idx for idx in inspector.get_indexes(EMAIL_LOG_TABLE) if idx.get("unique")]
+        if not any(entry["column_names"] == ["message_id"] for entry in existing):
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {EMAIL_LOG_TABLE} ADD CONSTRAINT {EMAIL_LOG_UNIQUE_KEY} UNIQUE (message_id)"))
+            inspector.clear_cache()
+        return True
+    except Exception as e:
+        # z.B. bereits doppelt protokollierte E-Mails
+        print(f"FEHLER: Eindeutiger Schlüssel auf {EMAIL_LOG_TABLE} konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def ensure_mail_tables():
+    """Legt alle Tabellen und Schlüssel an, die der E-Mail-Eingang braucht. Gibt True zurück, wenn alles vorhanden ist."""
+    results = [
+        ensure_sync_state_table(),
+        ensure_email_log_table(),
+        ensure_customer_email_key(),
+        ensure_mailbox_table(),
+        ensure_attachment_table(),
+        ensure_message_index_table(),
+    ]
+    return all(results)
+
+
+def email_dedup_key(email_data, mailbox=None):
+    """
+    Schlüssel, unter dem eine E-Mail in ticket_email_log eingetragen wird: die
+    normalisierte Message-ID. Ohne sie ist die IMAP-UID nur zusammen mit Postfach
+    (Konto, Server, Ordner) und UIDVALIDITY eindeutig; dieser Schlüssel wird gehasht.
+    """
+    message_id = normalize_message_id(email_data.get("Message-ID"))
+    if message_id:
+        return message_id
+    parts = [*(mailbox or ()), email_data.get("UIDVALIDITY"), email_data["UID"]]
+    return "uid:" + hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def insert_ticket_from_email(conn, email_data, assigned_employee_id=None, priority=INGEST_PRIORITY):
+    """
+    Legt Kunde (falls neu) und Ticket für eine E-Mail in der Transaktion des Aufrufers an.
+    Gibt die ID des neuen Tickets zurück.
+    """
+    kunde_id = resolve_customer_id(conn, email_data["Von"])
+
+    # Create ticket with extended fields
+    result = conn.execute(INSERT_TICKET_QUERY, _ticket_params(email_data, kunde_id, assigned_employee_id, priority))
+    ticket_id = result.lastrowid
+    link_attachments(conn, ticket_id, email_data.get("Anhänge"))
+    record_message_ids(conn, ticket_id, [normalize_message_id(email_data.get("Message-ID"))], DIRECTION_INBOUND)
+    publish_change("ticket", ticket_id, ACTION_INSERT, conn=conn)
+    return ticket_id
+
+
+def claim_emails(conn, keys):
+    """
+    Beansprucht die Schlüssel in ticket_email_log in der Transaktion des Aufrufers
+    mit einem mehrzeiligen INSERT IGNORE. Gibt die Menge der beanspruchten Schlüssel zurück;
+    bereits eingetragene fehlen darin.
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return set()
+
+    params = {f"key_{i}": key for i, key in enumerate(keys)}
+    existing = {row.message_id for row in conn.execute(text(f"""
+        SELECT message_id FROM {EMAIL_LOG_TABLE} WHERE message_id IN ({', '.join(f':{key}' for key in params)})
+    """), params)}
+    to_claim = [key for key in keys if key not in existing]
+    if not to_claim:
+        return set()
+
+    params = {f"key_{i}": key for i, key in enumerate(to_claim)}
+    claimed = conn.execute(text(f"""
+        INSERT IGNORE INTO {EMAIL_LOG_TABLE} (message_id, erstellt_am)
+        VALUES {', '.join(f'(:{key}, CURRENT_TIMESTAMP)' for key in params)}
+    """), params).rowcount
+    if claimed != len(to_claim):
+        # Ein paralleler Abgleich hat einen Teil inzwischen beansprucht; welchen, ist nicht erkennbar
+        raise RuntimeError("E-Mails werden gerade parallel verarbeitet, bitte erneut versuchen")
+    return set(to_claim)
+
+
+def insert_tickets_from_emails(conn, emails, assigned_employee_id=None, priority=INGEST_PRIORITY, mailbox=None):
+    """
+    Legt Tickets für viele E-Mails in der Transaktion des Aufrufers an: eine Abfrage
+    für die Kunden, ein Insert für neue Kunden und ein gemeinsamer Insert für alle
+    Tickets ohne Anhänge und ohne Message-ID.
+    Antworten auf bestehende Tickets werden stattdessen als Kommentar angehängt.
+    Die E-Mails werden wie beim Hintergrund-Abgleich in ticket_email_log beansprucht;
+    bereits verarbeitete werden übersprungen.
+
+    Args:
+        mailbox: (Konto, Server, Ordner) des Postfachs, für E-Mails ohne Message-ID
+
+    Returns:
+        Pro E-Mail ein Tupel (Ergebnis, Ticket-ID) mit Ergebnis "created", "replied" oder
+        "skipped"; die Ticket-ID fehlt (None) bei "skipped" und bei gemeinsam angelegten Tickets
+    """
+    if not emails:
+        return []
+
+    keys = [email_dedup_key(email_data, mailbox) for email_data in emails]
+    claimed = claim_emails(conn, keys)
+    # Doppelt ausgewählte E-Mails nur einmal umwandeln
+    first_index = {}
+    for i, key in enumerate(keys):
+        first_index.setdefault(key, i)
+    pending = [i for i, key in enumerate(keys) if key in claimed and first_index[key] == i]
+
+    outcomes = [("skipped", None)] * len(emails)
+    if not pending:
+        return outcomes
+
+    thread_ids = find_thread_tickets(conn, [emails[i] for i in pending])
+    new_indexes = []
+    for i, thread_id in zip(pending, thread_ids):
+        if thread_id is not None:
+            append_reply(conn, thread_id, emails[i])
+            outcomes[i] = ("replied", thread_id)
+        else:
+            new_indexes.append(i)
+            outcomes[i] = ("created", None)
+
+    if not new_indexes:
+        return outcomes
+
+    customer_ids = resolve_customer_ids(conn, [emails[i]["Von"] for i in new_indexes])
+
+    # Einzeln, wenn die Ticket-ID gebraucht wird: für Anhänge und für den Message-ID-Index,
+    # über den spätere Antworten des Kunden ihrem Ticket zugeordnet werden. Ein gemeinsamer
+    # Insert liefert nur die erste ID, und fortlaufende IDs garantiert MySQL dafür nicht.
+    needs_id = [i for i in new_indexes
+                if emails[i].get("Anhänge") or normalize_message_id(emails[i].get("Message-ID"))]
+    batched = sorted(set(new_indexes) - set(needs_id))
+
+    if batched:
+        conn.execute(INSERT_TICKET_QUERY, [
+            _ticket_params(emails[i], customer_ids[emails[i]["Von"]], assigned_employee_id, priority)
+            for i in batched
+        ])
+    for i in needs_id:
+        email_data = emails[i]
+        result = conn.execute(INSERT_TICKET_QUERY, _ticket_params(
+            email_data, customer_ids[email_data["Von"]], assigned_employee_id, priority))
+        link_attachments(conn, result.lastrowid, email_data.get("Anhänge"))
+        record_message_ids(conn, result.lastrowid, [normalize_message_id(email_data.get("Message-ID"))], DIRECTION_INBOUND)
+        outcomes[i] = ("created", result.lastrowid)
+
+    publish_change("ticket", None, ACTION_INSERT, conn=conn)
+    return outcomes
+
+
+def convert_email(engine, email_data, assigned_employee_id=None, priority=INGEST_PRIORITY, mailbox=None):
+    """
+    Wandelt eine E-Mail in ein Ticket um, sofern sie noch nicht verarbeitet wurde.
+    Antworten auf bestehende Tickets werden als Kommentar angehängt.
+
+    Args:
+        mailbox: (Konto, Server, Ordner) des Postfachs, für E-Mails ohne Message-ID
+
+    Gibt "created", "replied", "skipped" oder "failed" zurück.
+    """
+    msg_id = email_dedup_key(email_data, mailbox)
+    if email_data.get("Unvollständig"):
+        # Nicht beanspruchen: die Nachricht bleibt über email_sync_retry zur manuellen Bearbeitung sichtbar
+        logger.error("E-Mail %s von %s: Inhalt konnte nicht geladen werden, keine Umwandlung", msg_id, email_data.get("Von"))
+        return "failed"
+    try:
+        with engine.begin() as conn:
+            # E-Mail beanspruchen; bei einem Fehler wird der Eintrag mit dem Ticket zurückgerollt
+            claimed = conn.execute(text(f"""
+                INSERT IGNORE INTO {EMAIL_LOG_TABLE} (message_id, erstellt_am)
+                VALUES (:msg_id, CURRENT_TIMESTAMP)
+            """), {"msg_id": msg_id}).rowcount
+            if not claimed:
+                return "skipped"
+
+            thread_id = find_thread_ticket(conn, email_data)
+            if thread_id is not None:
+                append_reply(conn, thread_id, email_data)
+                return "replied"
+
+            insert_ticket_from_email(conn, email_data, assigned_employee_id, priority)
+    except Exception as e:
+        logger.error("Ticket aus E-Mail %s konnte nicht erstellt werden: %s", msg_id, e)
+        return "failed"
+
+    bump_status_count(None, INGEST_STATUS_ID)
+    return "created"
+
+
+def run_ingestion(engine, mailbox_config):
+    """
+    Gleicht ein Postfach ab und wandelt neue E-Mails in Tickets um.
+
+    Args:
+        mailbox_config: Dictionary mit email, password, imap_server und optional email_limit
+                        und timeout (Socket-Timeout und Zeitbudget des Laufs in Sekunden)
+
+    Returns:
+        Kennzahlen des Laufs (fetched, created, replied, skipped, failed, seconds)
+    """
+    started = time.monotonic()
+    metrics = {"created": 0, "replied": 0, "skipped": 0, "failed": 0}
+
+    # Caches (z.B. Kunden-Zuordnungen) auch im eigenständigen Prozess aktuell halten
+    sync_change_feed()
+
+    def on_message(email_data):
+        outcome = convert_email(engine, email_data, mailbox=mailbox_key(mailbox_config))
+        metrics[outcome] += 1
+        return outcome != "failed"
+
+    stats = sync_mailbox(
+        engine,
+        mailbox_config["email"],
+        mailbox_config["password"],
+        mailbox_config.get("imap_server") or DEFAULT_IMAP_SERVER,
+        folder=mailbox_config.get("folder") or DEFAULT_FOLDER,
+        on_message=on_message,
+        initial_backlog=mailbox_config.get("email_limit", 10),
+        timeout=mailbox_config.get("timeout"),
+        deadline=started + mailbox_config["timeout"] if mailbox_config.get("timeout") else None
+    )
+
+    metrics["fetched"] = stats["fetched"]
+    metrics["seconds"] = round(time.monotonic() - started, 2)
+    logger.info("Postfach %s/%s: %d abgerufen, %d Tickets erstellt, %d Antworten zugeordnet, %d übersprungen, "
+                "%d Fehler (%.2f s)", mailbox_config["email"], mailbox_config.get("folder") or DEFAULT_FOLDER,
+                metrics["fetched"], metrics["created"], metrics["replied"], metrics["skipped"], metrics["failed"],
+                metrics["seconds"])
+    return metrics
+
+
+def _run_claimed(engine, mailbox_config, key):
+    try:
+        return run_ingestion(engine, mailbox_config)
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(key)
+
+
+def poll_mailboxes(engine, mailboxes, max_workers=MAX_POLL_WORKERS, timeout=MAILBOX_TIMEOUT):
+    """
+    Gleicht mehrere Postfächer gleichzeitig ab. Die Gesamtdauer entspricht dem
+    langsamsten Postfach, höchstens aber timeout (plus Abschluss laufender Stapel).
+    Postfächer, deren voriger Abgleich noch läuft, werden übersprungen.
+
+    Returns:
+        Dictionary (Konto, Server, Ordner) -> Kennzahlen von run_ingestion oder {"error": ...}
+    """
+    results = {}
+    claimed = []
+    with _in_flight_lock:
+        for config in mailboxes:
+            key = mailbox_key(config)
+            if key in _in_flight:
+                logger.warning("Abgleich von %s/%s läuft noch, wird übersprungen", key[0], key[2])
+                results[key] = {"error": "Voriger Abgleich läuft noch", "at": time.time()}
+            else:
+                _in_flight.add(key)
+                claimed.append((key, config))
+    if not claimed:
+        return results
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(claimed)), thread_name_prefix="mail-poll")
+    futures = {}
+    for key, config in claimed:
+        # Das Socket-Timeout bricht hängende Verbindungen ab, das Zeitbudget beendet
+        # den Lauf nach dem laufenden Stapel; bis dahin bleibt das Postfach belegt
+        futures[executor.submit(_run_claimed, engine, {**config, "timeout": timeout}, key)] = key
+
+    done, not_done = wait(futures, timeout=timeout)
+    for future in done:
+        key = futures[future]
+        try:
+            results[key] = {**future.result(), "at": time.time()}
+        except Exception as e:
+            logger.error("Abgleich von %s/%s fehlgeschlagen: %s", key[0], key[2], e)
+            results[key] = {"error": str(e), "at": time.time()}
+    for future in not_done:
+        key = futures[future]
+        logger.warning("Abgleich von %s/%s nach %d s nicht abgeschlossen", key[0], key[2], timeout)
+        results[key] = {"error": f"Zeitüberschreitung nach {timeout} s", "at": time.time()}
+        if future.cancel():
+            # Nie gestartet: Postfach sofort wieder freigeben
+            with _in_flight_lock:
+                _in_flight.discard(key)
+
+    # Nicht auf hängende Postfächer warten
+    executor.shutdown(wait=False)
+    return results
+
+
+class MailIngestScheduler(threading.Thread):
+    """Hintergrund-Thread, der alle registrierten Postfächer periodisch abgleicht."""
+
+    def __init__(self, engine, interval=INGEST_POLL_INTERVAL, use_registry=True):
+        super().__init__(name="mail-ingest", daemon=True)
+        self.engine = engine
+        self.interval = interval
+        self.use_registry = use_registry
+        # (Konto, Server, Ordner) -> Konfiguration, zusätzlich zum Postfach-Register
+        self.mailboxes = {}
+        self.last_metrics = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def add_mailbox(self, mailbox_config):
+        """
+        Nimmt ein Postfach außerhalb des Registers auf (z.B. --email der Kommandozeile).
+        Die Zugangsdaten bleiben bis zum Ende des Prozesses im Speicher; die Oberfläche
+        registriert Postfächer deshalb nur über email_postfach.
+        """
+        with self.lock:
+            self.mailboxes[mailbox_key(mailbox_config)] = dict(mailbox_config)
+
+    def run_once(self):
+        with self.lock:
+            mailboxes = dict(self.mailboxes)
+        if self.use_registry:
+            try:
+                for config in load_mailboxes(self.engine):
+                    mailboxes.setdefault(mailbox_key(config), config)
+            except Exception as e:
+                logger.error("Postfach-Register konnte nicht gelesen werden: %s", e)
+        self.last_metrics.update(poll_mailboxes(self.engine, list(mailboxes.values())))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.run_once()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def get_ingest_scheduler(interval=INGEST_POLL_INTERVAL):
+    """Gibt den Scheduler des Prozesses zurück und startet ihn bei Bedarf."""
+    global _scheduler
+    from Main import engine
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = MailIngestScheduler(engine, interval)
+            _scheduler.start()
+        return _scheduler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Wandelt neue E-Mails ohne Benutzeroberfläche in Tickets um.")
+    parser.add_argument("--email", default=os.environ.get("TICKET_MAIL_EMAIL"),
+                        help="Zusätzliches IMAP-Konto außerhalb des Postfach-Registers")
+    parser.add_argument("--password", default=os.environ.get("TICKET_MAIL_PASSWORD"),
+                        help="App-Passwort (Standard: Umgebungsvariable TICKET_MAIL_PASSWORD)")
+    parser.add_argument("--imap-server", default=os.environ.get("TICKET_MAIL_IMAP_SERVER", DEFAULT_IMAP_SERVER))
+    parser.add_argument("--folder", default=DEFAULT_FOLDER)
+    parser.add_argument("--no-registry", action="store_true", help="Postfach-Register nicht verwenden")
+    parser.add_argument("--interval", type=int, default=INGEST_POLL_INTERVAL, help="Abrufintervall in Sekunden")
+    parser.add_argument("--once", action="store_true", help="Nur einen Abgleich ausführen und beenden")
+    args = parser.parse_args(argv)
+
+    if args.email and not args.password:
+        parser.error("--password (oder TICKET_MAIL_PASSWORD) ist für --email erforderlich")
+    if args.no_registry and not args.email:
+        parser.error("--email ist ohne Postfach-Register erforderlich")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    from Main import engine
+
+    # Der eigenständige Prozess darf nicht darauf angewiesen sein, dass die Oberfläche schon lief
+    ensure_change_event_table()
+    if not ensure_mail_tables():
+        logger.error("Tabellen für den E-Mail-Eingang konnten nicht angelegt werden")
+        return 1
+
+    scheduler = MailIngestScheduler(engine, args.interval, use_registry=not args.no_registry)
+    if args.email:
+        scheduler.add_mailbox({"email": args.email, "password": args.password,
+                               "imap_server": args.imap_server, "folder": args.folder})
+    if args.once:
+        scheduler.run_once()
+        return
+
+    try:
+        # Im Vordergrund laufen, damit Strg+C den Dienst sauber beendet
+        scheduler.run()
+    except KeyboardInterrupt:
+        logger.info("Beendet.")
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,273 @@
+import base64
+import quopri
+from email.header import decode_header, make_header
+from urllib.parse import unquote
+from TicketAttachments import MAX_ATTACHMENT_SIZE, MAX_ATTACHMENTS_PER_MESSAGE, store_stream
+
+# ==============================================================================
+# EINZELNE TEILE GROSSER NACHRICHTEN ABRUFEN
+# ==============================================================================
+# Nachrichten über MAX_MESSAGE_SIZE (TicketMailSync) werden nicht vollständig
+# heruntergeladen. Stattdessen wird ihre BODYSTRUCTURE gelesen und der Textteil
+# per BODY.PEEK[<teil>] abgerufen. Anhänge werden in Teilbereichen
+# (BODY.PEEK[<teil>]<start.länge>) geladen, dekodiert und direkt in die
+# Dateiablage geschrieben; im Speicher liegt dabei nie mehr als ein Teilbereich.
+
+# Vom Textteil wird höchstens so viel geladen; gespeichert werden ohnehin nur
+# MAX_DESCRIPTION_LENGTH Zeichen (TicketMailBody)
+MAX_TEXT_PART_BYTES = 256 * 1024
+
+# Größe der Teilbereiche beim Laden von Anhängen
+PART_CHUNK_BYTES = 1024 * 1024
+
+
+class ImapResponseError(Exception):
+    """Antwort des IMAP-Servers konnte nicht gelesen werden."""
+
+
+def _parse(data, pos):
+    """Liest einen Wert einer IMAP-Antwort ab pos. Gibt (Wert, neue Position) zurück."""
+    while pos < len(data) and data[pos:pos + 1] == b" ":
+        pos += 1
+    if pos >= len(data):
+        raise ImapResponseError("Unerwartetes Ende der Antwort")
+
+    char = data[pos:pos + 1]
+    if char == b"(":
+        values = []
+        pos += 1
+        while True:
+            while data[pos:pos + 1] == b" ":
+                pos += 1
+            if data[pos:pos + 1] == b")":
+                return values, pos + 1
+            value, pos = _parse(data, pos)
+            values.append(value)
+    if char == b'"':
+        chars = bytearray()
+        pos += 1
+        while data[pos:pos + 1] != b'"':
+            if data[pos:pos + 1] == b"\\":
+                pos += 1
+            if pos >= len(data):
+                raise ImapResponseError("Unvollständige Zeichenkette")
+            chars += data[pos:pos + 1]
+            pos += 1
+        return chars.decode("utf-8", errors="replace"), pos + 1
+    if char == b"{":
+        end = data.index(b"}", pos)
+        length = int(data[pos + 1:end])
+        # imaplib liefert den Literal-Inhalt direkt nach "{n}", ohne Zeilenumbruch
+        return bytes(data[end + 1:end + 1 + length]), end + 1 + length
+
+    end = pos
+    depth = 0
+    # Atome wie BODY[1.2]<0> enthalten Klammern, die nicht zur Liste gehören
+    while end < len(data) and (depth or data[end:end + 1] not in (b" ", b"(", b")")):
+        if data[end:end + 1] == b"[":
+            depth += 1
+        elif data[end:end + 1] == b"]":
+            depth -= 1
+        end += 1
+    atom = data[pos:end].decode("ascii", errors="replace")
+    return (None if atom.upper() == "NIL" else atom), end
+
+
+def parse_fetch_response(data):
+    """
+    Wandelt die Antwort von imaplib auf UID FETCH in ein Dictionary um,
+    z.B. {"UID": "12", "BODYSTRUCTURE": [...], "BODY[1]": b"..."}.
+    """
+    raw = b"".join(part[0] + part[1] if isinstance(part, tuple) else part for part in data if part is not None)
+    start = raw.find(b"(")
+    if start < 0:
+        raise ImapResponseError("Keine FETCH-Daten in der Antwort")
+    values, _ = _parse(raw, start)
+    result = {}
+    for key, value in zip(values[0::2], values[1::2]):
+        # Teilbereiche werden als BODY[1]<0> bestätigt
+        result[key.upper().split("<")[0]] = value
+    return result
+
+
+def uid_fetch(mailbox, uid, items):
+    """Führt UID FETCH über die imaplib-Verbindung von imap_tools aus."""
+    typ, data = mailbox.client.uid("FETCH", str(uid), items)
+    if typ != "OK" or not data or data[0] is None:
+        raise ImapResponseError(f"UID FETCH {uid} {items} fehlgeschlagen: {typ}")
+    return parse_fetch_response(data)
+
+
+def _params(values):
+    if not isinstance(values, list):
+        return {}
+    return {str(key).lower(): value for key, value in zip(values[0::2], values[1::2]) if key is not None}
+
+
+def _decode_filename(params, key="filename"):
+    """Dateiname aus filename (RFC 2047) oder filename* (RFC 2231)."""
+    try:
+        if params.get(f"{key}*"):
+            # charset'sprache'prozentkodierter-wert
+            charset, _, rest = params[f"{key}*"].partition("'")
+            return unquote(rest.partition("'")[2] or charset, encoding=charset if rest else "utf-8", errors="replace")
+        if params.get(key):
+            return str(make_header(decode_header(params[key])))
+    except Exception:
+        return params.get(key)
+    return None
+
+
+def _leaf(structure, part):
+    main_type = (structure[0] or "").lower()
+    sub_type = (structure[1] or "").lower()
+    params = _params(structure[2])
+    content_type = f"{main_type}/{sub_type}"
+    # Position der Erweiterungsdaten hängt vom Typ ab (RFC 3501, body-type-1part)
+    if content_type == "message/rfc822":
+        disposition_index = 11
+    elif main_type == "text":
+        disposition_index = 9
+    else:
+        disposition_index = 8
+    disposition = structure[disposition_index] if len(structure) > disposition_index else None
+    disposition_type = (disposition[0] or "").lower() if isinstance(disposition, list) and disposition else None
+    disposition_params = _params(disposition[1]) if isinstance(disposition, list) and len(disposition) > 1 else {}
+    try:
+        size = int(structure[6] or 0)
+    except (TypeError, ValueError):
+        size = 0
+    return {
+        "part": part,
+        "content_type": content_type,
+        "charset": params.get("charset") or "utf-8",
+        "encoding": (structure[5] or "7bit").lower(),
+        "size": size,
+        "disposition": disposition_type,
+        "filename": _decode_filename(disposition_params) or _decode_filename(params, "name"),
+    }
+
+
+def flatten_bodystructure(structure, prefix=""):
+    """Gibt die einzelnen Teile einer BODYSTRUCTURE mit ihren Teilnummern (z.B. "1.2") zurück."""
+    if structure and isinstance(structure[0], list):
+        leaves = []
+        for i, child in enumerate(structure):
+            # Auf die Teile folgen Untertyp und Erweiterungsdaten (die ebenfalls Listen sein können)
+            if not isinstance(child, list):
+                break
+            leaves.extend(flatten_bodystructure(child, f"{prefix}{i + 1}."))
+        return leaves
+    return [_leaf(structure, prefix.rstrip(".") or "1")]
+
+
+def decode_transfer_encoding(data, encoding):
+    """Dekodiert base64 und quoted-printable; andere Kodierungen bleiben unverändert."""
+    if encoding == "base64":
+        compact = b"".join(data.split())
+        return base64.b64decode(compact[:len(compact) - len(compact) % 4])
+    if encoding == "quoted-printable":
+        return quopri.decodestring(data)
+    return data
+
+
+def _as_bytes(value):
+    if value is None:
+        return b""
+    return value if isinstance(value, bytes) else value.encode("utf-8")
+
+
+def fetch_text_parts(mailbox, uid, max_bytes=MAX_TEXT_PART_BYTES):
+    """
+    Lädt nur Text- und HTML-Teil einer Nachricht, ohne Anhänge.
+
+    Returns:
+        (Text, HTML, Liste der übrigen Teile aus flatten_bodystructure, z.B. für store_part_attachments)
+    """
+    structure = uid_fetch(mailbox, uid, "(BODYSTRUCTURE)").get("BODYSTRUCTURE")
+    if not isinstance(structure, list):
+        raise ImapResponseError(f"Keine BODYSTRUCTURE für Nachricht {uid}")
+
+    texts = {}
+    others = []
+    for leaf in flatten_bodystructure(structure):
+        is_body = leaf["content_type"] in ("text/plain", "text/html") and leaf["disposition"] != "attachment"
+        if is_body and leaf["content_type"] not in texts:
+            section = f"BODY[{leaf['part']}]"
+            response = uid_fetch(mailbox, uid, f"(BODY.PEEK[{leaf['part']}]<0.{max_bytes}>)")
+            raw = decode_transfer_encoding(_as_bytes(response.get(section)), leaf["encoding"])
+            try:
+                texts[leaf["content_type"]] = raw.decode(leaf["charset"], errors="replace")
+            except LookupError:
+                texts[leaf["content_type"]] = raw.decode("utf-8", errors="replace")
+        else:
+            others.append(leaf)
+
+    if not texts:
+        raise ImapResponseError(f"Nachricht {uid} enthält keinen Textteil")
+    return texts.get("text/plain", ""), texts.get("text/html"), others
+
+
+def _decode_stream(chunks, encoding):
+    """Dekodiert Teilbereiche fortlaufend; unvollständige base64-Gruppen und QP-Zeilen werden mitgeführt."""
+    rest = b""
+    if encoding == "base64":
+        for chunk in chunks:
+            data = rest + b"".join(chunk.split())
+            usable = len(data) - len(data) % 4
+            rest = data[usable:]
+            yield base64.b64decode(data[:usable])
+        if rest:
+            yield base64.b64decode(rest + b"=" * (-len(rest) % 4))
+    elif encoding == "quoted-printable":
+        for chunk in chunks:
+            data = rest + chunk
+            cut = data.rfind(b"\n") + 1
+            rest = data[cut:]
+            yield quopri.decodestring(data[:cut])
+        if rest:
+            yield quopri.decodestring(rest)
+    else:
+        yield from chunks
+
+
+def iter_part_chunks(mailbox, uid, part, chunk_size=PART_CHUNK_BYTES):
+    """Lädt einen Teil der Nachricht in Teilbereichen von chunk_size Bytes (noch kodiert)."""
+    offset = 0
+    while True:
+        response = uid_fetch(mailbox, uid, f"(BODY.PEEK[{part}]<{offset}.{chunk_size}>)")
+        chunk = _as_bytes(response.get(f"BODY[{part}]"))
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        offset += len(chunk)
+
+
+def store_part_attachments(mailbox, uid, leaves, max_size=MAX_ATTACHMENT_SIZE, max_count=MAX_ATTACHMENTS_PER_MESSAGE):
+    """
+    Legt die übergebenen Teile einer Nachricht in Teilbereichen in der Dateiablage ab.
+
+    Returns:
+        (Beschreibungen wie bei store_message_attachments, nicht übernommene Teile)
+    """
+    refs, skipped = [], []
+    for leaf in leaves:
+        # base64 ist etwa ein Drittel größer als der Inhalt
+        decoded_size = leaf["size"] * 3 // 4 if leaf["encoding"] == "base64" else leaf["size"]
+        if len(refs) >= max_count or decoded_size > max_size:
+            skipped.append(leaf)
+            continue
+        stored = store_stream(_decode_stream(iter_part_chunks(mailbox, uid, leaf["part"]), leaf["encoding"]), max_size)
+        if stored is None:
+            skipped.append(leaf)
+            continue
+        content_hash, size = stored
+        default_name = "nachricht.eml" if leaf["content_type"] == "message/rfc822" else "anhang"
+        refs.append({
+            "Dateiname": (leaf["filename"] or default_name)[:255],
+            "Content_Type": leaf["content_type"],
+            "Größe": size,
+            "Hash": content_hash,
+        })
+    return refs, skipped
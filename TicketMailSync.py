@@ -0,0 +1,343 @@
+import time
+from datetime import datetime
+from imap_tools import MailBox, AND
+from sqlalchemy import text
+from TicketAttachments import store_message_attachments, store_text_attachment
+from TicketMailBody import normalize_email_body
+from TicketMailParts import fetch_text_parts, store_part_attachments
+from TicketMailThreads import parse_message_id_list
+
+# ==============================================================================
+# INKREMENTELLER IMAP-ABGLEICH
+# ==============================================================================
+# Pro Konto und Ordner werden UIDVALIDITY und die höchste verarbeitete UID in
+# email_sync_state gespeichert. Ein Abruf fragt nur die UIDs oberhalb dieser
+# Marke ab und lädt die Nachrichten in begrenzten Stapeln. Nach jedem Stapel
+# wird die Marke fortgeschrieben, ein abgebrochener Lauf setzt also dort fort.
+# Ändert sich UIDVALIDITY, sind alle gespeicherten UIDs ungültig und der Ordner
+# wird neu eingelesen; doppelte Tickets verhindert dabei der eindeutige Schlüssel
+# auf ticket_email_log (siehe TicketMailIngest).
+
+SYNC_STATE_TABLE = "email_sync_state"
+SYNC_RETRY_TABLE = "email_sync_retry"
+
+SYNC_BATCH_SIZE = 50
+
+# Nach so vielen Fehlversuchen hält eine Nachricht die Marke nicht mehr auf
+MAX_SYNC_ATTEMPTS = 3
+# Danach bleibt sie nur noch zur manuellen Prüfung in email_sync_retry stehen
+MAX_RETRY_ATTEMPTS = 20
+
+# Beim ersten Abgleich (oder nach einem UIDVALIDITY-Wechsel) nur die neuesten Nachrichten übernehmen
+INITIAL_SYNC_BACKLOG = 10
+
+# Nachrichten werden in zwei Schritten geladen: erst nur die Kopfzeilen, dann der
+# Inhalt nur für Nachrichten, die geöffnet oder umgewandelt werden. Kleine
+# Nachrichten werden vollständig in Abrufen von höchstens FETCH_BATCH_BYTES
+# geladen, größere Teil für Teil, ihre Anhänge in Teilbereichen direkt in die
+# Dateiablage (TicketMailParts). Texte normalisiert TicketMailBody.
+MAX_MESSAGE_SIZE = 2 * 1024 * 1024
+FETCH_BATCH_BYTES = 8 * 1024 * 1024
+
+
+def ensure_sync_state_table():
+    """Legt die Tabelle für die Abgleich-Marken an, falls sie fehlt."""
+    from Main import engine
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {SYNC_STATE_TABLE} (
+                    Konto VARCHAR(190) NOT NULL,
+                    Server VARCHAR(190) NOT NULL,
+                    Ordner VARCHAR(190) NOT NULL,
+                    UIDVALIDITY BIGINT NOT NULL,
+                    Letzte_UID BIGINT NOT NULL,
+                    Aktualisiert_am DATETIME NOT NULL,
+                    PRIMARY KEY (Konto, Server, Ordner)
+                )
+            """))
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {SYNC_RETRY_TABLE} (
+                    Konto VARCHAR(190) NOT NULL,
+                    Server VARCHAR(190) NOT NULL,
+                    Ordner VARCHAR(190) NOT NULL,
+                    UIDVALIDITY BIGINT NOT NULL,
+                    UID BIGINT NOT NULL,
+                    Versuche INT NOT NULL,
+                    Letzter_Versuch_am DATETIME NOT NULL,
+                    PRIMARY KEY (Konto, Server, Ordner, UID)
+                )
+            """))
+        return True
+    except Exception as e:
+        print(f"FEHLER: Tabellen {SYNC_STATE_TABLE}/{SYNC_RETRY_TABLE} konnten nicht angelegt werden: {str(e)}")
+        return False
+
+
+def message_to_email_header(msg):
+    """Kopfdaten einer Nachricht für Listen, ohne Inhalt."""
+    return {
+        "Von": msg.from_,
+        "Betreff": msg.subject,
+        "Datum": msg.date.strftime("%d.%m.%Y %H:%M"),
+        "Größe": msg.size_rfc822,
+        "UID": msg.uid,  # Nur innerhalb des Ordners und der UIDVALIDITY eindeutig
+        "Message-ID": (msg.headers.get("message-id") or ("",))[0].strip(),
+        # Verweise auf frühere Nachrichten, für die Zuordnung von Antworten zu Tickets
+        "In-Reply-To": parse_message_id_list(" ".join(msg.headers.get("in-reply-to", ()))),
+        "References": parse_message_id_list(" ".join(msg.headers.get("references", ()))),
+    }
+
+
+def build_email_data(header, plain_text, html, attachments):
+    """
+    Ergänzt die Kopfdaten um den normalisierten Text und die Anhang-Beschreibungen.
+    Wurde beim Normalisieren Inhalt entfernt, wird das Original als Anhang abgelegt.
+    """
+    body, lost_content = normalize_email_body(plain_text, html)
+
+    if lost_content:
+        if html:
+            original = store_text_attachment(html, "originalnachricht.html", "text/html")
+        else:
+            original = store_text_attachment(plain_text or "", "originalnachricht.txt")
+        if original is not None:
+            attachments.append(original)
+
+    return {**header, "Nachricht": body, "Anhänge": attachments}
+
+
+def message_to_email_data(msg):
+    """
+    Wandelt eine imap_tools-Nachricht in das Dictionary um, das die Ticket-Erstellung erwartet.
+    Anhänge werden dabei in der Dateiablage abgelegt, im Dictionary stehen nur ihre Beschreibungen.
+    """
+    return build_email_data(message_to_email_header(msg), msg.text, msg.html, store_message_attachments(msg))
+
+
+def large_message_to_email_data(mailbox, header):
+    """
+    Lädt eine Nachricht über MAX_MESSAGE_SIZE Teil für Teil: den Text vollständig, die
+    Anhänge in Teilbereichen direkt in die Dateiablage. Nicht übernommene Anhänge (zu groß
+    oder zu viele) werden im Text vermerkt. Lässt sich kein Text laden, wird die Nachricht
+    als "Unvollständig" markiert; sie wird dann nicht in ein Ticket umgewandelt.
+    """
+    try:
+        plain_text, html, others = fetch_text_parts(mailbox, header["UID"])
+    except Exception as e:
+        print(f"FEHLER: Text der Nachricht {header['UID']} ({(header.get('Größe') or 0) // 1024} KB) "
+              f"konnte nicht geladen werden: {str(e)}")
+        return {**header, "Nachricht": "[Inhalt konnte nicht geladen werden, bitte manuell bearbeiten]",
+                "Anhänge": [], "Unvollständig": True}
+
+    try:
+        attachments, skipped_parts = store_part_attachments(mailbox, header["UID"], others)
+    except Exception as e:
+        print(f"FEHLER: Anhänge der Nachricht {header['UID']} konnten nicht geladen werden: {str(e)}")
+        return {**header, "Nachricht": "[Anhänge konnten nicht geladen werden, bitte manuell bearbeiten]",
+                "Anhänge": [], "Unvollständig": True}
+
+    email_data = build_email_data(header, plain_text, html, attachments)
+    skipped = [f"{leaf['filename'] or leaf['content_type']} ({leaf['size'] // 1024} KB)" for leaf in skipped_parts]
+    if skipped:
+        email_data["Nachricht"] += "\n\n[Anhänge nicht übernommen: " + ", ".join(skipped) + "]"
+    return email_data
+
+
+def _size_batches(headers, max_bytes):
+    """Teilt Kopfdaten in Gruppen auf, deren Nachrichten zusammen höchstens max_bytes groß sind."""
+    batch, batch_size = [], 0
+    for header in headers:
+        size = header.get("Größe") or 0
+        if batch and batch_size + size > max_bytes:
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(header["UID"])
+        batch_size += size
+    if batch:
+        yield batch
+
+
+def fetch_message_bodies(mailbox, headers, max_size=MAX_MESSAGE_SIZE, batch_bytes=FETCH_BATCH_BYTES):
+    """
+    Lädt zu bereits abgerufenen Kopfdaten die Inhalte nach: kleine Nachrichten in
+    Abrufen von höchstens batch_bytes, Nachrichten über max_size Teil für Teil.
+    """
+    small = [header for header in headers if (header.get("Größe") or 0) <= max_size]
+
+    loaded = {}
+    for uids in _size_batches(small, batch_bytes):
+        for msg in mailbox.fetch(AND(uid=uids), mark_seen=False, bulk=True):
+            loaded[msg.uid] = message_to_email_data(msg)
+
+    result = []
+    for header in headers:
+        email_data = loaded.get(header["UID"])
+        if email_data is None:
+            email_data = large_message_to_email_data(mailbox, header)
+        result.append(email_data)
+    return result
+
+
+def load_sync_state(engine, account, server, folder):
+    """Gibt (UIDVALIDITY, Letzte_UID) zurück oder (None, None), falls noch nie abgeglichen wurde."""
+    with engine.connect() as conn:
+        row = conn.execute(text(f"""
+            SELECT UIDVALIDITY, Letzte_UID FROM {SYNC_STATE_TABLE}
+            WHERE Konto = :account AND Server = :server AND Ordner = :folder
+        """), {"account": account, "server": server, "folder": folder}).fetchone()
+    return (row.UIDVALIDITY, row.Letzte_UID) if row else (None, None)
+
+
+def save_sync_state(engine, account, server, folder, uidvalidity, last_uid):
+    """Schreibt die Marke fort."""
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            INSERT INTO {SYNC_STATE_TABLE} (Konto, Server, Ordner, UIDVALIDITY, Letzte_UID, Aktualisiert_am)
+            VALUES (:account, :server, :folder, :uidvalidity, :last_uid, :now)
+            ON DUPLICATE KEY UPDATE UIDVALIDITY = VALUES(UIDVALIDITY), Letzte_UID = VALUES(Letzte_UID),
+                                    Aktualisiert_am = VALUES(Aktualisiert_am)
+        """), {
+            "account": account, "server": server, "folder": folder,
+            "uidvalidity": uidvalidity, "last_uid": last_uid, "now": datetime.now()
+        })
+
+
+def load_retry_uids(engine, account, server, folder, uidvalidity):
+    """
+    Gibt {UID: Versuche} der fehlgeschlagenen Nachrichten zurück. Einträge aus
+    einer früheren UIDVALIDITY sind ungültig und werden dabei entfernt.
+    """
+    params = {"account": account, "server": server, "folder": folder, "uidvalidity": uidvalidity}
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            DELETE FROM {SYNC_RETRY_TABLE}
+            WHERE Konto = :account AND Server = :server AND Ordner = :folder AND UIDVALIDITY <> :uidvalidity
+        """), params)
+        rows = conn.execute(text(f"""
+            SELECT UID, Versuche FROM {SYNC_RETRY_TABLE}
+            WHERE Konto = :account AND Server = :server AND Ordner = :folder
+        """), params).fetchall()
+    return {row.UID: row.Versuche for row in rows}
+
+
+def save_retry_state(engine, account, server, folder, uidvalidity, failed_uids, done_uids):
+    """Erhöht die Versuchszahl fehlgeschlagener UIDs und entfernt verarbeitete oder gelöschte."""
+    keys = {"account": account, "server": server, "folder": folder}
+    with engine.begin() as conn:
+        if failed_uids:
+            conn.execute(text(f"""
+                INSERT INTO {SYNC_RETRY_TABLE} (Konto, Server, Ordner, UIDVALIDITY, UID, Versuche, Letzter_Versuch_am)
+                VALUES (:account, :server, :folder, :uidvalidity, :uid, 1, :now)
+                ON DUPLICATE KEY UPDATE Versuche = Versuche + 1, Letzter_Versuch_am = VALUES(Letzter_Versuch_am)
+            """), [{**keys, "uidvalidity": uidvalidity, "uid": uid, "now": datetime.now()} for uid in failed_uids])
+        if done_uids:
+            params = {**keys, **{f"uid_{i}": uid for i, uid in enumerate(done_uids)}}
+            conn.execute(text(f"""
+                DELETE FROM {SYNC_RETRY_TABLE}
+                WHERE Konto = :account AND Server = :server AND Ordner = :folder
+                  AND UID IN ({', '.join(f':uid_{i}' for i in range(len(done_uids)))})
+            """), params)
+
+
+def _process_batch(mailbox, batch, uidvalidity, on_message, stats):
+    """Lädt einen Stapel und übergibt die Nachrichten an on_message. Gibt die fehlgeschlagenen UIDs zurück."""
+    headers = [message_to_email_header(msg) for msg in mailbox.fetch(
+        AND(uid=[str(uid) for uid in batch]), mark_seen=False, headers_only=True, bulk=True)]
+    headers.sort(key=lambda header: int(header["UID"]))
+    failed = []
+    for email_data in fetch_message_bodies(mailbox, headers):
+        stats["fetched"] += 1
+        # Die UID allein ist nur innerhalb dieser UIDVALIDITY eindeutig
+        email_data["UIDVALIDITY"] = uidvalidity
+        try:
+            ok = on_message(email_data) if on_message else True
+        except Exception as e:
+            print(f"FEHLER: Nachricht {email_data['UID']} konnte nicht verarbeitet werden: {str(e)}")
+            ok = False
+        stats["processed" if ok else "failed"] += 1
+        if not ok:
+            failed.append(int(email_data["UID"]))
+    return failed
+
+
+def sync_mailbox(engine, email, password, imap_server="imap.gmail.com", folder="INBOX", on_message=None,
+                 batch_size=SYNC_BATCH_SIZE, max_batches=None, initial_backlog=INITIAL_SYNC_BACKLOG, timeout=None,
+                 deadline=None):
+    """
+    Ruft nur die seit dem letzten Abgleich eingegangenen Nachrichten ab, dazu die
+    früher fehlgeschlagenen Nachrichten aus email_sync_retry.
+
+    Args:
+        on_message: on_message(email_data) wird für jede neue Nachricht aufgerufen, email_data
+                    enthält dabei auch die UIDVALIDITY des Ordners; gibt True zurück,
+                    wenn die Nachricht erfolgreich verarbeitet wurde
+        max_batches: Höchstens so viele Stapel pro Aufruf, der Rest folgt beim nächsten Abgleich
+        timeout: Socket-Timeout der IMAP-Verbindung in Sekunden
+        deadline: Zeitpunkt (time.monotonic()), nach dem kein weiterer Stapel begonnen wird
+
+    Returns:
+        Dictionary mit fetched, processed, failed und remaining
+    """
+    stats = {"fetched": 0, "processed": 0, "failed": 0, "remaining": 0}
+    stored_validity, last_uid = load_sync_state(engine, email, imap_server, folder)
+
+    with MailBox(imap_server, timeout=timeout).login(email, password, initial_folder=folder) as mailbox:
+        uidvalidity = mailbox.folder.status(folder, ["UIDVALIDITY"])["UIDVALIDITY"]
+
+        if stored_validity != uidvalidity:
+            # Erster Abgleich oder UIDs neu vergeben: nur die neuesten Nachrichten übernehmen
+            all_uids = sorted(int(uid) for uid in mailbox.uids("ALL"))
+            backlog = all_uids[-initial_backlog:] if initial_backlog else []
+            last_uid = backlog[0] - 1 if backlog else (all_uids[-1] if all_uids else 0)
+            save_sync_state(engine, email, imap_server, folder, uidvalidity, last_uid)
+
+        attempts = load_retry_uids(engine, email, imap_server, folder, uidvalidity)
+
+        # Unterhalb der Marke liegende Nachrichten, die den Ordner nicht mehr blockieren, erneut versuchen
+        retry_uids = sorted(uid for uid, count in attempts.items() if uid <= last_uid and count < MAX_RETRY_ATTEMPTS)
+        for batch in (retry_uids[i:i + batch_size] for i in range(0, len(retry_uids), batch_size)):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            failed = _process_batch(mailbox, batch, uidvalidity, on_message, stats)
+            # Auch UIDs, die der Server nicht mehr liefert, werden nicht weiter versucht
+            save_retry_state(engine, email, imap_server, folder, uidvalidity,
+                             failed, [uid for uid in batch if uid not in failed])
+            for uid in failed:
+                attempts[uid] += 1
+                if attempts[uid] >= MAX_RETRY_ATTEMPTS:
+                    print(f"FEHLER: Nachricht {uid} in {email}/{folder} nach {attempts[uid]} Versuchen aufgegeben")
+
+        # "n:*" liefert bei leerem Bereich die letzte Nachricht, daher zusätzlich filtern
+        new_uids = sorted(int(uid) for uid in mailbox.uids(f"UID {last_uid + 1}:*") if int(uid) > last_uid)
+
+        batches = [new_uids[i:i + batch_size] for i in range(0, len(new_uids), batch_size)]
+        if max_batches is not None:
+            stats["remaining"] = sum(len(batch) for batch in batches[max_batches:])
+            batches = batches[:max_batches]
+
+        for index, batch in enumerate(batches):
+            if deadline is not None and time.monotonic() >= deadline:
+                # Zeitbudget verbraucht: der Rest folgt beim nächsten Abgleich
+                stats["remaining"] += sum(len(rest) for rest in batches[index:])
+                break
+            failed = _process_batch(mailbox, batch, uidvalidity, on_message, stats)
+            save_retry_state(engine, email, imap_server, folder, uidvalidity,
+                             failed, [uid for uid in batch if uid in attempts and uid not in failed])
+            for uid in failed:
+                attempts[uid] = attempts.get(uid, 0) + 1
+
+            # Die Marke bleibt vor der ersten Nachricht stehen, die den Ordner noch blockieren darf.
+            # Danach schon verarbeitete Nachrichten überspringt beim nächsten Lauf ticket_email_log.
+            blocking = [uid for uid in failed if attempts[uid] < MAX_SYNC_ATTEMPTS]
+            if blocking:
+                last_uid = blocking[0] - 1
+                save_sync_state(engine, email, imap_server, folder, uidvalidity, last_uid)
+                stats["remaining"] += sum(len(rest) for rest in batches[index + 1:])
+                break
+
+            last_uid = batch[-1]
+            save_sync_state(engine, email, imap_server, folder, uidvalidity, last_uid)
+
+    return stats
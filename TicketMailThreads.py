@@ -0,0 +1,182 @@
+import hashlib
+import re
+from email.utils import getaddresses, parseaddr
+from sqlalchemy import text
+from TicketAttachments import link_attachments
+from TicketChanges import ACTION_INSERT, publish_change
+from TicketCustomers import lookup_customer_ids, normalize_email
+
+# ==============================================================================
+# ANTWORTEN BESTEHENDEN TICKETS ZUORDNEN
+# ==============================================================================
+# email_message_index ordnet jede gesendete und jede eingegangene Message-ID
+# ihrem Ticket zu. Eine eingehende E-Mail, die per In-Reply-To oder References
+# auf eine bekannte Nachricht verweist oder "Ticket #<id>" im Betreff trägt,
+# wird als Kommentar an dieses Ticket gehängt statt ein neues Ticket anzulegen.
+# Die Zuordnung ist eine Abfrage über den Primärschlüssel des Index.
+# Die Betreff-Kennung allein kann jeder schreiben; sie zählt nur, wenn der Absender
+# der Kunde des Tickets ist oder zu den Empfängern einer zum Ticket gesendeten
+# E-Mail gehört (Spalte Empfaenger der ausgehenden Einträge).
+
+MESSAGE_INDEX_TABLE = "email_message_index"
+MESSAGE_ID_MAX_LENGTH = 255
+RECIPIENTS_MAX_LENGTH = 1024
+
+DIRECTION_INBOUND = "ein"
+DIRECTION_OUTBOUND = "aus"
+
+# Nur die letzten Verweise prüfen; lange Threads listen sonst Dutzende IDs auf
+MAX_REFERENCES = 20
+
+TICKET_TOKEN_PATTERN = re.compile(r"Ticket\s*#(\d+)", re.IGNORECASE)
+MESSAGE_ID_PATTERN = re.compile(r"<([^<>\s]+)>")
+
+
+def ensure_message_index_table():
+    """Legt den Message-ID-Index an, falls er fehlt."""
+    from Main import engine, inspector
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {MESSAGE_INDEX_TABLE} (
+                    Message_ID VARCHAR({MESSAGE_ID_MAX_LENGTH}) NOT NULL PRIMARY KEY,
+                    ID_Ticket INT NOT NULL,
+                    Richtung VARCHAR(8) NOT NULL,
+                    Empfaenger VARCHAR({RECIPIENTS_MAX_LENGTH}) NULL,
+                    Erstellt_am DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    INDEX idx_message_index_ticket (ID_Ticket)
+                )
+            """))
+
+        # Ältere Tabellen: Empfänger ausgehender E-Mails für die Prüfung der Betreff-Kennung
+        if "Empfaenger" not in [column["name"] for column in inspector.get_columns(MESSAGE_INDEX_TABLE)]:
+            with engine.begin() as conn:
+                conn.execute(text(f"""
+                    ALTER TABLE {MESSAGE_INDEX_TABLE} ADD COLUMN Empfaenger VARCHAR({RECIPIENTS_MAX_LENGTH}) NULL
+                """))
+            inspector.clear_cache()
+        return True
+    except Exception as e:
+        print(f"FEHLER: Tabelle {MESSAGE_INDEX_TABLE} konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def normalize_message_id(value):
+    """Message-ID ohne spitze Klammern; zu lange IDs werden gehasht. Leere Werte ergeben None."""
+    message_id = (value or "").strip().strip("<>").strip()
+    if not message_id:
+        return None
+    if len(message_id) > MESSAGE_ID_MAX_LENGTH:
+        return "sha256:" + hashlib.sha256(message_id.encode("utf-8")).hexdigest()
+    return message_id
+
+
+def parse_message_id_list(value):
+    """Zerlegt den Wert von In-Reply-To oder References in einzelne Message-IDs."""
+    ids = MESSAGE_ID_PATTERN.findall(value or "")
+    if not ids and value and value.strip():
+        ids = value.split()
+    return [normalized for normalized in map(normalize_message_id, ids) if normalized]
+
+
+def parse_recipients(value):
+    """Normalisierte Adressen aus einem To/Cc-Wert wie "A <a@x.de>, b@y.de"."""
+    return list(dict.fromkeys(normalize_email(address) for _, address in getaddresses([value or ""]) if address))
+
+
+def record_message_ids(conn, ticket_id, message_ids, direction, recipients=None):
+    """
+    Trägt Message-IDs für ein Ticket in der Transaktion des Aufrufers in den Index ein.
+    recipients: Empfänger-Adressen ausgehender E-Mails
+    """
+    stored_recipients = ",".join(recipients)[:RECIPIENTS_MAX_LENGTH] if recipients else None
+    rows = [{"message_id": message_id, "ticket_id": ticket_id, "direction": direction, "recipients": stored_recipients}
+            for message_id in dict.fromkeys(filter(None, message_ids))]
+    if not rows:
+        return
+    conn.execute(text(f"""
+        INSERT IGNORE INTO {MESSAGE_INDEX_TABLE} (Message_ID, ID_Ticket, Richtung, Empfaenger)
+        VALUES (:message_id, :ticket_id, :direction, :recipients)
+    """), rows)
+
+
+def _reference_candidates(email_data):
+    # Der direkteste Verweis zuerst: In-Reply-To, dann die neuesten References
+    references = dict.fromkeys(email_data.get("In-Reply-To", []) + email_data.get("References", [])[::-1])
+    return list(references)[:MAX_REFERENCES]
+
+
+def find_thread_tickets(conn, emails):
+    """
+    Sucht für jede eingehende E-Mail das Ticket, auf das sie antwortet, mit je
+    einer Abfrage für alle Verweise und alle Betreff-Kennungen.
+    Gibt pro E-Mail die Ticket-ID oder None für eine neue Anfrage zurück.
+    """
+    candidates = [_reference_candidates(email_data) for email_data in emails]
+
+    known = {}
+    all_references = list(dict.fromkeys(message_id for refs in candidates for message_id in refs))
+    if all_references:
+        params = {f"id_{i}": message_id for i, message_id in enumerate(all_references)}
+        rows = conn.execute(text(f"""
+            SELECT Message_ID, ID_Ticket FROM {MESSAGE_INDEX_TABLE}
+            WHERE Message_ID IN ({', '.join(f':{key}' for key in params)})
+        """), params).fetchall()
+        known = {row.Message_ID: row.ID_Ticket for row in rows}
+
+    results = [next((known[message_id] for message_id in refs if message_id in known), None) for refs in candidates]
+
+    # Betreff-Kennungen nur für E-Mails ohne bekannten Verweis prüfen
+    tokens = []
+    for email_data, ticket_id in zip(emails, results):
+        match = TICKET_TOKEN_PATTERN.search(email_data.get("Betreff") or "") if ticket_id is None else None
+        tokens.append(int(match.group(1)) if match else None)
+
+    token_ids = list(dict.fromkeys(token for token in tokens if token is not None))
+    if not token_ids:
+        return results
+
+    params = {f"ticket_{i}": ticket_id for i, ticket_id in enumerate(token_ids)}
+    placeholders = ", ".join(f":{key}" for key in params)
+    ticket_customers = {row.ID_Ticket: row.ID_Kunde for row in conn.execute(text(f"""
+        SELECT ID_Ticket, ID_Kunde FROM ticket WHERE ID_Ticket IN ({placeholders})
+    """), params)}
+    outbound_recipients = {}
+    for row in conn.execute(text(f"""
+        SELECT ID_Ticket, Empfaenger FROM {MESSAGE_INDEX_TABLE}
+        WHERE Richtung = :direction AND Empfaenger IS NOT NULL AND ID_Ticket IN ({placeholders})
+    """), {**params, "direction": DIRECTION_OUTBOUND}):
+        outbound_recipients.setdefault(row.ID_Ticket, set()).update(row.Empfaenger.split(","))
+    senders = lookup_customer_ids(conn, [email_data["Von"] for email_data, token in zip(emails, tokens)
+                                         if token in ticket_customers])
+
+    for i, (email_data, token) in enumerate(zip(emails, tokens)):
+        if token not in ticket_customers:
+            continue
+        sender_id = senders.get(email_data["Von"])
+        sender = normalize_email(parseaddr(email_data["Von"])[1])
+        if (sender_id is not None and sender_id == ticket_customers[token]) or \
+                sender in outbound_recipients.get(token, ()):
+            results[i] = token
+    return results
+
+
+def find_thread_ticket(conn, email_data):
+    """Wie find_thread_tickets für eine einzelne E-Mail."""
+    return find_thread_tickets(conn, [email_data])[0]
+
+
+def append_reply(conn, ticket_id, email_data):
+    """Hängt eine eingehende Antwort als Kommentar an ein Ticket. Gibt die Kommentar-ID zurück."""
+    result = conn.execute(text("""
+        INSERT INTO ticket_kommentar (ID_Ticket, Erstellt_von, Kommentar_Text, Erstellt_am)
+        VALUES (:ticket_id, NULL, :text, NOW())
+    """), {
+        "ticket_id": ticket_id,
+        "text": f"E-Mail von {email_data['Von']}: {email_data['Betreff']}\n\n{email_data['Nachricht']}"
+    })
+    link_attachments(conn, ticket_id, email_data.get("Anhänge"))
+    record_message_ids(conn, ticket_id, [normalize_message_id(email_data.get("Message-ID"))], DIRECTION_INBOUND)
+    publish_change("ticket_kommentar", result.lastrowid, ACTION_INSERT, conn=conn)
+    return result.lastrowid
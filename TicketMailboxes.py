@@ -0,0 +1,168 @@
+import os
+import threading
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy import text
+from TicketChanges import ACTION_DELETE, ACTION_UPDATE, publish_change
+
+# ==============================================================================
+# POSTFACH-REGISTER
+# ==============================================================================
+# Alle Support-Adressen, die automatisch in Tickets umgewandelt werden, stehen in
+# email_postfach: ein Eintrag je Konto, Server und Ordner. Der Hintergrund-Abgleich
+# (TicketMailIngest) liest das Register bei jedem Lauf und gleicht die Einträge
+# parallel ab.
+# Passwörter werden mit Fernet verschlüsselt gespeichert; der Schlüssel kommt aus
+# der Umgebungsvariablen TICKET_MAIL_SECRET_KEY (Fernet.generate_key()) und liegt
+# nie in der Datenbank. Die Tabelle ist in den allgemeinen Tabellen-Ansichten
+# (Datenbanken, Datenbankverwaltung, Export) ausgeblendet.
+
+MAILBOX_TABLE = "email_postfach"
+DEFAULT_IMAP_SERVER = "imap.gmail.com"
+DEFAULT_FOLDER = "INBOX"
+
+MAILBOX_SECRET_ENV = "TICKET_MAIL_SECRET_KEY"
+ENCRYPTED_PREFIX = "fernet:"
+
+# Tabellen mit Zugangsdaten, die die allgemeinen Tabellen-Ansichten nicht anzeigen
+HIDDEN_TABLES = {MAILBOX_TABLE}
+
+PASSWORD_COLUMN_LENGTH = 512
+
+# Anlegen, Verbreitern und Verschlüsseln nur einmal pro Prozess (Main.main() läuft bei jedem Rerun)
+_mailbox_table_ready = False
+_mailbox_table_lock = threading.Lock()
+
+
+def ensure_mailbox_table():
+    """Legt das Postfach-Register einmal pro Prozess an bzw. bringt es auf den aktuellen Stand."""
+    global _mailbox_table_ready
+    from Main import engine, inspector
+
+    with _mailbox_table_lock:
+        if _mailbox_table_ready:
+            return True
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {MAILBOX_TABLE} (
+                        ID_Postfach INT AUTO_INCREMENT PRIMARY KEY,
+                        Konto VARCHAR(190) NOT NULL,
+                        Passwort VARCHAR({PASSWORD_COLUMN_LENGTH}) NOT NULL,
+                        Server VARCHAR(190) NOT NULL,
+                        Ordner VARCHAR(190) NOT NULL DEFAULT '{DEFAULT_FOLDER}',
+                        Aktiv BOOLEAN NOT NULL DEFAULT TRUE,
+                        UNIQUE KEY uq_postfach (Konto, Server, Ordner)
+                    )
+                """))
+
+            # Ältere Tabellen: Platz für das verschlüsselte Passwort schaffen
+            inspector.clear_cache()
+            column = next(column for column in inspector.get_columns(MAILBOX_TABLE) if column["name"] == "Passwort")
+            if (getattr(column["type"], "length", None) or 0) < PASSWORD_COLUMN_LENGTH:
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {MAILBOX_TABLE} MODIFY Passwort VARCHAR({PASSWORD_COLUMN_LENGTH}) NOT NULL"))
+                inspector.clear_cache()
+
+            encrypt_stored_passwords(engine)
+            _mailbox_table_ready = True
+            return True
+        except Exception as e:
+            print(f"FEHLER: Tabelle {MAILBOX_TABLE} konnte nicht angelegt werden: {str(e)}")
+            return False
+
+
+def _fernet():
+    key = os.environ.get(MAILBOX_SECRET_ENV)
+    if not key:
+        raise RuntimeError(f"Umgebungsvariable {MAILBOX_SECRET_ENV} für die Postfach-Passwörter ist nicht gesetzt")
+    return Fernet(key)
+
+
+def encrypt_password(password):
+    return ENCRYPTED_PREFIX + _fernet().encrypt(password.encode("utf-8")).decode("ascii")
+
+
+def decrypt_password(stored):
+    """Entschlüsselt ein gespeichertes Passwort; Werte ohne Präfix stammen aus der Zeit vor der Verschlüsselung."""
+    if not stored.startswith(ENCRYPTED_PREFIX):
+        return stored
+    return _fernet().decrypt(stored[len(ENCRYPTED_PREFIX):].encode("ascii")).decode("utf-8")
+
+
+def encrypt_stored_passwords(engine):
+    """Verschlüsselt noch im Klartext gespeicherte Passwörter, sofern ein Schlüssel gesetzt ist."""
+    with engine.begin() as conn:
+        rows = conn.execute(text(f"""
+            SELECT ID_Postfach, Passwort FROM {MAILBOX_TABLE} WHERE Passwort NOT LIKE :prefix
+        """), {"prefix": ENCRYPTED_PREFIX + "%"}).fetchall()
+        if rows and not os.environ.get(MAILBOX_SECRET_ENV):
+            print(f"FEHLER: {MAILBOX_SECRET_ENV} ist nicht gesetzt, {len(rows)} Postfach-Passwörter bleiben unverschlüsselt")
+        elif rows:
+            conn.execute(text(f"UPDATE {MAILBOX_TABLE} SET Passwort = :password WHERE ID_Postfach = :id"),
+                         [{"id": row.ID_Postfach, "password": encrypt_password(row.Passwort)} for row in rows])
+
+
+def mailbox_key(mailbox_config):
+    """Eindeutiger Schlüssel (Konto, Server, Ordner) eines Postfachs."""
+    return (mailbox_config["email"],
+            mailbox_config.get("imap_server") or DEFAULT_IMAP_SERVER,
+            mailbox_config.get("folder") or DEFAULT_FOLDER)
+
+
+def load_mailboxes(engine, only_active=True):
+    """Liest die registrierten Postfächer als Konfigurationen für run_ingestion."""
+    query = f"SELECT ID_Postfach, Konto, Passwort, Server, Ordner, Aktiv FROM {MAILBOX_TABLE}"
+    if only_active:
+        query += " WHERE Aktiv = TRUE"
+    query += " ORDER BY Konto, Ordner"
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(query)).fetchall()
+
+    mailboxes = []
+    for row in rows:
+        try:
+            password = decrypt_password(row.Passwort)
+        except (RuntimeError, InvalidToken) as e:
+            # Falscher oder fehlender Schlüssel: Postfach überspringen statt den Abgleich abzubrechen
+            print(f"FEHLER: Passwort für Postfach {row.Konto}/{row.Ordner} kann nicht entschlüsselt werden: {str(e) or 'ungültiger Schlüssel'}")
+            continue
+        mailboxes.append({
+            "id": row.ID_Postfach,
+            "email": row.Konto,
+            "password": password,
+            "imap_server": row.Server,
+            "folder": row.Ordner,
+            "active": bool(row.Aktiv),
+        })
+    return mailboxes
+
+
+def load_mailbox_keys(engine, only_active=True):
+    """Schlüssel (Konto, Server, Ordner) der registrierten Postfächer, ohne Passwörter zu entschlüsseln."""
+    query = f"SELECT Konto, Server, Ordner FROM {MAILBOX_TABLE}"
+    if only_active:
+        query += " WHERE Aktiv = TRUE"
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(query)).fetchall()
+    return {(row.Konto, row.Server, row.Ordner) for row in rows}
+
+
+def save_mailbox(engine, email, password, imap_server=DEFAULT_IMAP_SERVER, folder=DEFAULT_FOLDER, active=True):
+    """Registriert ein Postfach oder aktualisiert Passwort und Status eines vorhandenen."""
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            INSERT INTO {MAILBOX_TABLE} (Konto, Passwort, Server, Ordner, Aktiv)
+            VALUES (:email, :password, :server, :folder, :active)
+            ON DUPLICATE KEY UPDATE Passwort = VALUES(Passwort), Aktiv = VALUES(Aktiv)
+        """), {"email": email, "password": encrypt_password(password), "server": imap_server, "folder": folder,
+               "active": active})
+        publish_change(MAILBOX_TABLE, action=ACTION_UPDATE, conn=conn)
+
+
+def delete_mailbox(engine, mailbox_id):
+    """Entfernt ein Postfach aus dem Register. Die Abgleich-Marke bleibt erhalten."""
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {MAILBOX_TABLE} WHERE ID_Postfach = :id"), {"id": mailbox_id})
+        publish_change(MAILBOX_TABLE, mailbox_id, ACTION_DELETE, conn=conn)
@@ -1,15 +1,30 @@
 
-import altair as alt
+from datetime import datetime
 import streamlit as st
 import pandas as pd
 from sqlalchemy import text
 from Authorisation import generate_salt, hash_password
 from TicketMail import show_email_inbox_tab, show_email_tab
+from TicketCharts import bar_chart, time_series_chart
+from TicketDashboard import (DASHBOARD_KEY, KANBAN_KEY, get_precomputed, refresh_now, request_refresh, show_staleness)
+from TicketCounts import bump_status_count, get_status_count_label, invalidate_status_counts
+from TicketArchive import (ARCHIVE_BATCH_SIZE, ARCHIVE_CLOSED_STATUS_NAMES, ARCHIVE_MIN_AGE_DAYS, ARCHIVE_TABLE,
+                           count_archivable_rows, ensure_archive_table, run_history_archival)
+from TicketTimeline import TIMELINE_TYPES, TYPE_CHANGE, TYPE_COMMENT, TYPE_EMAIL, fetch_ticket_timeline
+from TicketSnapshot import SNAPSHOT_FIELDS, reconstruct_ticket
+from TicketChanges import ACTION_INSERT, publish_change
+from TicketAttachments import get_thumbnail, load_ticket_attachments, open_attachment
 
 # ==============================================================================
 # 2. DATA ACCESS & HELPERS
 # ==============================================================================
 
+# Listen laden nur eine gekürzte Beschreibung, der volle Text wird erst im Ticket geladen
+DESCRIPTION_PREVIEW_LENGTH = 120
+
+# Anzahl der zuletzt erstellten Tickets je Seite in der Auswahl des Bearbeiten-Tabs
+EDIT_RECENT_PAGE_SIZE = 25
+
 def fetch_data_for_select(engine, query, value_col, name_col):
     """Fetches data for a selectbox and returns options and an ID map."""
     df = pd.read_sql(query, con=engine)
@@ -20,7 +35,7 @@ def fetch_data_for_select(engine, query, value_col, name_col):
 def build_ticket_query(filters, search):
     """Builds the dynamic SQL query and parameters for ticket filtering and search."""
     query = """
-    SELECT t.ID_Ticket, t.Titel, t.Beschreibung, t.Priorität, 
+    SELECT t.ID_Ticket, t.Titel, LEFT(t.Beschreibung, :preview_length) AS Vorschau, t.Priorität, 
            s.Name as Status, m.Name as Mitarbeiter, k.Name as Kunde,
            t.Erstellt_am, t.Geändert_am
     FROM ticket t
@@ -29,7 +44,7 @@ def build_ticket_query(filters, search):
     LEFT JOIN kunde k ON t.ID_Kunde = k.ID_Kunde
     WHERE 1=1
     """
-    params = {}
+    params = {"preview_length": DESCRIPTION_PREVIEW_LENGTH}
 
     # Apply filters
     if filters.get("status") != "Alle":
@@ -58,6 +73,159 @@ def build_ticket_query(filters, search):
     query += " ORDER BY t.Erstellt_am DESC"
     return query, params
 
+def load_ticket_description(engine, ticket_id):
+    """Loads the full description of a single ticket by primary key."""
+    with engine.connect() as conn:
+        return conn.execute(
+            text("SELECT Beschreibung FROM ticket WHERE ID_Ticket = :ticket_id"),
+            {"ticket_id": ticket_id}
+        ).scalar()
+
+def fetch_ticket_header(engine, ticket_id):
+    """Loads ID, title and status of a single ticket by primary key, or None."""
+    with engine.connect() as conn:
+        return conn.execute(text("""
+            SELECT t.ID_Ticket, t.Titel, s.Name as Status
+            FROM ticket t
+            LEFT JOIN status s ON t.ID_Status = s.ID_Status
+            WHERE t.ID_Ticket = :ticket_id
+        """), {"ticket_id": ticket_id}).fetchone()
+
+def fetch_recent_tickets(engine, before_id=None, limit=EDIT_RECENT_PAGE_SIZE):
+    """Loads one page of the newest tickets (keyset on ID_Ticket) and the cursor for the next page."""
+    query = """
+        SELECT t.ID_Ticket, t.Titel, s.Name as Status
+        FROM ticket t
+        LEFT JOIN status s ON t.ID_Status = s.ID_Status
+    """
+    params = {"limit": limit + 1}
+    if before_id is not None:
+        query += " WHERE t.ID_Ticket < :before_id"
+        params["before_id"] = before_id
+    query += " ORDER BY t.ID_Ticket DESC LIMIT :limit"
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(query), params).fetchall()
+
+    next_cursor = rows[limit - 1].ID_Ticket if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def format_timeline_entry(row):
+    """Formats a single timeline row as Markdown."""
+    zeitpunkt = row.Zeitpunkt.strftime('%d.%m.%Y %H:%M') if row.Zeitpunkt else ""
+    if row.Typ == TYPE_COMMENT:
+        return f"💬 **{row.Mitarbeiter_Name}** - {zeitpunkt}\n\n{row.Neuer_Wert}"
+    if row.Typ == TYPE_EMAIL:
+        return f"📧 {row.Neuer_Wert}  \n🧑‍💼 Durch: *{row.Mitarbeiter_Name}* am *{zeitpunkt}*"
+    return (f"🔹 **{row.Feldname}** geändert von **{row.Alter_Wert}** zu **{row.Neuer_Wert}**  \n"
+            f"🧑‍💼 Durch: *{row.Mitarbeiter_Name}* am *{zeitpunkt}*")
+
+def show_timeline_page(engine, ticket_id, state_key, types=TIMELINE_TYPES, feld_filter=None,
+                       date_from=None, date_to=None, as_table=False, empty_message="Keine Einträge vorhanden."):
+    """Renders one page of the ticket timeline with keyset paging buttons."""
+    # Archivierte Historie nur auf Wunsch einbeziehen
+    include_archive = False
+    if TYPE_CHANGE in types or TYPE_EMAIL in types:
+        include_archive = st.checkbox("Archivierte Einträge anzeigen", key=f"{state_key}_archive")
+
+    # Blätter-Zustand zurücksetzen, wenn sich Ticket oder Filter ändern
+    filter_key = (ticket_id, tuple(types), feld_filter, date_from, date_to, include_archive)
+    if st.session_state.get(f"{state_key}_filter") != filter_key:
+        st.session_state[f"{state_key}_filter"] = filter_key
+        st.session_state[f"{state_key}_cursors"] = [None]
+
+    cursors = st.session_state[f"{state_key}_cursors"]
+    page_index = len(cursors) - 1
+
+    try:
+        rows, next_cursor = fetch_ticket_timeline(
+            engine, ticket_id, types=types, feld_filter=feld_filter,
+            date_from=date_from, date_to=date_to, cursor=cursors[-1], include_archive=include_archive
+        )
+    except Exception as e:
+        st.error(f"Fehler beim Laden der Ticket-Zeitleiste: {str(e)}")
+        rows, next_cursor = [], None
+
+    if not rows:
+        st.info(empty_message)
+    elif as_table:
+        timeline_df = pd.DataFrame([{
+            "Zeitpunkt": row.Zeitpunkt,
+            "Typ": row.Typ,
+            "Mitarbeiter": row.Mitarbeiter_Name,
+            "Feld": row.Feldname,
+            "Alt": row.Alter_Wert,
+            "Neu": row.Neuer_Wert
+        } for row in rows])
+        st.dataframe(
+            timeline_df,
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "Zeitpunkt": st.column_config.DatetimeColumn("Zeitpunkt", format="DD.MM.YYYY HH:mm")
+            }
+        )
+    else:
+        st.markdown("\n\n---\n\n".join(format_timeline_entry(row) for row in rows))
+
+    if page_index == 0 and next_cursor is None:
+        return
+
+    # Blättern
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("◀ Neuere", disabled=page_index == 0, key=f"{state_key}_prev_page"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Seite {page_index + 1}")
+    with col3:
+        if st.button("Ältere ▶", disabled=next_cursor is None, key=f"{state_key}_next_page"):
+            cursors.append(next_cursor)
+            st.rerun()
+
+def show_ticket_time_travel(engine, ticket_id):
+    """Shows the reconstructed state of a ticket at a chosen point in time."""
+    with st.expander("🕰️ Zustand zu einem Zeitpunkt anzeigen"):
+        col1, col2 = st.columns(2)
+        with col1:
+            at_date = st.date_input("Datum:", value=datetime.now().date(), key=f"time_travel_date_{ticket_id}")
+        with col2:
+            at_time = st.time_input("Uhrzeit:", value=datetime.now().time().replace(second=0, microsecond=0),
+                                    key=f"time_travel_time_{ticket_id}")
+
+        if not st.button("Rekonstruieren", key=f"time_travel_button_{ticket_id}"):
+            return
+
+        try:
+            state, basis, replayed = reconstruct_ticket(engine, ticket_id, datetime.combine(at_date, at_time))
+        except Exception as e:
+            st.error(f"Fehler bei der Rekonstruktion: {str(e)}")
+            return
+
+        if state is None:
+            st.info("Das Ticket existierte zu diesem Zeitpunkt noch nicht.")
+            return
+
+        # IDs in der Historie durch Namen ersetzen
+        lookups = {
+            "Status": "SELECT ID_Status, Name FROM status",
+            "Mitarbeiter": "SELECT ID_Mitarbeiter, Name FROM mitarbeiter",
+            "Kunde": "SELECT ID_Kunde, Name FROM kunde",
+        }
+        display_state = dict(state)
+        with engine.connect() as conn:
+            for feld, query in lookups.items():
+                names = {str(row[0]): row[1] for row in conn.execute(text(query))}
+                display_state[feld] = names.get(state.get(feld), state.get(feld))
+
+        st.caption(f"Ausgangsbasis: {basis}, {replayed} Änderungen nachgespielt")
+        st.dataframe(
+            pd.DataFrame([{"Feld": feld, "Wert": display_state.get(feld, "")} for feld in SNAPSHOT_FIELDS]),
+            use_container_width=True,
+            hide_index=True
+        )
+
 # ==============================================================================
 # 3. UI COMPONENTS
 # ==============================================================================
@@ -104,12 +272,48 @@ def show_ticket_overview():
     except Exception as e:
         st.error(f"Fehler beim Abrufen der Tickets: {e}")
 
+def show_ticket_attachments(engine, ticket_id):
+    """Zeigt die Anhänge eines Tickets; Vorschaubilder und Downloads werden erst bei Bedarf von der Platte gelesen."""
+    try:
+        attachments = load_ticket_attachments(engine, ticket_id)
+    except Exception as e:
+        st.error(f"Fehler beim Laden der Anhänge: {str(e)}")
+        return
+
+    if not attachments:
+        return
+
+    st.markdown("---")
+    if not st.toggle(f"📎 Anhänge anzeigen ({len(attachments)})", key=f"attachments_{ticket_id}"):
+        return
+
+    for attachment in attachments:
+        col1, col2, col3 = st.columns([1, 3, 1])
+        with col1:
+            thumb = get_thumbnail(attachment.Hash, attachment.Content_Type)
+            if thumb is not None:
+                st.image(str(thumb))
+        with col2:
+            st.write(f"**{attachment.Dateiname}** ({attachment.Groesse // 1024} KB)")
+        with col3:
+            download_key = f"attachment_download_{attachment.ID_Anhang}"
+            if st.button("⬇️ Laden", key=f"{download_key}_prepare"):
+                file = open_attachment(attachment.Hash)
+                if file is None:
+                    st.error("Datei nicht mehr vorhanden.")
+                else:
+                    with file:
+                        st.download_button("💾 Speichern", data=file.read(), file_name=attachment.Dateiname,
+                                           mime=attachment.Content_Type or "application/octet-stream",
+                                           key=download_key, on_click="ignore")
+
 def show_ticket_details(ticket_id):
     """Displays details, comments, and history for a single ticket."""
     from Main import engine
     # Ticket-Details abrufen
     query = """
-    SELECT t.ID_Ticket, t.Titel, t.Beschreibung, t.Priorität, 
+    SELECT t.ID_Ticket, t.Titel, LEFT(t.Beschreibung, :preview_length) AS Vorschau,
+           CHAR_LENGTH(t.Beschreibung) AS Beschreibung_Laenge, t.Priorität, 
            s.Name as Status, m.Name as Mitarbeiter, k.Name as Kunde,
            t.Erstellt_am, t.Geändert_am
     FROM ticket t
@@ -121,7 +325,7 @@ def show_ticket_details(ticket_id):
 
     try:
         with engine.connect() as conn:
-            result = conn.execute(text(query), {"ticket_id": ticket_id})
+            result = conn.execute(text(query), {"ticket_id": ticket_id, "preview_length": DESCRIPTION_PREVIEW_LENGTH})
             ticket = result.fetchone()
     except Exception as e:
         st.error(f"Fehler beim Abrufen der Ticket-Details: {str(e)}")
@@ -147,39 +351,19 @@ def show_ticket_details(ticket_id):
 
         st.markdown("---")
         st.write("**Beschreibung:**")
-        st.write(ticket.Beschreibung)
-
-        # Kommentare abrufen
-        st.markdown("---")
-        st.subheader("Kommentare")
-
-        kommentar_query = """
-        SELECT k.ID_Kommentar, k.Kommentar_Text AS Kommentar, m.Name as Mitarbeiter, k.Erstellt_am
-        FROM ticket_kommentar k
-        JOIN mitarbeiter m ON k.ID_Mitarbeiter = m.ID_Mitarbeiter
-        WHERE k.ID_Ticket = :ID_Ticket
-        ORDER BY k.Erstellt_am DESC
-        """
+        if (ticket.Beschreibung_Laenge or 0) <= DESCRIPTION_PREVIEW_LENGTH:
+            st.write(ticket.Vorschau)
+        elif st.toggle(f"Vollständige Beschreibung anzeigen ({ticket.Beschreibung_Laenge} Zeichen)", key=f"full_description_{ticket_id}"):
+            st.write(load_ticket_description(engine, ticket_id))
+        else:
+            st.write(f"{ticket.Vorschau} …")
 
-        try:
-            with engine.connect() as conn:
-                result = conn.execute(text(kommentar_query), {"ID_Ticket": ticket_id})
-                kommentare = result.fetchall()
-        except Exception as e:
-            st.error(f"Fehler beim Abrufen der Kommentare: {str(e)}")
-            kommentare = []
+        show_ticket_attachments(engine, ticket_id)
 
-        if not kommentare:
-            st.info("Keine Kommentare vorhanden.")
-        else:
-            for kommentar in kommentare:
-                st.markdown(f"""
-                **{kommentar.Mitarbeiter}** - {kommentar.Erstellt_am}
-                
-                {kommentar.Kommentar}
-                
-                ---
-                """)
+        # Kommentare, Änderungen und E-Mails als gemeinsame Zeitleiste
+        st.markdown("---")
+        st.subheader("🕘 Verlauf")
+        show_timeline_page(engine, ticket_id, f"details_timeline_{ticket_id}", empty_message="Keine Kommentare oder Änderungen vorhanden.")
 
         # Neuen Kommentar hinzufügen
         st.subheader("Neuer Kommentar")
@@ -195,93 +379,101 @@ def show_ticket_details(ticket_id):
                 try:
                     with engine.begin() as conn:
                         insert_query = text("""
-                        INSERT INTO ticket_kommentar (ID_Ticket, ID_Mitarbeiter, Kommentar_Text, Erstellt_am)
+                        INSERT INTO ticket_kommentar (ID_Ticket, Erstellt_von, Kommentar_Text, Erstellt_am)
                         VALUES (:ID_Ticket, :ID_Mitarbeiter, :Kommentar_Text, NOW())
                         """)
-                        conn.execute(insert_query, {
+                        result = conn.execute(insert_query, {
                             "ID_Ticket": ticket_id,
                             "ID_Mitarbeiter": st.session_state.user_id,
                             "Kommentar_Text": comment_text
                         })
+                        publish_change("ticket_kommentar", result.lastrowid, ACTION_INSERT, conn=conn)
 
                     st.success("Kommentar erfolgreich hinzugefügt!")
                     st.rerun()
                 except Exception as e:
                     st.error(f"Fehler beim Hinzufügen des Kommentars: {str(e)}")
 
-        # --- Ticket-Historie anzeigen ---
-        st.markdown("---")
-        st.subheader("🕘 Änderungshistorie")
-
-        try:
-            historie_query = """
-            SELECT th.Feldname, th.Alter_Wert, th.Neuer_Wert, m.Name AS Geändert_von, th.Geändert_am
-            FROM ticket_historie th
-            LEFT JOIN mitarbeiter m ON th.Geändert_von = m.ID_Mitarbeiter
-            WHERE th.ID_Ticket = :ticket_id
-            ORDER BY th.Geändert_am DESC
-            """
-            with engine.connect() as conn:
-                result = conn.execute(text(historie_query), {"ticket_id": ticket_id})
-                history_entries = result.fetchall()
-        except Exception as e:
-            st.error(f"Fehler beim Abrufen der Historie: {str(e)}")
-            history_entries = []
-
-        if not history_entries:
-            st.info("Keine Änderungen protokolliert.")
-        else:
-            for eintrag in history_entries:
-                st.markdown(f"""
-                🔹 **{eintrag.Feldname}** geändert von **{eintrag.Alter_Wert}** zu **{eintrag.Neuer_Wert}**  
-                🧑‍💼 Durch: *{eintrag.Geändert_von}* am *{eintrag.Geändert_am}*
-                """)
-
 def show_ticket_edit_tab():
     """UI for editing a ticket."""
-    from Ticket import log_ticket_change
+    from Ticket import log_ticket_change, update_ticket_with_history, TicketConflictError
     from Main import engine
     st.subheader("✏️ Ticket bearbeiten")
 
-    # Alle Tickets laden für die Auswahl
+    # Direkt verlinktes Ticket (?ticket=123) per Primärschlüssel laden
+    selected_header = None
+    linked_id = st.query_params.get("ticket")
+    if linked_id and linked_id.isdigit():
+        try:
+            selected_header = fetch_ticket_header(engine, int(linked_id))
+        except Exception as e:
+            st.error(f"Fehler beim Laden des Tickets: {str(e)}")
+        if selected_header is None:
+            st.error(f"Ticket #{linked_id} nicht gefunden!")
+
+    # Zum Blättern nur eine Seite der neuesten Tickets laden
+    if "edit_recent_cursors" not in st.session_state:
+        st.session_state.edit_recent_cursors = [None]
+    cursors = st.session_state.edit_recent_cursors
     try:
-        query = text("""
-            SELECT t.ID_Ticket, t.Titel, s.Name as Status
-            FROM ticket t
-            LEFT JOIN status s ON t.ID_Status = s.ID_Status
-            ORDER BY t.ID_Ticket DESC
-        """)
-        with engine.connect() as conn:
-            result = conn.execute(query)
-            tickets_df = pd.DataFrame(result.fetchall(), columns=result.keys())
+        recent_tickets, next_cursor = fetch_recent_tickets(engine, cursors[-1])
     except Exception as e:
         st.error(f"Fehler beim Laden der Tickets: {str(e)}")
         return
 
-    if tickets_df.empty:
+    if not recent_tickets and selected_header is None:
         st.info("Keine Tickets gefunden.")
         return
 
     # Ticket-Auswahl
     col1, col2 = st.columns([3, 1])
 
-    with col1:
-        ticket_options = [f"#{row['ID_Ticket']} - {row['Titel']} ({row['Status']})" for _, row in tickets_df.iterrows()]
-        selected_ticket_option = st.selectbox("Ticket auswählen:", options=ticket_options)
-
-        # Ticket-ID aus der Auswahl extrahieren
-        selected_ticket_id = int(selected_ticket_option.split("#")[1].split(" - ")[0])
-
     with col2:
         search_term = st.text_input("Ticket-ID suchen:", "")
         if search_term and search_term.isdigit():
             search_id = int(search_term)
-            if search_id in tickets_df["ID_Ticket"].values:
-                selected_ticket_id = search_id
+            found = fetch_ticket_header(engine, search_id)
+            if found is not None:
+                selected_header = found
+                st.query_params["ticket"] = str(search_id)
                 st.success(f"Ticket #{search_id} gefunden!")
             else:
                 st.error(f"Ticket #{search_id} nicht gefunden!")
 
+    with col1:
+        headers = {row.ID_Ticket: row for row in recent_tickets}
+        if selected_header is not None and selected_header.ID_Ticket not in headers:
+            # Verlinktes Ticket liegt nicht auf der aktuellen Seite
+            headers = {selected_header.ID_Ticket: selected_header, **headers}
+        ticket_ids = list(headers)
+        default_id = selected_header.ID_Ticket if selected_header is not None else ticket_ids[0]
+
+        def remember_selection():
+            st.query_params["ticket"] = str(st.session_state.edit_ticket_select)
+
+        selected_ticket_id = st.selectbox(
+            "Ticket auswählen:",
+            options=ticket_ids,
+            index=ticket_ids.index(default_id),
+            format_func=lambda x: f"#{x} - {headers[x].Titel} ({headers[x].Status})",
+            key="edit_ticket_select",
+            on_change=remember_selection
+        )
+        if selected_header is not None:
+            selected_ticket_id = selected_header.ID_Ticket
+
+        nav1, nav2, nav3 = st.columns([1, 2, 1])
+        with nav1:
+            if st.button("◀ Neuere", disabled=len(cursors) == 1, key="edit_recent_prev"):
+                cursors.pop()
+                st.rerun()
+        with nav2:
+            st.caption(f"Seite {len(cursors)} der zuletzt erstellten Tickets")
+        with nav3:
+            if st.button("Ältere ▶", disabled=next_cursor is None, key="edit_recent_next"):
+                cursors.append(next_cursor)
+                st.rerun()
+
     # Tabs für Bearbeitung, Historie und Kommentare
     tab1, tab2, tab3 = st.tabs(["📝 Bearbeiten", "📜 Historie", "💬 Kommentare"])
 
@@ -309,6 +501,12 @@ def show_ticket_edit_tab():
             st.error(f"Fehler beim Laden des Tickets: {str(e)}")
             return
 
+        # Version merken, die beim Anzeigen des Formulars galt (für die Konfliktprüfung beim Speichern)
+        if st.session_state.get("edit_version_ticket_id") != selected_ticket_id:
+            st.session_state.edit_version_ticket_id = selected_ticket_id
+            st.session_state.edit_version = ticket_dict.get("version", 0)
+            st.session_state.edit_conflict = False
+
         # Status-Optionen laden
         status_df = pd.read_sql("SELECT ID_Status, Name FROM status ORDER BY Name", con=engine)
 
@@ -455,66 +653,47 @@ def show_ticket_edit_tab():
                         })
 
                     if changes:
-                        # Ticket aktualisieren
-                        update_query = text("""
-                            UPDATE ticket
-                            SET Titel = :titel,
-                                Beschreibung = :beschreibung,
-                                Priorität = :prioritaet,
-                                ID_Status = :status,
-                                ID_Mitarbeiter = :mitarbeiter,
-                                ID_Kunde = :kunde,
-                                Geändert_am = NOW()
-                            WHERE ID_Ticket = :ticket_id
-                        """)
-
-                        with engine.connect() as conn:
-                            with conn.begin():
-                                conn.execute(update_query, {
-                                    "titel": titel,
-                                    "beschreibung": beschreibung,
-                                    "prioritaet": prioritaet,
-                                    "status": selected_status["ID_Status"],
-                                    "mitarbeiter": selected_mitarbeiter["ID_Mitarbeiter"],
-                                    "kunde": selected_kunde["ID_Kunde"],
-                                    "ticket_id": selected_ticket_id
-                                })
-
-                            # Kategorie aktualisieren
-                            if current_kategorie_id != selected_kategorie["ID_Kategorie"]:
-                                # Bestehende Kategorie-Zuordnung löschen
-                                delete_query = text("""
-                                    DELETE FROM ticket_kategorie WHERE ID_Ticket = :ticket_id
-                                """)
-                                conn.execute(delete_query, {"ticket_id": selected_ticket_id})
-
-                                # Neue Kategorie-Zuordnung erstellen
-                                insert_query = text("""
-                                    INSERT INTO ticket_kategorie (ID_Ticket, ID_Kategorie)
-                                    VALUES (:ticket_id, :kategorie_id)
-                                """)
-                                conn.execute(insert_query, {
-                                    "ticket_id": selected_ticket_id,
-                                    "kategorie_id": selected_kategorie["ID_Kategorie"]
-                                })
-
-                            # Änderungen in der Historie protokollieren
-                            for change in changes:
-                                log_ticket_change(
-                                    selected_ticket_id,
-                                    change["display"],
-                                    change["old"],
-                                    change["new"],
-                                    st.session_state.user_id
-                                )
+                        # Ticket, Kategorie und Historie in einer einzigen kurzen Transaktion schreiben
+                        kategorie_changed = current_kategorie_id != selected_kategorie["ID_Kategorie"]
+                        update_ticket_with_history(
+                            selected_ticket_id,
+                            {
+                                "titel": titel,
+                                "beschreibung": beschreibung,
+                                "prioritaet": prioritaet,
+                                "status": selected_status["ID_Status"],
+                                "mitarbeiter": selected_mitarbeiter["ID_Mitarbeiter"],
+                                "kunde": selected_kunde["ID_Kunde"]
+                            },
+                            changes,
+                            st.session_state.user_id,
+                            st.session_state.edit_version,
+                            kategorie_id=selected_kategorie["ID_Kategorie"] if kategorie_changed else None
+                        )
+                        # Beim nächsten Lauf die neue Version übernehmen
+                        st.session_state.edit_version_ticket_id = None
+
+                        bump_status_count(ticket_dict.get("ID_Status"), selected_status["ID_Status"])
+                        request_refresh(DASHBOARD_KEY)
+                        request_refresh(KANBAN_KEY)
 
                         st.success("Ticket erfolgreich aktualisiert!")
                         st.rerun()
                     else:
                         st.info("Keine Änderungen erkannt.")
+                except TicketConflictError as e:
+                    st.session_state.edit_conflict = True
+                    st.error(f"⚠️ {str(e)} Ihre Änderungen wurden nicht gespeichert.")
                 except Exception as e:
                     st.error(f"Fehler beim Aktualisieren des Tickets: {str(e)}")
 
+        # Nach einem Konflikt die aktuelle Fassung neu laden lassen
+        if st.session_state.get("edit_conflict"):
+            if st.button("🔄 Aktuelle Version laden", key="reload_after_conflict"):
+                st.session_state.edit_version_ticket_id = None
+                st.session_state.edit_conflict = False
+                st.rerun()
+
     # Tab 2: Ticket-Historie
     with tab2:
         st.subheader(f"Historie für Ticket #{selected_ticket_id}")
@@ -532,58 +711,20 @@ def show_ticket_edit_tab():
             with col3:
                 filter_date_to = st.date_input("Bis Datum:", value=None)
 
-        # Historie laden
-        try:
-            query = text("""
-                SELECT th.ID_Historie, th.Feldname, th.Alter_Wert, th.Neuer_Wert, 
-                       th.Geändert_am, m.Name as Mitarbeiter_Name
-                FROM ticket_historie th
-                LEFT JOIN mitarbeiter m ON th.Geändert_von = m.ID_Mitarbeiter
-                WHERE th.ID_Ticket = :ticket_id
-                ORDER BY th.Geändert_am DESC
-            """)
-            with engine.connect() as conn:
-                result = conn.execute(query, {"ticket_id": selected_ticket_id})
-                history_df = pd.DataFrame(result.fetchall(), columns=result.keys())
-        except Exception as e:
-            st.error(f"Fehler beim Laden der Ticket-Historie: {str(e)}")
-            history_df = pd.DataFrame()
-
-        if history_df.empty:
-            st.info("Keine Historieneinträge für dieses Ticket gefunden.")
-        else:
-            # Filter anwenden
-            filtered_df = history_df.copy()
-
-            if filter_field:
-                filtered_df = filtered_df[filtered_df["Feldname"].str.contains(filter_field, case=False)]
-
-            if filter_date_from:
-                filtered_df = filtered_df[filtered_df["Geändert_am"].dt.date >= filter_date_from]
-
-            if filter_date_to:
-                filtered_df = filtered_df[filtered_df["Geändert_am"].dt.date <= filter_date_to]
-
-            # Formatierte Anzeige der Historie
-            for _, row in filtered_df.iterrows():
-                with st.container():
-                    col1, col2 = st.columns([1, 3])
-
-                    with col1:
-                        st.write(f"**{row['Geändert_am'].strftime('%d.%m.%Y %H:%M')}**")
-                        st.write(f"*{row['Mitarbeiter_Name']}*")
-
-                    with col2:
-                        st.write(f"**Feld:** {row['Feldname']}")
-
-                        # Spezielle Formatierung für bestimmte Feldtypen
-                        if row['Feldname'] == 'Kommentar':
-                            st.write(f"**Neuer Kommentar:** {row['Neuer_Wert']}")
-                        else:
-                            st.write(f"**Alt:** {row['Alter_Wert']}")
-                            st.write(f"**Neu:** {row['Neuer_Wert']}")
-
-                    st.divider()
+        # Eine Seite der Historie laden (Filter und Blättern laufen in SQL)
+        show_timeline_page(
+            engine,
+            selected_ticket_id,
+            "history_timeline",
+            types=(TYPE_CHANGE, TYPE_EMAIL),
+            feld_filter=filter_field,
+            date_from=filter_date_from,
+            date_to=filter_date_to,
+            as_table=True,
+            empty_message="Keine Historieneinträge für dieses Ticket gefunden."
+        )
+
+        show_ticket_time_travel(engine, selected_ticket_id)
 
     # Tab 3: Kommentare
     with tab3:
@@ -606,11 +747,12 @@ def show_ticket_edit_tab():
                         """)
 
                         with engine.begin() as conn:
-                            conn.execute(insert_query, {
+                            result = conn.execute(insert_query, {
                                 "ticket_id": selected_ticket_id,
                                 "comment_text": new_comment,
                                 "mitarbeiter_id": st.session_state.user_id
                             })
+                            publish_change("ticket_kommentar", result.lastrowid, ACTION_INSERT, conn=conn)
 
                         # Kommentar auch in Historie loggen
                         log_ticket_change(selected_ticket_id, "Kommentar", "", new_comment, st.session_state.user_id)
@@ -621,33 +763,13 @@ def show_ticket_edit_tab():
                         st.error(f"Fehler beim Hinzufügen des Kommentars: {str(e)}")
 
         # Bestehende Kommentare anzeigen
-        try:
-            query = text("""
-                SELECT tk.ID_Kommentar, tk.Kommentar_Text, tk.Erstellt_am, 
-                       m.Name as Mitarbeiter_Name
-                FROM ticket_kommentar tk
-                LEFT JOIN mitarbeiter m ON tk.Erstellt_von = m.ID_Mitarbeiter
-                WHERE tk.ID_Ticket = :ticket_id
-                ORDER BY tk.Erstellt_am DESC
-            """)
-            with engine.connect() as conn:
-                result = conn.execute(query, {"ticket_id": selected_ticket_id})
-                comments_df = pd.DataFrame(result.fetchall(), columns=result.keys())
-        except Exception as e:
-            st.error(f"Fehler beim Laden der Ticket-Kommentare: {str(e)}")
-            comments_df = pd.DataFrame()
-
-        if comments_df.empty:
-            st.info("Keine Kommentare für dieses Ticket gefunden.")
-        else:
-            for _, row in comments_df.iterrows():
-                with st.container():
-                    st.markdown(f"""
-                    **{row['Mitarbeiter_Name']}** - {row['Erstellt_am'].strftime('%d.%m.%Y %H:%M')}
-                    
-                    {row['Kommentar_Text']}
-                    """)
-                    st.divider()
+        show_timeline_page(
+            engine,
+            selected_ticket_id,
+            "comments_timeline",
+            types=(TYPE_COMMENT,),
+            empty_message="Keine Kommentare für dieses Ticket gefunden."
+        )
 
     # The original logic from your file can be placed here.
     st.info("Der Bearbeitungsbereich für Tickets wird hier implementiert.")
@@ -727,7 +849,12 @@ def show_new_ticket_form():
                     ticket_id = result.lastrowid
 
                     # Automatische Einträge in ticket_mitarbeiter und ticket_kategorie
-                    create_ticket_relations(ticket_id, ID_Mitarbeiter)
+                    create_ticket_relations(ticket_id, ID_Mitarbeiter, conn=conn)
+                    publish_change("ticket", ticket_id, ACTION_INSERT, conn=conn)
+
+                bump_status_count(None, ID_Status)
+                request_refresh(DASHBOARD_KEY)
+                request_refresh(KANBAN_KEY)
 
                 st.success(f"Ticket #{ticket_id} erfolgreich erstellt!")
             except Exception as e:
@@ -735,36 +862,17 @@ def show_new_ticket_form():
 
 def show_ticket_statistics():
     """UI for displaying ticket statistics."""
-    from Main import engine
     st.subheader("📊 Ticket-Statistiken")
 
-    # Statistiken abrufen
+    # Statistiken aus dem vorberechneten Cache lesen
     try:
-        # Tickets nach Status
-        status_query = """
-        SELECT s.Name AS Status, COUNT(*) AS Anzahl
-        FROM ticket t
-        JOIN status s ON t.ID_Status = s.ID_Status
-        GROUP BY s.Name
-        """
-        status_stats_df = pd.read_sql(status_query, con=engine)
-
-        # Tickets nach Priorität
-        prioritaet_query = """
-        SELECT Priorität, COUNT(*) AS Anzahl
-        FROM ticket
-        GROUP BY Priorität
-        """
-        prioritaet_stats_df = pd.read_sql(prioritaet_query, con=engine)
-
-        # Tickets nach Mitarbeiter
-        mitarbeiter_query = """
-        SELECT m.Name AS Mitarbeiter, COUNT(*) AS Anzahl
-        FROM ticket t
-        JOIN mitarbeiter m ON t.ID_Mitarbeiter = m.ID_Mitarbeiter
-        GROUP BY m.Name
-        """
-        mitarbeiter_stats_df = pd.read_sql(mitarbeiter_query, con=engine)
+        aggregates, computed_at = get_precomputed(DASHBOARD_KEY)
+        show_staleness(computed_at)
+
+        status_stats_df = aggregates["status"]
+        prioritaet_stats_df = aggregates["prioritaet"]
+        mitarbeiter_stats_df = aggregates["mitarbeiter"]
+        verlauf_stats_df = aggregates["verlauf"]
 
         # Statistiken anzeigen
         if not status_stats_df.empty and not prioritaet_stats_df.empty and not mitarbeiter_stats_df.empty:
@@ -774,45 +882,27 @@ def show_ticket_statistics():
                 st.subheader("Tickets nach Status")
 
                 # Altair-Diagramm für Status
-                status_chart = alt.Chart(status_stats_df).mark_bar().encode(
-                    x=alt.X('Status:N', sort='-y'),
-                    y='Anzahl:Q',
-                    color='Status:N'
-                ).properties(
-                    width=400,
-                    height=300
-                )
-
+                status_chart = bar_chart(status_stats_df, "Status")
                 st.altair_chart(status_chart, use_container_width=True)
 
                 st.subheader("Tickets nach Mitarbeiter")
 
-                # Altair-Diagramm für Mitarbeiter
-                mitarbeiter_chart = alt.Chart(mitarbeiter_stats_df).mark_bar().encode(
-                    x=alt.X('Mitarbeiter:N', sort='-y'),
-                    y='Anzahl:Q',
-                    color='Mitarbeiter:N'
-                ).properties(
-                    width=400,
-                    height=300
-                )
-
+                # Altair-Diagramm für Mitarbeiter (Top-N + "Sonstige")
+                mitarbeiter_chart = bar_chart(mitarbeiter_stats_df, "Mitarbeiter")
                 st.altair_chart(mitarbeiter_chart, use_container_width=True)
 
             with col2:
                 st.subheader("Tickets nach Priorität")
 
                 # Altair-Diagramm für Priorität
-                prioritaet_chart = alt.Chart(prioritaet_stats_df).mark_bar().encode(
-                    x=alt.X('Priorität:N', sort='-y'),
-                    y='Anzahl:Q',
-                    color='Priorität:N'
-                ).properties(
-                    width=400,
-                    height=300
-                )
-
+                prioritaet_chart = bar_chart(prioritaet_stats_df, "Priorität")
                 st.altair_chart(prioritaet_chart, use_container_width=True)
+
+                if not verlauf_stats_df.empty:
+                    st.subheader("Neue Tickets im Zeitverlauf")
+
+                    verlauf_chart = time_series_chart(verlauf_stats_df, "Datum")
+                    st.altair_chart(verlauf_chart, use_container_width=True)
         else:
             st.info("Keine Statistiken verfügbar. Erstellen Sie zuerst einige Tickets.")
     except Exception as e:
@@ -832,7 +922,7 @@ def show_settings():
     st.subheader("⚙️ Einstellungen")
 
     # Tabs für verschiedene Einstellungen
-    settings_tabs = st.tabs(["👤 Mitarbeiter", "🏢 Kunden", "🏷️ Kategorien", "📋 Status"])
+    settings_tabs = st.tabs(["👤 Mitarbeiter", "🏢 Kunden", "🏷️ Kategorien", "📋 Status", "🗄️ Historien-Archiv"])
 
     # Tab: Mitarbeiter
     with settings_tabs[0]:
@@ -868,13 +958,14 @@ def show_settings():
                             INSERT INTO mitarbeiter (Name, Email, Password_hash, salt, Rolle, password_change_required)
                             VALUES (:name, :email, :password_hash, :salt, :rolle, FALSE)
                             """)
-                            conn.execute(insert_query, {
+                            result = conn.execute(insert_query, {
                                 "name": name,
                                 "email": email,
                                 "password_hash": password_hash,
                                 "salt": salt,
                                 "rolle": rolle
                             })
+                            publish_change("mitarbeiter", result.lastrowid, ACTION_INSERT, conn=conn)
 
                         st.success(f"Mitarbeiter '{name}' erfolgreich hinzugefügt!")
                         st.rerun()
@@ -909,12 +1000,13 @@ def show_settings():
                             INSERT INTO kunde (Name, Kontaktperson, Email, Telefon)
                             VALUES (:name, :Kontaktperson, :email, :telefon)
                             """)
-                            conn.execute(insert_query, {
+                            result = conn.execute(insert_query, {
                                 "name": name,
                                 "Kontaktperson": Kontaktperson,
                                 "email": email,
                                 "telefon": telefon
                             })
+                            publish_change("kunde", result.lastrowid, ACTION_INSERT, conn=conn)
 
                         st.success(f"Kunde '{name}' erfolgreich hinzugefügt!")
                         st.rerun()
@@ -947,10 +1039,11 @@ def show_settings():
                             INSERT INTO kategorie (Name, Beschreibung)
                             VALUES (:name, :beschreibung)
                             """)
-                            conn.execute(insert_query, {
+                            result = conn.execute(insert_query, {
                                 "name": name,
                                 "beschreibung": beschreibung
                             })
+                            publish_change("kategorie", result.lastrowid, ACTION_INSERT, conn=conn)
 
                         st.success(f"Kategorie '{name}' erfolgreich hinzugefügt!")
                         st.rerun()
@@ -983,33 +1076,60 @@ def show_settings():
                             INSERT INTO status (Name, Beschreibung)
                             VALUES (:name, :beschreibung)
                             """)
-                            conn.execute(insert_query, {
+                            result = conn.execute(insert_query, {
                                 "name": name,
                                 "beschreibung": beschreibung
                             })
+                            publish_change("status", result.lastrowid, ACTION_INSERT, conn=conn)
 
+                        invalidate_status_counts()
                         st.success(f"Status '{name}' erfolgreich hinzugefügt!")
                         st.rerun()
                     except Exception as e:
                         st.error(f"Fehler beim Hinzufügen des Status: {str(e)}")
 
+    # Tab: Historien-Archiv
+    with settings_tabs[4]:
+        st.subheader("Historie archivieren")
+        st.write(f"Verschiebt Historien-Einträge geschlossener Tickets ({', '.join(ARCHIVE_CLOSED_STATUS_NAMES)}) "
+                 f"in die Tabelle `{ARCHIVE_TABLE}`. Ein abgebrochener Lauf kann einfach erneut gestartet werden.")
+
+        col1, col2 = st.columns(2)
+        min_age_days = col1.number_input("Mindestalter (Tage)", min_value=1, value=ARCHIVE_MIN_AGE_DAYS, key="archive_min_age")
+        batch_size = col2.number_input("Stapelgröße", min_value=100, max_value=10000, value=ARCHIVE_BATCH_SIZE, step=100, key="archive_batch_size")
+        compressed = st.checkbox("Archivtabelle komprimieren (ROW_FORMAT=COMPRESSED)", key="archive_compressed")
+
+        try:
+            st.write(f"**{count_archivable_rows(engine, min_age_days)}** Einträge können archiviert werden.")
+        except Exception as e:
+            st.error(f"Fehler beim Zählen der archivierbaren Einträge: {str(e)}")
+
+        if st.button("🗄️ Archivierung starten", key="start_archive"):
+            try:
+                if compressed:
+                    ensure_archive_table(compressed=True)
+                progress_text = st.empty()
+                total = run_history_archival(
+                    engine,
+                    min_age_days=min_age_days,
+                    batch_size=batch_size,
+                    on_progress=lambda moved: progress_text.text(f"{moved} Einträge archiviert...")
+                )
+                progress_text.empty()
+                st.success(f"✅ {total} Historien-Einträge archiviert.")
+            except Exception as e:
+                st.error(f"Fehler bei der Archivierung: {str(e)}")
+
 def show_kanban_board():
     """UI for the Kanban board view."""
-    from Main import engine
+    from Ticket import move_ticket_status, TicketConflictError
     st.subheader("📌 Kanban-Board")
-    # The original logic from your file can be placed here.
-    # Status laden
-    status_df = pd.read_sql("SELECT ID_Status, Name FROM status ORDER BY ID_Status", con=engine)
-    status_list = status_df.to_dict('records')
 
-    # Tickets nach Status abrufen
-    query = """
-    SELECT t.ID_Ticket, t.Titel, t.Priorität, s.Name AS Status
-    FROM ticket t
-    LEFT JOIN status s ON t.ID_Status = s.ID_Status
-    ORDER BY t.ID_Status, t.Erstellt_am DESC
-    """
-    tickets_df = pd.read_sql(query, con=engine)
+    # Status und Spaltenköpfe aus dem vorberechneten Cache lesen
+    kanban, computed_at = get_precomputed(KANBAN_KEY)
+    show_staleness(computed_at)
+    status_list = kanban["status"]
+    tickets_df = kanban["tickets"]
 
     # Leeres Board, falls keine Tickets
     if tickets_df.empty:
@@ -1021,8 +1141,8 @@ def show_kanban_board():
 
     for col, status in zip(columns, status_list):
         with col:
-            st.markdown(f"### {status['Name']}")
-            filtered = tickets_df[tickets_df["Status"] == status["Name"]]
+            st.markdown(f"### {status['Name']} ({get_status_count_label(status['ID_Status'])})")
+            filtered = tickets_df[tickets_df["ID_Status"] == status["ID_Status"]]
 
             for _, ticket in filtered.iterrows():
                 st.markdown(f"""
@@ -1044,22 +1164,23 @@ def show_kanban_board():
                                 s["ID_Status"] for s in status_list if s["Name"] == new_status
                             )
 
-                            # Update in DB
-                            with engine.begin() as conn:
-                                conn.execute(text("""
-                                    UPDATE ticket
-                                    SET ID_Status = :status_id, Geändert_am = NOW()
-                                    WHERE ID_Ticket = :ticket_id
-                                """), {
-                                    "status_id": new_status_id,
-                                    "ticket_id": ticket["ID_Ticket"]
-                                })
+                            # Update in DB, schlägt fehl, wenn das Ticket inzwischen geändert wurde
+                            move_ticket_status(int(ticket["ID_Ticket"]), new_status_id, int(ticket["version"]),
+                                               old_status_id=int(ticket["ID_Status"]),
+                                               mitarbeiter_id=st.session_state.user_id)
 
+                            bump_status_count(ticket["ID_Status"], new_status_id)
 
+                            # Eigene Änderung sofort sichtbar machen, Statistiken im Hintergrund nachziehen
+                            refresh_now(KANBAN_KEY)
+                            request_refresh(DASHBOARD_KEY)
 
                             st.success(f"Ticket #{ticket['ID_Ticket']} verschoben nach '{new_status}'")
                             st.rerun()
 
+                        except TicketConflictError as e:
+                            refresh_now(KANBAN_KEY)
+                            st.warning(f"⚠️ {str(e)} Das Board wurde neu geladen, bitte erneut verschieben.")
                         except Exception as e:
                             st.error(f"Fehler beim Verschieben des Tickets: {str(e)}")
 
@@ -0,0 +1,193 @@
+import json
+from sqlalchemy import text
+from TicketArchive import ARCHIVE_TABLE
+from TicketHistoryDelta import decode_history_values
+
+# ==============================================================================
+# ZEITREISE: TICKET-ZUSTAND ZU EINEM BELIEBIGEN ZEITPUNKT
+# ==============================================================================
+# Alle SNAPSHOT_INTERVAL Änderungen wird der vollständige Zustand eines Tickets
+# in ticket_snapshot abgelegt. Für einen Zeitpunkt wird vom nächstgelegenen
+# Snapshot aus nur die Historie dazwischen nachgespielt: vorwärts (Neuer_Wert)
+# ab dem letzten Snapshot davor, sonst rückwärts (Alter_Wert) ab dem ersten
+# Snapshot danach bzw. ab dem aktuellen Ticket.
+
+SNAPSHOT_TABLE = "ticket_snapshot"
+SNAPSHOT_INTERVAL = 20
+
+# Feldnamen, wie sie in ticket_historie protokolliert werden
+SNAPSHOT_FIELDS = ("Titel", "Beschreibung", "Priorität", "Status", "Mitarbeiter", "Kunde", "Kategorie")
+
+
+def ensure_snapshot_table():
+    """Legt die Snapshot-Tabelle an, falls sie fehlt."""
+    from Main import engine
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {SNAPSHOT_TABLE} (
+                    ID_Snapshot INT AUTO_INCREMENT PRIMARY KEY,
+                    ID_Ticket INT NOT NULL,
+                    ID_Historie INT NOT NULL,
+                    Zeitpunkt DATETIME NOT NULL,
+                    Daten LONGTEXT NOT NULL,
+                    INDEX idx_snapshot_ticket_zeit (ID_Ticket, Zeitpunkt)
+                )
+            """))
+        return True
+    except Exception as e:
+        print(f"FEHLER: Snapshot-Tabelle konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def _as_history_value(value):
+    # Gleiche Darstellung wie in make_history_record
+    return str(value) if value is not None else ""
+
+
+def load_current_state(conn, ticket_id):
+    """Liest den aktuellen Zustand eines Tickets in der Darstellung der Historie."""
+    row = conn.execute(text("""
+        SELECT t.Titel, t.Beschreibung, t.Priorität, t.ID_Status, t.ID_Mitarbeiter, t.ID_Kunde,
+               (SELECT k.Name
+                FROM ticket_kategorie tk
+                JOIN kategorie k ON tk.ID_Kategorie = k.ID_Kategorie
+                WHERE tk.ID_Ticket = t.ID_Ticket
+                LIMIT 1) AS Kategorie
+        FROM ticket t
+        WHERE t.ID_Ticket = :ticket_id
+    """), {"ticket_id": ticket_id}).fetchone()
+
+    if row is None:
+        return None
+
+    return {
+        "Titel": _as_history_value(row.Titel),
+        "Beschreibung": _as_history_value(row.Beschreibung),
+        "Priorität": _as_history_value(row.Priorität),
+        "Status": _as_history_value(row.ID_Status),
+        "Mitarbeiter": _as_history_value(row.ID_Mitarbeiter),
+        "Kunde": _as_history_value(row.ID_Kunde),
+        "Kategorie": _as_history_value(row.Kategorie),
+    }
+
+
+def maybe_take_snapshot(conn, ticket_id, interval=SNAPSHOT_INTERVAL):
+    """
+    Legt einen Snapshot an, wenn seit dem letzten mindestens interval Änderungen
+    protokolliert wurden. Läuft in der Transaktion des Aufrufers, direkt nach dem
+    Schreiben der Historie, damit Ticket und Historie zusammenpassen.
+    """
+    last_id = conn.execute(text(f"""
+        SELECT COALESCE(MAX(ID_Historie), 0) FROM {SNAPSHOT_TABLE} WHERE ID_Ticket = :ticket_id
+    """), {"ticket_id": ticket_id}).scalar()
+
+    # Nur bis interval zählen, nicht die gesamte Historie
+    pending = conn.execute(text("""
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM ticket_historie
+            WHERE ID_Ticket = :ticket_id AND ID_Historie > :last_id
+            LIMIT :interval
+        ) x
+    """), {"ticket_id": ticket_id, "last_id": last_id, "interval": interval}).scalar()
+
+    if pending < interval:
+        return False
+
+    newest = conn.execute(text("""
+        SELECT ID_Historie, Geändert_am FROM ticket_historie
+        WHERE ID_Ticket = :ticket_id
+        ORDER BY ID_Historie DESC
+        LIMIT 1
+    """), {"ticket_id": ticket_id}).fetchone()
+
+    state = load_current_state(conn, ticket_id)
+    if state is None:
+        return False
+
+    conn.execute(text(f"""
+        INSERT INTO {SNAPSHOT_TABLE} (ID_Ticket, ID_Historie, Zeitpunkt, Daten)
+        VALUES (:ticket_id, :id_historie, :zeitpunkt, :daten)
+    """), {
+        "ticket_id": ticket_id,
+        "id_historie": newest.ID_Historie,
+        "zeitpunkt": newest.Geändert_am,
+        "daten": json.dumps(state, ensure_ascii=False)
+    })
+    return True
+
+
+def _fetch_changes(conn, ticket_id, conditions, params, descending):
+    """Lädt die Feldänderungen aus Historie und Archiv in Abspielreihenfolge."""
+    field_params = {f"field_{i}": name for i, name in enumerate(SNAPSHOT_FIELDS)}
+    field_list = ", ".join(f":{key}" for key in field_params)
+    direction = "DESC" if descending else "ASC"
+
+    branches = []
+    for table in ("ticket_historie", ARCHIVE_TABLE):
+        branches.append(f"""
+            SELECT ID_Historie, Geändert_am, Feldname, Alter_Wert, Neuer_Wert, Kodierung
+            FROM {table}
+            WHERE ID_Ticket = :ticket_id AND Feldname IN ({field_list}) AND {conditions}
+        """)
+    query = f"SELECT * FROM ({' UNION ALL '.join(branches)}) h ORDER BY h.Geändert_am {direction}, h.ID_Historie {direction}"
+
+    return conn.execute(text(query), {**params, **field_params, "ticket_id": ticket_id}).fetchall()
+
+
+def reconstruct_ticket(engine, ticket_id, at):
+    """
+    Rekonstruiert die Felder eines Tickets zum Zeitpunkt at.
+
+    Returns:
+        (Zustand als Dictionary, Beschreibung der Ausgangsbasis, Anzahl nachgespielter Änderungen)
+        oder (None, None, 0), wenn das Ticket zu diesem Zeitpunkt noch nicht existierte.
+    """
+    with engine.connect() as conn:
+        erstellt_am = conn.execute(text("SELECT Erstellt_am FROM ticket WHERE ID_Ticket = :ticket_id"),
+                                   {"ticket_id": ticket_id}).scalar()
+        if erstellt_am is not None and at < erstellt_am:
+            return None, None, 0
+
+        snapshot = conn.execute(text(f"""
+            SELECT ID_Historie, Zeitpunkt, Daten FROM {SNAPSHOT_TABLE}
+            WHERE ID_Ticket = :ticket_id AND Zeitpunkt <= :at
+            ORDER BY Zeitpunkt DESC, ID_Historie DESC
+            LIMIT 1
+        """), {"ticket_id": ticket_id, "at": at}).fetchone()
+
+        if snapshot is not None:
+            # Vorwärts ab dem letzten Snapshot vor dem Zeitpunkt
+            state = json.loads(snapshot.Daten)
+            changes = _fetch_changes(conn, ticket_id, "ID_Historie > :from_id AND Geändert_am <= :at",
+                                     {"from_id": snapshot.ID_Historie, "at": at}, descending=False)
+            for change in changes:
+                _, neuer_wert = decode_history_values(change.Alter_Wert, change.Neuer_Wert, change.Kodierung)
+                state[change.Feldname] = neuer_wert
+            return state, f"Snapshot vom {snapshot.Zeitpunkt.strftime('%d.%m.%Y %H:%M')}", len(changes)
+
+        # Rückwärts ab dem ersten Snapshot nach dem Zeitpunkt oder ab dem aktuellen Stand
+        snapshot = conn.execute(text(f"""
+            SELECT ID_Historie, Zeitpunkt, Daten FROM {SNAPSHOT_TABLE}
+            WHERE ID_Ticket = :ticket_id AND Zeitpunkt > :at
+            ORDER BY Zeitpunkt, ID_Historie
+            LIMIT 1
+        """), {"ticket_id": ticket_id, "at": at}).fetchone()
+
+        if snapshot is not None:
+            state = json.loads(snapshot.Daten)
+            basis = f"Snapshot vom {snapshot.Zeitpunkt.strftime('%d.%m.%Y %H:%M')}"
+            changes = _fetch_changes(conn, ticket_id, "ID_Historie <= :to_id AND Geändert_am > :at",
+                                     {"to_id": snapshot.ID_Historie, "at": at}, descending=True)
+        else:
+            state = load_current_state(conn, ticket_id)
+            if state is None:
+                return None, None, 0
+            basis = "aktueller Stand"
+            changes = _fetch_changes(conn, ticket_id, "Geändert_am > :at", {"at": at}, descending=True)
+
+        for change in changes:
+            alter_wert, _ = decode_history_values(change.Alter_Wert, change.Neuer_Wert, change.Kodierung)
+            state[change.Feldname] = alter_wert
+        return state, basis, len(changes)
@@ -0,0 +1,152 @@
+from datetime import timedelta
+from types import SimpleNamespace
+from sqlalchemy import text
+from TicketArchive import ARCHIVE_TABLE
+from TicketHistoryDelta import decode_history_values
+
+# ==============================================================================
+# TICKET-ZEITLEISTE
+# ==============================================================================
+# Kommentare, Feldänderungen und gesendete E-Mails eines Tickets werden mit einer
+# einzigen UNION-ALL-Abfrage nach Zeitpunkt sortiert und seitenweise geladen.
+# Geblättert wird per Keyset über (Zeitpunkt, Quelle, ID_Eintrag), damit auch
+# Tickets mit tausenden Einträgen so schnell öffnen wie neue.
+
+TIMELINE_PAGE_SIZE = 50
+
+TYPE_COMMENT = "Kommentar"
+TYPE_CHANGE = "Änderung"
+TYPE_EMAIL = "E-Mail"
+TIMELINE_TYPES = (TYPE_COMMENT, TYPE_CHANGE, TYPE_EMAIL)
+
+# Feldname, unter dem gesendete E-Mails in ticket_historie protokolliert werden
+EMAIL_FIELD_NAME = "E-Mail gesendet"
+
+# Quelle als Tie-Breaker, da IDs aus verschiedenen Tabellen kollidieren können
+SOURCE_COMMENT = 1
+SOURCE_HISTORY = 2
+
+COMMENT_INDEX_NAME = "idx_kommentar_ticket_zeit"
+
+
+def ensure_timeline_indexes():
+    """Legt den Index für die Kommentar-Seite der Zeitleiste an, falls er fehlt."""
+    from Main import engine, inspector
+
+    try:
+        indexes = inspector.get_indexes("ticket_kommentar")
+        if any(idx["name"] == COMMENT_INDEX_NAME for idx in indexes):
+            return True
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE INDEX {COMMENT_INDEX_NAME} ON ticket_kommentar (ID_Ticket, Erstellt_am, ID_Kommentar)"))
+        inspector.clear_cache()
+        return True
+    except Exception as e:
+        print(f"FEHLER: Index auf ticket_kommentar konnte nicht angelegt werden: {str(e)}")
+        return False
+
+
+def _branch_filters(source, time_col, id_col, feld_col, params, feld_filter, date_from, date_to, cursor):
+    """Baut die Bedingungen eines UNION-Zweigs, sodass jeder Zweig seinen eigenen Index nutzt."""
+    conditions = []
+    if feld_filter:
+        conditions.append(f"{feld_col} LIKE :feld_filter")
+        params["feld_filter"] = f"%{feld_filter}%"
+    if date_from:
+        conditions.append(f"{time_col} >= :date_from")
+        params["date_from"] = date_from
+    if date_to:
+        conditions.append(f"{time_col} < :date_to")
+        params["date_to"] = date_to + timedelta(days=1)
+    if cursor:
+        # Keyset-Bedingung (Zeitpunkt, Quelle, ID) < Cursor, mit fester Quelle je Zweig
+        conditions.append(f"""({time_col} < :cursor_at
+            OR ({time_col} = :cursor_at AND ({source} < :cursor_source
+                OR ({source} = :cursor_source AND {id_col} < :cursor_id))))""")
+    return "".join(f" AND {condition}" for condition in conditions)
+
+
+def fetch_ticket_timeline(engine, ticket_id, types=TIMELINE_TYPES, feld_filter=None, date_from=None, date_to=None,
+                          cursor=None, page_size=TIMELINE_PAGE_SIZE, include_archive=False):
+    """
+    Lädt eine Seite der Zeitleiste eines Tickets, neueste Einträge zuerst.
+
+    Args:
+        types: Welche Eintragsarten geladen werden (Kommentar, Änderung, E-Mail)
+        feld_filter: Teilstring für den Feldnamen (Kommentare heißen "Kommentar")
+        cursor: Cursor aus dem vorherigen Aufruf oder None für die erste Seite
+        include_archive: Auch archivierte Historien-Einträge aus ticket_historie_archiv laden
+
+    Returns:
+        (Liste der Zeilen, Cursor für die nächste Seite oder None)
+    """
+    params = {"ticket_id": ticket_id, "limit": page_size + 1}
+    if cursor:
+        params["cursor_at"], params["cursor_source"], params["cursor_id"] = cursor
+
+    branches = []
+
+    if TYPE_COMMENT in types:
+        filters = _branch_filters(SOURCE_COMMENT, "tk.Erstellt_am", "tk.ID_Kommentar", f"'{TYPE_COMMENT}'",
+                                  params, feld_filter, date_from, date_to, cursor)
+        branches.append(f"""(
+            SELECT '{TYPE_COMMENT}' AS Typ, {SOURCE_COMMENT} AS Quelle, tk.ID_Kommentar AS ID_Eintrag,
+                   tk.Erstellt_am AS Zeitpunkt, m.Name AS Mitarbeiter_Name,
+                   '{TYPE_COMMENT}' AS Feldname, NULL AS Alter_Wert, tk.Kommentar_Text AS Neuer_Wert,
+                   NULL AS Kodierung
+            FROM ticket_kommentar tk
+            LEFT JOIN mitarbeiter m ON tk.Erstellt_von = m.ID_Mitarbeiter
+            WHERE tk.ID_Ticket = :ticket_id{filters}
+            ORDER BY tk.Erstellt_am DESC, tk.ID_Kommentar DESC
+            LIMIT :limit
+        )""")
+
+    if TYPE_CHANGE in types or TYPE_EMAIL in types:
+        filters = _branch_filters(SOURCE_HISTORY, "th.Geändert_am", "th.ID_Historie", "th.Feldname",
+                                  params, feld_filter, date_from, date_to, cursor)
+        # Kommentare werden zusätzlich in der Historie protokolliert und kommen bereits aus ticket_kommentar
+        filters += f" AND th.Feldname <> '{TYPE_COMMENT}'"
+        if TYPE_CHANGE not in types:
+            filters += " AND th.Feldname = :email_field"
+        elif TYPE_EMAIL not in types:
+            filters += " AND th.Feldname <> :email_field"
+        params["email_field"] = EMAIL_FIELD_NAME
+
+        # Archivierte Einträge behalten ihre ID_Historie und teilen sich deshalb die Quelle
+        history_tables = ["ticket_historie"] + ([ARCHIVE_TABLE] if include_archive else [])
+        for table in history_tables:
+            branches.append(f"""(
+                SELECT CASE WHEN th.Feldname = :email_field THEN '{TYPE_EMAIL}' ELSE '{TYPE_CHANGE}' END AS Typ,
+                       {SOURCE_HISTORY} AS Quelle, th.ID_Historie AS ID_Eintrag,
+                       th.Geändert_am AS Zeitpunkt, m.Name AS Mitarbeiter_Name,
+                       th.Feldname, th.Alter_Wert, th.Neuer_Wert, th.Kodierung
+                FROM {table} th
+                LEFT JOIN mitarbeiter m ON th.Geändert_von = m.ID_Mitarbeiter
+                WHERE th.ID_Ticket = :ticket_id{filters}
+                ORDER BY th.Geändert_am DESC, th.ID_Historie DESC
+                LIMIT :limit
+            )""")
+
+    if not branches:
+        return [], None
+
+    # Jeder Zweig liefert höchstens eine Seite, das äußere ORDER BY mischt nur noch diese Zeilen
+    query = f"SELECT * FROM ({' UNION ALL '.join(branches)}) tl"
+    query += " ORDER BY tl.Zeitpunkt DESC, tl.Quelle DESC, tl.ID_Eintrag DESC LIMIT :limit"
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(query), params).fetchall()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = (last.Zeitpunkt, last.Quelle, last.ID_Eintrag)
+
+    # Delta-kodierte Werte für die Anzeige wiederherstellen
+    entries = []
+    for row in rows:
+        entry = dict(row._mapping)
+        entry["Alter_Wert"], entry["Neuer_Wert"] = decode_history_values(entry["Alter_Wert"], entry["Neuer_Wert"], entry.pop("Kodierung"))
+        entries.append(SimpleNamespace(**entry))
+    return entries, next_cursor